@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import random
+import re
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import main
+from main import ConnectionManager
+from wire import FRAME_HEADER, SUBPROTOCOLS
+
+# Results land here by default, one file per run named after the commit and time
+RESULTS_DIR = Path(__file__).parent / "benchmarks"
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
+# Messages are serialized with json.dumps, so the sequence number follows the type
+SEQ_PATTERN = re.compile(r'"seq": (\d+)')
+
+
+def summarize(seconds: List[float]) -> Dict:
+    """Percentiles of a list of durations, in milliseconds"""
+    if not seconds:
+        return {"count": 0}
+    values = sorted(seconds)
+
+    def at(q):
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) * 1000,
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": values[-1] * 1000,
+    }
+
+
+def histogram(seconds: List[float]) -> Dict[str, int]:
+    counts = [0] * len(LATENCY_BUCKETS_MS)
+    for value in seconds:
+        ms = value * 1000
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                counts[i] += 1
+                break
+    return {f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS_MS, counts)}
+
+
+class Recorder:
+    """Shared timing state for one scenario"""
+
+    def __init__(self):
+        # perf_counter() at the start of the tick that produced each cell_update seq
+        self.tick_started: Dict[int, float] = {}
+        self.tick_durations: List[float] = []
+        self.latencies: List[float] = []
+        self.edit_latencies: List[float] = []
+
+
+class SimulatedClient:
+    """A websocket client talking ASGI directly to the app, with no network in between"""
+
+    ids = itertools.count(1)
+
+    def __init__(self, recorder: Recorder, path: str = "/ws", query: str = "", editor: bool = False,
+                 encoding: str = "json"):
+        self.recorder = recorder
+        self.subprotocols = [name for name, value in SUBPROTOCOLS.items() if value == encoding]
+        self.path = path
+        self.query = query
+        self.editor = editor
+        self.user_id = f"bench-{next(self.ids)}"
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.accepted = asyncio.Event()
+        self.closed = False
+        self.messages = 0
+        self.bytes = 0
+        self.snapshots = 0
+        # (symbol, field) -> perf_counter() when this editor sent an override for it
+        self.pending_edits: Dict[tuple, float] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self.path,
+            "raw_path": self.path.encode(),
+            "query_string": self.query.encode(),
+            "root_path": "",
+            "headers": [],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+            "subprotocols": self.subprotocols,
+        }
+        self.incoming.put_nowait({"type": "websocket.connect"})
+        self.task = asyncio.create_task(main.app(scope, self.receive, self.send))
+        await self.accepted.wait()
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send(self, message):
+        now = time.perf_counter()
+        kind = message["type"]
+        if kind == "websocket.accept":
+            self.accepted.set()
+        elif kind == "websocket.close":
+            self.closed = True
+            self.accepted.set()
+        elif kind == "websocket.send":
+            frame = message.get("bytes")
+            if frame is not None:
+                # Binary frames are only used for cell updates
+                self.messages += 1
+                self.bytes += len(frame)
+                started = self.recorder.tick_started.get(FRAME_HEADER.unpack_from(frame)[3])
+                if started is not None:
+                    self.recorder.latencies.append(now - started)
+                return
+            text = message.get("text") or ""
+            self.messages += 1
+            self.bytes += len(text.encode())
+            if text.startswith('{"type": "cell_update"'):
+                match = SEQ_PATTERN.search(text, 0, 64)
+                started = self.recorder.tick_started.get(int(match.group(1))) if match else None
+                if started is not None:
+                    self.recorder.latencies.append(now - started)
+                if self.editor and self.pending_edits:
+                    cell_data = json.loads(text)["cell_data"]
+                    for symbol, field in list(self.pending_edits):
+                        if field in cell_data.get(symbol, {}):
+                            self.recorder.edit_latencies.append(now - self.pending_edits.pop((symbol, field)))
+            elif text.startswith('{"type": "snapshot"'):
+                self.snapshots += 1
+
+    def send_json(self, message: Dict):
+        self.incoming.put_nowait({"type": "websocket.receive", "text": json.dumps(message)})
+
+    def edit(self, symbol: str, field: str, value: Optional[float]):
+        self.pending_edits[(symbol, field)] = time.perf_counter()
+        self.send_json({"symbol": symbol, "cell_id": field, "value": value, "user_id": self.user_id})
+
+    async def close(self):
+        self.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        try:
+            await asyncio.wait_for(self.task, 5)
+        except (asyncio.TimeoutError, Exception):
+            self.task.cancel()
+
+
+def build_manager(symbols: int, refs: int, columnar: bool, seed: int) -> ConnectionManager:
+    """A sheet of `symbols` symbols whose bid edges each average `refs` earlier symbols' bid edges"""
+    manager = ConnectionManager(columnar=columnar, seed=seed)
+    names = list(manager.symbols)
+    # Leave the built-in symbols' own formulas alone so no cycles are introduced
+    first = len(names) + refs
+    while len(names) < symbols:
+        name = f"B{len(names):05d}"
+        manager.add_symbol(name, "benchmark")
+        names.append(name)
+    if refs > 0:
+        for i in range(first, len(names)):
+            terms = " + ".join(f"context['{names[i - j]}']['bid_edge']" for j in range(1, refs + 1))
+            manager.set_formula(names[i], "bid_edge", f"({terms}) / {refs} + 0.01")
+            manager.set_formula(names[i], "ask_edge", "bid_edge + 0.25")
+    return manager
+
+
+async def run_editor(client: SimulatedClient, symbols: List[str], rate: float, rng: random.Random):
+    """Alternate setting and clearing overrides on random input cells at `rate` edits per second"""
+    overridden = []
+    while True:
+        await asyncio.sleep(1 / rate)
+        if overridden and rng.random() < 0.5:
+            symbol, field = overridden.pop(rng.randrange(len(overridden)))
+            client.edit(symbol, field, None)
+        else:
+            symbol, field = rng.choice(symbols), rng.choice(("bid_q", "ask_q"))
+            overridden.append((symbol, field))
+            client.edit(symbol, field, rng.randint(1, 100))
+
+
+async def run_scenario(symbols: int, refs: int, clients: int, editors: int, duration: float,
+                       interval: float, edit_rate: float, columnar: bool, seed: int,
+                       encoding: str = "json", subscribe: int = 0) -> Dict:
+    recorder = Recorder()
+    setup_started = time.perf_counter()
+    manager = build_manager(symbols, refs, columnar, seed)
+    # The /ws handler works on the module-level manager
+    main.manager = manager
+    setup_seconds = time.perf_counter() - setup_started
+
+    names = list(manager.symbols)
+    readers = []
+    for i in range(clients):
+        query = ""
+        if subscribe:
+            # Each reader watches its own window of the sheet, as a desk would
+            start = i * subscribe % len(names)
+            window = (names + names)[start:start + min(subscribe, len(names))]
+            query = f"symbols={','.join(window)}"
+        readers.append(SimulatedClient(recorder, query=query, encoding=encoding))
+    # Editors stay on JSON so their edit latencies can be matched to cells
+    writers = [SimulatedClient(recorder, editor=True) for _ in range(editors)]
+    for client in readers + writers:
+        await client.connect()
+    rng = random.Random(seed)
+    editor_tasks = [asyncio.create_task(run_editor(client, names, edit_rate, random.Random(rng.random())))
+                    for client in writers]
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + duration
+    while loop.time() < deadline:
+        seq = manager.seq
+        tick_started = time.perf_counter()
+        await manager.tick()
+        recorder.tick_durations.append(time.perf_counter() - tick_started)
+        if manager.seq != seq:
+            recorder.tick_started[manager.seq] = tick_started
+        # Even with no interval, yield so the client senders can drain
+        await asyncio.sleep(interval)
+    elapsed = loop.time() - started
+
+    for task in editor_tasks:
+        task.cancel()
+    # Give queued messages a moment to reach the clients before measuring them
+    drain_deadline = loop.time() + 5
+    while loop.time() < drain_deadline and any(channel.queue for channel in manager.fanout.channels.values()):
+        await asyncio.sleep(0.01)
+    channels = list(manager.fanout.channels.values())
+    dropped = sum(channel.dropped for channel in channels)
+    everyone = readers + writers
+    # Clients closed by the server, e.g. by the disconnect overflow policy
+    disconnected = sum(client.closed for client in everyone)
+    for client in everyone:
+        await client.close()
+
+    return {
+        "symbols": len(manager.symbols),
+        "formula_refs": refs,
+        "clients": clients,
+        "editors": editors,
+        "columnar": manager.store is not None,
+        "encoding": encoding,
+        "subscribe": subscribe,
+        "interval": interval,
+        "setup_seconds": setup_seconds,
+        "elapsed_seconds": elapsed,
+        "ticks": len(recorder.tick_durations),
+        "ticks_per_second": len(recorder.tick_durations) / elapsed if elapsed > 0 else None,
+        "tick_ms": summarize(recorder.tick_durations),
+        "latency_ms": summarize(recorder.latencies),
+        "latency_histogram": histogram(recorder.latencies),
+        "edit_latency_ms": summarize(recorder.edit_latencies),
+        "edit_latency_histogram": histogram(recorder.edit_latencies),
+        "messages": sum(client.messages for client in everyone),
+        "bytes": sum(client.bytes for client in everyone),
+        "snapshots": sum(client.snapshots for client in everyone),
+        "dropped": dropped,
+        "disconnected": disconnected,
+    }
+
+
+def scenario_key(result: Dict) -> tuple:
+    return (result["symbols"], result["formula_refs"], result["clients"], result["editors"], result["columnar"],
+            result.get("encoding", "json"), result.get("subscribe", 0))
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result: Dict, baseline: Optional[Dict] = None):
+    line = (f"symbols={result['symbols']:<6} refs={result['formula_refs']:<3} clients={result['clients']:<4} "
+            f"editors={result['editors']:<3} {result['encoding']:<6} sub={result['subscribe'] or 'all':<4} ticks/s={result['ticks_per_second']:9.1f} "
+            f"tick p99={result['tick_ms'].get('p99', 0):8.2f}ms "
+            f"latency p99={result['latency_ms'].get('p99', 0):8.2f}ms")
+    if baseline is not None and baseline.get("ticks_per_second"):
+        line += f" ({result['ticks_per_second'] / baseline['ticks_per_second']:.2f}x baseline ticks/s)"
+    print(line, flush=True)
+
+
+def parse_ints(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part]
+
+
+if __name__ == "__main__":
+    # python bench.py --symbols 10,1000 --refs 0,4 --clients 1,50 --editors 0,4 --duration 5
+    parser = argparse.ArgumentParser(description="Benchmark the tick loop and websocket fan-out in-process")
+    parser.add_argument("--symbols", type=parse_ints, default=[10, 100, 1000])
+    parser.add_argument("--refs", type=parse_ints, default=[0, 2, 8],
+                        help="symbols each bid_edge formula references; 0 for no formulas")
+    parser.add_argument("--clients", type=parse_ints, default=[1, 10, 100])
+    parser.add_argument("--editors", type=parse_ints, default=[0, 4])
+    parser.add_argument("--encodings", type=lambda value: value.split(","), default=["json"],
+                        help=f"client encodings to sweep: {', '.join(sorted(set(SUBPROTOCOLS.values())))}")
+    parser.add_argument("--subscribe", type=parse_ints, default=[0],
+                        help="symbols each reader subscribes to; 0 for all of them")
+    parser.add_argument("--edit-rate", type=float, default=20, help="overrides per second per editor")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per scenario")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between ticks; 0 runs them back to back")
+    parser.add_argument("--columnar", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help=f"results file (default: under {RESULTS_DIR}/)")
+    parser.add_argument("--baseline", type=Path, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        baseline = {scenario_key(result): result for result in json.loads(args.baseline.read_text())["scenarios"]}
+
+    async def run_all():
+        results = []
+        for symbols, refs, clients, editors, encoding, subscribe in itertools.product(
+                args.symbols, args.refs, args.clients, args.editors, args.encodings, args.subscribe):
+            result = await run_scenario(symbols, refs, clients, editors, args.duration, args.interval,
+                                        args.edit_rate, args.columnar, args.seed, encoding, subscribe)
+            print_result(result, baseline.get(scenario_key(result)))
+            results.append(result)
+        return results
+
+    started = datetime.now()
+    commit = git_commit()
+    scenarios = asyncio.run(run_all())
+    output = args.output or RESULTS_DIR / f"bench_{commit or 'unknown'}_{started.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "commit": commit,
+        "started": started.isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "args": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "scenarios": scenarios,
+    }, indent=2))
+    print(f"Results written to {output}")
@@ -0,0 +1,119 @@
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from formulas import FormulaError
+
+# A cell is a (symbol, field) pair
+Cell = Tuple[str, str]
+
+
+class CycleError(FormulaError):
+    """Raised when a formula would make a cell depend on itself through other cells"""
+
+
+class DependencyGraph:
+    """Cells and the cells their formulas read, with a cached topological order.
+
+    A formula reading its own cell sees the previous value, so that isn't
+    treated as an edge. Changed cells are marked dirty and `take_dirty`
+    returns them plus everything downstream, ordered so every cell comes
+    after the cells it reads.
+    """
+
+    def __init__(self):
+        self.inputs: Dict[Cell, Set[Cell]] = {}
+        self.dependents: Dict[Cell, Set[Cell]] = {}
+        self.dirty: Set[Cell] = set()
+        self._order: Optional[List[Cell]] = None
+        self._rank: Dict[Cell, int] = {}
+
+    def check_inputs(self, cell: Cell, inputs: Iterable[Cell]):
+        """Raise CycleError if `cell` reading `inputs` would create a cycle"""
+        inputs = set(inputs)
+        inputs.discard(cell)
+        if not inputs:
+            return
+        # A cycle exists if one of the new inputs is already downstream of cell
+        seen = {cell}
+        queue = deque([cell])
+        while queue:
+            current = queue.popleft()
+            for dependent in self.dependents.get(current, ()):
+                if dependent in inputs:
+                    raise CycleError(
+                        f"Formula for {cell[0]}.{cell[1]} creates a cycle through {dependent[0]}.{dependent[1]}"
+                    )
+                if dependent not in seen:
+                    seen.add(dependent)
+                    queue.append(dependent)
+
+    def set_inputs(self, cell: Cell, inputs: Iterable[Cell]):
+        """Replace the cells `cell` reads; raises CycleError and changes nothing on a cycle"""
+        inputs = set(inputs)
+        inputs.discard(cell)
+        if inputs == self.inputs.get(cell, set()):
+            return
+        self.check_inputs(cell, inputs)
+        for old in self.inputs.get(cell, ()):
+            self.dependents[old].discard(cell)
+        self.inputs[cell] = inputs
+        self.dependents.setdefault(cell, set())
+        for new in inputs:
+            self.dependents.setdefault(new, set()).add(cell)
+            self.inputs.setdefault(new, set())
+        self._order = None
+
+    def topological_order(self) -> List[Cell]:
+        if self._order is None:
+            remaining = {cell: len(inputs) for cell, inputs in self.inputs.items()}
+            queue = deque(sorted(cell for cell, count in remaining.items() if count == 0))
+            order = []
+            while queue:
+                cell = queue.popleft()
+                order.append(cell)
+                for dependent in self.dependents.get(cell, ()):
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        queue.append(dependent)
+            if len(order) != len(remaining):
+                # set_inputs rejects cycles, so this only happens if the dicts were edited directly
+                raise CycleError("Dependency graph contains a cycle")
+            self._order = order
+            self._rank = {cell: i for i, cell in enumerate(order)}
+        return self._order
+
+    def levels(self) -> Dict[Cell, int]:
+        """Each cell's depth: 0 for cells that read nothing, otherwise one more than its deepest input"""
+        levels: Dict[Cell, int] = {}
+        for cell in self.topological_order():
+            inputs = self.inputs.get(cell)
+            levels[cell] = 1 + max(levels[i] for i in inputs) if inputs else 0
+        return levels
+
+    def mark_dirty(self, cell: Cell):
+        self.dirty.add(cell)
+
+    def has_dependents(self, cell: Cell) -> bool:
+        """Whether any formula reads `cell`; an input nothing reads needn't be marked dirty when it changes"""
+        return bool(self.dependents.get(cell))
+
+    def affected(self, cells: Iterable[Cell]) -> List[Cell]:
+        """Return `cells` and every cell downstream of them in topological order"""
+        self.topological_order()
+        seen = set(cells)
+        queue = deque(seen)
+        while queue:
+            current = queue.popleft()
+            for dependent in self.dependents.get(current, ()):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    queue.append(dependent)
+        rank = self._rank
+        return sorted(seen, key=lambda cell: rank.get(cell, -1))
+
+    def take_dirty(self) -> List[Cell]:
+        """Return the dirty cells and their downstream cells in order, clearing the dirty set"""
+        if not self.dirty:
+            return []
+        dirty, self.dirty = self.dirty, set()
+        return self.affected(dirty)
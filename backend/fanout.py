@@ -0,0 +1,380 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+from fnmatch import fnmatchcase
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket
+
+from metrics import metrics
+
+# What a client's queue does when a new message arrives and it's full
+OVERFLOW_POLICIES = ("drop_oldest", "conflate", "disconnect")
+DEFAULT_OVERFLOW = "conflate"
+DEFAULT_MAX_QUEUE = 256
+
+# A queued item is either a pre-encoded frame (text or binary) or a callable that builds it at send time
+QueueItem = Union[str, bytes, Callable[[], Union[str, bytes]]]
+# Messages carrying only cell data, which a resync snapshot supersedes; anything else must be delivered
+CELL_MESSAGES = ("cell_update", "snapshot")
+
+SEND_SECONDS = metrics.histogram("trading_ws_send_seconds", "Time to write one message to a websocket")
+ENCODE_SECONDS = metrics.histogram("trading_ws_encode_seconds",
+                                   "Time to encode a message once for every client using an encoding", ("encoding",))
+
+# A subscription entry with any of these is a pattern rather than a symbol name
+PATTERN_CHARS = "*?["
+
+
+class Subscription:
+    """The symbols and fields a client is sent cell updates for; None means all of them.
+
+    Symbol entries are names or shell-style patterns such as "ES*".
+    Subscriptions are immutable, and equal ones share a key so their
+    clients can be sent the same encoded payload.
+    """
+
+    def __init__(self, symbols: Optional[Iterable[str]] = None, fields: Optional[Iterable[str]] = None):
+        self.entries: Optional[FrozenSet[str]] = None if symbols is None else frozenset(symbols)
+        self.names: Optional[FrozenSet[str]] = None
+        self.patterns: Tuple[str, ...] = ()
+        if self.entries is not None and "*" not in self.entries:
+            self.names = frozenset(entry for entry in self.entries if not any(c in entry for c in PATTERN_CHARS))
+            self.patterns = tuple(sorted(self.entries - self.names))
+        self.fields: Optional[FrozenSet[str]] = None if fields is None else frozenset(fields)
+        self.key = (self.names, self.patterns, self.fields)
+
+    @property
+    def everything(self) -> bool:
+        return self.names is None and self.fields is None
+
+    def wants(self, symbol: str) -> bool:
+        if self.names is None or symbol in self.names:
+            return True
+        return any(fnmatchcase(symbol, pattern) for pattern in self.patterns)
+
+    def filter(self, cell_data: Dict) -> Dict:
+        """The part of a cell_data dict (symbol -> field -> cell) this subscription covers"""
+        if self.everything:
+            return cell_data
+        filtered = {}
+        for symbol, cells in cell_data.items():
+            if not self.wants(symbol):
+                continue
+            if self.fields is not None:
+                cells = {field: cell for field, cell in cells.items() if field in self.fields}
+            if cells:
+                filtered[symbol] = cells
+        return filtered
+
+    def add(self, symbols: Optional[Iterable[str]] = None, fields: Optional[Iterable[str]] = None) -> "Subscription":
+        """This subscription plus `symbols` and `fields`; adding to "all" narrows it to just those"""
+        entries = self.entries
+        if symbols is not None:
+            entries = set(symbols) if entries is None else entries | set(symbols)
+        wanted = self.fields
+        if fields is not None:
+            wanted = set(fields) if wanted is None else wanted | set(fields)
+        return Subscription(entries, wanted)
+
+    def remove(self, symbols: Optional[Iterable[str]] = None, fields: Optional[Iterable[str]] = None,
+               all_symbols: Iterable[str] = (), all_fields: Iterable[str] = ()) -> "Subscription":
+        """This subscription less `symbols` and `fields`; removing from "all" starts from `all_symbols`/`all_fields`"""
+        entries = self.entries
+        if symbols is not None:
+            entries = (set(all_symbols) if entries is None or "*" in entries else entries) - set(symbols)
+        wanted = self.fields
+        if fields is not None:
+            wanted = (set(all_fields) if wanted is None else wanted) - set(fields)
+        return Subscription(entries, wanted)
+
+    def to_dict(self) -> Dict:
+        return {
+            "symbols": None if self.entries is None else sorted(self.entries),
+            "fields": None if self.fields is None else sorted(self.fields),
+        }
+
+
+EVERYTHING = Subscription()
+
+
+class ClientChannel:
+    """A bounded outgoing queue for one websocket, drained by its own sender task"""
+
+    ids = itertools.count(1)
+
+    def __init__(self, websocket: WebSocket, max_queue: int = DEFAULT_MAX_QUEUE,
+                 overflow: str = DEFAULT_OVERFLOW, resync: Optional[Callable[[], str]] = None,
+                 on_close: Optional[Callable[["ClientChannel"], None]] = None, encoding: str = "json",
+                 subscription: Subscription = EVERYTHING):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.websocket = websocket
+        self.encoding = encoding
+        self.subscription = subscription
+        # Names the client in metrics; the port keeps two tabs on one host apart
+        client = getattr(websocket, "client", None)
+        self.name = f"{client.host}:{client.port}" if client else f"client-{next(self.ids)}"
+        self.max_queue = max(1, max_queue)
+        self.overflow = overflow
+        self.resync = resync
+        self.on_close = on_close
+        # (item, whether it only carries cell data a resync would supersede)
+        self.queue: deque = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.send_seconds = 0.0
+        self.task = asyncio.create_task(self.run())
+
+    def push(self, item: QueueItem, cells_only: bool = False) -> bool:
+        """Queue an item without waiting; returns False if the channel is closed.
+
+        `cells_only` marks cell updates and snapshots, the only items the
+        conflate policy may replace with a resync.
+        """
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            if self.overflow == "conflate" and self.resync is not None:
+                resynced = self._conflate()
+                if resynced and cells_only:
+                    # The resync queued in place of the cell data covers this too
+                    self.dropped += 1
+                    return True
+                if len(self.queue) >= self.max_queue:
+                    # Full of messages the client can't do without; it can't keep up
+                    self.close()
+                    return False
+            elif self.overflow == "disconnect":
+                self.close()
+                return False
+            else:
+                self.queue.popleft()
+                self.dropped += 1
+        self.queue.append((item, cells_only))
+        self.ready.set()
+        return True
+
+    def _conflate(self) -> bool:
+        """Replace the queued cell data with one resync where the first of it was; False if there's none"""
+        kept = deque()
+        replaced = 0
+        for entry in self.queue:
+            if not entry[1]:
+                kept.append(entry)
+            elif not replaced:
+                kept.append((self.resync, True))
+            replaced += entry[1]
+        if not replaced:
+            return False
+        self.dropped += replaced
+        self.queue = kept
+        return True
+
+    async def run(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                item, _ = self.queue.popleft()
+                if callable(item):
+                    item = item()
+                started = time.perf_counter()
+                if isinstance(item, bytes):
+                    await self.websocket.send_bytes(item)
+                else:
+                    await self.websocket.send_text(item)
+                elapsed = time.perf_counter() - started
+                SEND_SECONDS.observe(elapsed)
+                self.send_seconds += elapsed
+                self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # The socket is gone; the receive loop will see the disconnect too
+            pass
+        finally:
+            self._closed()
+
+    def close(self):
+        if self.closed:
+            return
+        self._closed()
+        self.task.cancel()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=1013)  # Try again later
+        except Exception:
+            pass
+
+    def _closed(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        if self.on_close is not None:
+            self.on_close(self)
+
+
+class SubscriptionGroup:
+    """The channels with one subscription, which share each encoded payload"""
+
+    def __init__(self, subscription: Subscription):
+        self.subscription = subscription
+        self.channels: Set[ClientChannel] = set()
+        # seq of the last cell_update sent to this group; it skips the ones with nothing for it
+        self.last_seq = 0
+
+
+class Fanout:
+    """Routes each message to the clients subscribed to it, encoding it once per subscription and encoding.
+
+    Clients with the same subscription form a group. Which groups want a
+    symbol is looked up once and cached until a group comes or goes, so a
+    cell update only touches the groups interested in its symbols. Messages
+    without cell data go to everyone.
+    """
+
+    def __init__(self):
+        self.channels: Dict[WebSocket, ClientChannel] = {}
+        # Encoding name -> message encoder; other encodings are registered by the app
+        self.encoders: Dict[str, Callable[[dict], Union[str, bytes]]] = {"json": json.dumps}
+        self.groups: Dict[Tuple, SubscriptionGroup] = {}
+        # Symbol -> the groups, other than the one for everything, that want it
+        self.routes: Dict[str, List[SubscriptionGroup]] = {}
+        # seq of the last cell_update published; new groups start from it
+        self.last_seq = 0
+
+    def add(self, websocket: WebSocket, max_queue: int = DEFAULT_MAX_QUEUE,
+            overflow: str = DEFAULT_OVERFLOW, resync: Optional[Callable[[], str]] = None,
+            encoding: str = "json", subscription: Subscription = EVERYTHING) -> ClientChannel:
+        if encoding not in self.encoders:
+            raise ValueError(f"Unknown encoding: {encoding}")
+        channel = ClientChannel(websocket, max_queue, overflow, resync, on_close=self._on_close,
+                                encoding=encoding, subscription=subscription)
+        self.channels[websocket] = channel
+        self._join(channel)
+        return channel
+
+    def remove(self, websocket: WebSocket):
+        channel = self.channels.pop(websocket, None)
+        if channel is not None:
+            self._leave(channel)
+            channel.close()
+
+    def _on_close(self, channel: ClientChannel):
+        if self.channels.get(channel.websocket) is channel:
+            del self.channels[channel.websocket]
+            self._leave(channel)
+
+    def subscription_of(self, websocket: WebSocket) -> Subscription:
+        channel = self.channels.get(websocket)
+        return EVERYTHING if channel is None else channel.subscription
+
+    def subscribe(self, websocket: WebSocket, subscription: Subscription) -> bool:
+        """Replace a client's subscription; returns False if it isn't connected"""
+        channel = self.channels.get(websocket)
+        if channel is None:
+            return False
+        self._leave(channel)
+        channel.subscription = subscription
+        self._join(channel)
+        return True
+
+    def _join(self, channel: ClientChannel):
+        key = channel.subscription.key
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = SubscriptionGroup(channel.subscription)
+            group.last_seq = self.last_seq
+            self.routes.clear()
+        group.channels.add(channel)
+
+    def _leave(self, channel: ClientChannel):
+        key = channel.subscription.key
+        group = self.groups.get(key)
+        if group is None:
+            return
+        group.channels.discard(channel)
+        if not group.channels:
+            del self.groups[key]
+            self.routes.clear()
+
+    def _route(self, symbol: str) -> List[SubscriptionGroup]:
+        groups = self.routes.get(symbol)
+        if groups is None:
+            groups = self.routes[symbol] = [
+                group for group in self.groups.values()
+                if not group.subscription.everything and group.subscription.wants(symbol)
+            ]
+        return groups
+
+    def _push(self, channels: Iterable[ClientChannel], message: dict):
+        encoded: Dict[str, Union[str, bytes]] = {}
+        for channel in list(channels):
+            payload = encoded.get(channel.encoding)
+            if payload is None:
+                started = time.perf_counter()
+                payload = encoded[channel.encoding] = self.encoders[channel.encoding](message)
+                ENCODE_SECONDS.observe(time.perf_counter() - started, (channel.encoding,))
+            channel.push(payload, message.get("type") in CELL_MESSAGES)
+
+    def publish(self, message: dict):
+        cell_data = message.get("cell_data")
+        if cell_data is not None and "seq" in message:
+            self.last_seq = message["seq"]
+        if not self.channels:
+            return
+        if cell_data is None:
+            self._push(self.channels.values(), message)
+            return
+        everyone = self.groups.get(EVERYTHING.key)
+        if everyone is not None:
+            self._push(everyone.channels, message)
+            if len(self.groups) == 1:
+                return
+        deltas: Dict[SubscriptionGroup, Dict] = {}
+        for symbol, cells in cell_data.items():
+            for group in self._route(symbol):
+                fields = group.subscription.fields
+                if fields is not None:
+                    cells_wanted = {field: cell for field, cell in cells.items() if field in fields}
+                    if not cells_wanted:
+                        continue
+                else:
+                    cells_wanted = cells
+                deltas.setdefault(group, {})[symbol] = cells_wanted
+        for group, delta in deltas.items():
+            filtered = dict(message, cell_data=delta)
+            if "seq" in message:
+                # Clients check this rather than seq - 1, since the updates in between weren't for them
+                filtered["prev_seq"] = group.last_seq
+                group.last_seq = message["seq"]
+            self._push(group.channels, filtered)
+
+    def send(self, websocket: WebSocket, message: dict) -> bool:
+        """Queue a message for one client behind anything already queued for it"""
+        channel = self.channels.get(websocket)
+        if channel is None:
+            return False
+        started = time.perf_counter()
+        payload = self.encoders[channel.encoding](message)
+        ENCODE_SECONDS.observe(time.perf_counter() - started, (channel.encoding,))
+        return channel.push(payload, message.get("type") in CELL_MESSAGES)
+
+    def stats(self) -> Dict:
+        return {
+            "clients": len(self.channels),
+            "groups": [
+                dict(group.subscription.to_dict(), clients=len(group.channels))
+                for group in self.groups.values()
+            ],
+            "routed_symbols": len(self.routes),
+        }
@@ -0,0 +1,209 @@
+import ast
+import math
+from types import CodeType
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# Fields a formula can produce or reference
+NUMERIC_FIELDS = ("bid_edge", "ask_edge", "bid_q", "ask_q")
+
+# Plain function calls a formula may make in addition to math.*
+ALLOWED_FUNCTIONS = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "round": round,
+}
+
+# Names bound as arguments of the compiled evaluator
+ARGUMENT_NAMES = ("time_diff", "symbol_seed")
+
+# Distinct formula sources kept compiled for the cells that share them
+MAX_COMPILED_SOURCES = 10000
+
+
+class FormulaError(ValueError):
+    """Raised when a formula can't be parsed, validated or bound"""
+
+
+class _Rewriter(ast.NodeTransformer):
+    """Turn field names and context[...] lookups into attribute reads on bound calculators"""
+
+    def __init__(self, slots: Dict[str, str]):
+        self.slots = slots
+
+    def visit_Name(self, node: ast.Name):
+        if node.id in NUMERIC_FIELDS:
+            return _attribute("_self", node.id, node)
+        return node
+
+    def visit_Subscript(self, node: ast.Subscript):
+        symbol, field = _context_reference(node)
+        return _attribute(self.slots[symbol], field, node)
+
+
+def _attribute(name: str, attr: str, node: ast.AST) -> ast.Attribute:
+    """name.attr in place of `node`, with its location, so the tree never needs fix_missing_locations"""
+    value = ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+    return ast.copy_location(ast.Attribute(value=value, attr=attr, ctx=ast.Load()), node)
+
+
+def _context_reference(node: ast.Subscript) -> Tuple[str, str]:
+    """Return (symbol, field) for a context['SYM']['field'] node or raise FormulaError"""
+    inner = node.value
+    if not (
+        isinstance(inner, ast.Subscript)
+        and isinstance(inner.value, ast.Name)
+        and inner.value.id == "context"
+        and isinstance(inner.slice, ast.Constant)
+        and isinstance(inner.slice.value, str)
+        and isinstance(node.slice, ast.Constant)
+        and isinstance(node.slice.value, str)
+    ):
+        raise FormulaError("Only context['SYMBOL']['field'] lookups are allowed")
+    field = node.slice.value
+    if field not in NUMERIC_FIELDS:
+        raise FormulaError(f"Unknown field in reference: {field}")
+    return inner.slice.value, field
+
+
+class _CompiledSource:
+    """What compiling a formula's source yields that doesn't depend on the cell it's for.
+
+    Fields read by name are collected in `fields` rather than as references,
+    since they're the reading cell's own; context[...] lookups name their
+    symbol, so `lookups` and the code are the same for every cell.
+    """
+
+    def __init__(self, source: str):
+        # SyntaxError is left to the caller, which knows the cell to name in the message
+        tree = ast.parse(source.strip(), mode="eval")
+
+        self.lookups: Set[Tuple[str, str]] = set()
+        self.fields: Set[str] = set()
+        self.reads_arguments = False
+        self._validate(tree)
+
+        # One slot per distinct looked-up symbol, in a stable order
+        self.slot_symbols: List[str] = sorted({ref_symbol for ref_symbol, _ in self.lookups})
+        slots = {ref_symbol: f"_ref{i}" for i, ref_symbol in enumerate(self.slot_symbols)}
+        body = _Rewriter(slots).visit(tree).body
+
+        lambda_node = ast.copy_location(ast.Lambda(
+            args=ast.arguments(
+                posonlyargs=[],
+                args=[ast.copy_location(ast.arg(arg=name), body) for name in ARGUMENT_NAMES],
+                kwonlyargs=[],
+                kw_defaults=[],
+                defaults=[],
+            ),
+            body=body,
+        ), body)
+        # Every node already has a location, which saves walking the tree again to fill them in
+        self.code = compile(ast.Expression(body=lambda_node), "<formula>", "eval")
+
+    def _validate(self, node: ast.AST):
+        if isinstance(node, ast.Expression):
+            self._validate(node.body)
+        elif isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise FormulaError(f"Unsupported constant in formula: {node.value!r}")
+        elif isinstance(node, ast.Name):
+            if node.id in NUMERIC_FIELDS:
+                self.fields.add(node.id)
+            elif node.id in ARGUMENT_NAMES:
+                self.reads_arguments = True
+            else:
+                raise FormulaError(f"Unknown name in formula: {node.id}")
+        elif isinstance(node, ast.Attribute):
+            _math_attribute(node)
+        elif isinstance(node, ast.Subscript):
+            self.lookups.add(_context_reference(node))
+        elif isinstance(node, ast.Call):
+            if node.keywords:
+                raise FormulaError("Keyword arguments are not allowed in formulas")
+            if isinstance(node.func, ast.Name) and node.func.id in ALLOWED_FUNCTIONS:
+                pass
+            elif isinstance(node.func, ast.Attribute) and callable(_math_attribute(node.func)):
+                pass
+            else:
+                raise FormulaError("Only math.* and abs/min/max/round calls are allowed")
+            for arg in node.args:
+                self._validate(arg)
+        elif isinstance(node, (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp)):
+            for child in ast.iter_child_nodes(node):
+                if not isinstance(child, (ast.operator, ast.unaryop, ast.boolop, ast.cmpop)):
+                    self._validate(child)
+        else:
+            raise FormulaError(f"Unsupported syntax in formula: {type(node).__name__}")
+
+
+_compiled_sources: Dict[str, _CompiledSource] = {}
+
+
+def _renamed(code: CodeType, filename: str) -> CodeType:
+    """`code` and the code nested in it as if compiled from `filename`"""
+    consts = tuple(_renamed(const, filename) if isinstance(const, CodeType) else const
+                   for const in code.co_consts)
+    return code.replace(co_filename=filename, co_consts=consts)
+
+
+class CompiledFormula:
+    """A validated formula compiled once into a code object.
+
+    Cross-symbol references are collected in `references` and turned into
+    attribute reads on the calculators passed to `bind`, so evaluating the
+    result is a plain function call with no parsing or namespace building.
+    Sources are compiled once and shared by every cell with that formula,
+    which is most of the cost of restoring many symbols.
+    """
+
+    def __init__(self, symbol: str, field: str, source: str):
+        self.symbol = symbol
+        self.field = field
+        self.source = source
+
+        compiled = _compiled_sources.get(source)
+        if compiled is None:
+            try:
+                compiled = _CompiledSource(source)
+            except SyntaxError as e:
+                raise FormulaError(f"Invalid formula for {symbol}.{field}: {e.msg}") from None
+            if len(_compiled_sources) >= MAX_COMPILED_SOURCES:
+                # Many distinct formulas; start over rather than track usage
+                _compiled_sources.clear()
+            _compiled_sources[source] = compiled
+
+        self.references: Set[Tuple[str, str]] = compiled.lookups | {(symbol, name) for name in compiled.fields}
+        # Formulas reading time or their own previous value change every tick
+        # even when none of their inputs do
+        self.volatile = compiled.reads_arguments or (symbol, field) in self.references
+        self.slot_symbols = compiled.slot_symbols
+        # Named after the cell so profiles tell its frames apart from other cells'
+        self.code = _renamed(compiled.code, f"<formula {symbol}.{field}>")
+
+    def bind(self, resolve: Callable[[str], Optional[object]], calculator: object) -> Callable[[float, int], float]:
+        """Resolve referenced symbols to calculators and return the evaluator"""
+        namespace = {"__builtins__": {}, "math": math, "_self": calculator}
+        namespace.update(ALLOWED_FUNCTIONS)
+        for i, ref_symbol in enumerate(self.slot_symbols):
+            target = calculator if ref_symbol == self.symbol else resolve(ref_symbol)
+            if target is None:
+                raise FormulaError(f"Formula for {self.symbol}.{self.field} references unknown symbol {ref_symbol}")
+            namespace[f"_ref{i}"] = target
+        return eval(self.code, namespace)
+
+
+def _math_attribute(node: ast.Attribute):
+    """Return the math module attribute for a math.name node or raise FormulaError"""
+    if not (isinstance(node.value, ast.Name) and node.value.id == "math"
+            and not node.attr.startswith("_") and hasattr(math, node.attr)):
+        raise FormulaError("Only math.* attributes are allowed")
+    return getattr(math, node.attr)
+
+
+def compile_formula(symbol: str, field: str, source: str) -> CompiledFormula:
+    if field not in NUMERIC_FIELDS:
+        raise FormulaError(f"Formulas are not supported for field: {field}")
+    if not isinstance(source, str) or not source.strip():
+        raise FormulaError(f"Empty formula for {symbol}.{field}")
+    return CompiledFormula(symbol, field, source)
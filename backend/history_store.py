@@ -0,0 +1,316 @@
+import bisect
+import csv
+import mmap
+import os
+import struct
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from formulas import NUMERIC_FIELDS
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+# Next to this file, whatever directory the server is started from
+HISTORY_DIR = Path(__file__).parent / "history"
+
+MAGIC = b"TGHS"
+VERSION = 1
+# magic, version, record count
+HEADER = struct.Struct("<4sIQ")
+# timestamp (microseconds since the epoch), value, override flag, padding
+RECORD = struct.Struct("<qdB7x")
+# One sparse index entry per this many records
+INDEX_STRIDE = 256
+INITIAL_RECORDS = 4096
+# Most bars one downsample request may produce; a wider bucket is needed past this
+MAX_BUCKETS = 10000
+
+Point = Tuple[int, float, bool]
+# bucket start (microseconds), open, high, low, close, count
+Bar = Tuple[int, float, float, float, float, int]
+
+
+def to_micros(timestamp: datetime) -> int:
+    return int(round(timestamp.timestamp() * 1_000_000))
+
+
+def from_micros(micros: int) -> datetime:
+    return datetime.fromtimestamp(micros / 1_000_000)
+
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([("timestamp", "<i8"), ("value", "<f8"), ("is_override", "u1"), ("padding", "V7")])
+
+
+def _downsample_points(points: List[Point], width: int) -> List[Bar]:
+    """Segment.downsample without numpy"""
+    bars: List[list] = []
+    for timestamp, value, _ in points:
+        bucket_start = timestamp - timestamp % width
+        if not bars or bars[-1][0] != bucket_start:
+            bars.append([bucket_start, value, value, value, value, 0])
+        bar = bars[-1]
+        bar[2] = max(bar[2], value)
+        bar[3] = min(bar[3], value)
+        bar[4] = value
+        bar[5] += 1
+    return [tuple(bar) for bar in bars]
+
+
+def _downsample_arrays(timestamps, values, width: int) -> List[Bar]:
+    """Segment.downsample over time-ordered numpy arrays: bucket edges, then one reduceat per aggregate"""
+    keys = timestamps - timestamps % width
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    ends = np.append(starts[1:], len(values))
+    return list(zip(
+        keys[starts].tolist(),
+        values[starts].tolist(),
+        np.maximum.reduceat(values, starts).tolist(),
+        np.minimum.reduceat(values, starts).tolist(),
+        values[ends - 1].tolist(),
+        (ends - starts).tolist(),
+    ))
+
+
+class Segment:
+    """Fixed-width, time-ordered records for one (symbol, field), memory-mapped.
+
+    Every INDEX_STRIDE-th timestamp is kept in memory, so a range lookup is
+    a bisect over the sparse index followed by a bisect within one block.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        is_new = not path.exists() or path.stat().st_size < HEADER.size
+        self.file = open(path, "a+b")
+        if is_new:
+            self.file.truncate(HEADER.size + RECORD.size * INITIAL_RECORDS)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        if is_new:
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, 0)
+        magic, version, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a history segment: {path}")
+        self.capacity = (len(self.mm) - HEADER.size) // RECORD.size
+        self.index: List[int] = [self.timestamp_at(i) for i in range(0, self.count, INDEX_STRIDE)]
+        self.last_timestamp = self.timestamp_at(self.count - 1) if self.count else None
+
+    def timestamp_at(self, i: int) -> int:
+        return struct.unpack_from("<q", self.mm, HEADER.size + i * RECORD.size)[0]
+
+    def _grow(self, needed: int):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        self.mm.close()
+        self.file.truncate(HEADER.size + RECORD.size * capacity)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.capacity = capacity
+
+    def append(self, points: Iterable[Point]) -> int:
+        """Append points in time order; points older than the last stored one are skipped"""
+        points = [point for point in points]
+        if self.count + len(points) > self.capacity:
+            self._grow(self.count + len(points))
+        appended = 0
+        for timestamp, value, is_override in points:
+            if self.last_timestamp is not None and timestamp < self.last_timestamp:
+                continue
+            if self.count % INDEX_STRIDE == 0:
+                self.index.append(timestamp)
+            RECORD.pack_into(self.mm, HEADER.size + self.count * RECORD.size, timestamp, value, is_override)
+            self.count += 1
+            self.last_timestamp = timestamp
+            appended += 1
+        # The count is written last so readers never see half-written records
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.count)
+        return appended
+
+    def _lower_bound(self, timestamp: int) -> int:
+        """Index of the first record at or after `timestamp`"""
+        block = max(0, bisect.bisect_left(self.index, timestamp) - 1)
+        lo = block * INDEX_STRIDE
+        hi = min(self.count, lo + 2 * INDEX_STRIDE)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp_at(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start: Optional[int] = None, end: Optional[int] = None,
+              limit: Optional[int] = None) -> List[Point]:
+        first, last = self.bounds(start, end)
+        if limit is not None:
+            last = min(last, first + limit)
+        if last <= first:
+            return []
+        data = self.mm[HEADER.size + first * RECORD.size:HEADER.size + last * RECORD.size]
+        return [(timestamp, value, bool(flag)) for timestamp, value, flag in RECORD.iter_unpack(data)]
+
+    def bounds(self, start: Optional[int] = None, end: Optional[int] = None) -> Tuple[int, int]:
+        """Indexes of the first record in [start, end] and one past the last"""
+        first = self._lower_bound(start) if start is not None else 0
+        last = self._lower_bound(end + 1) if end is not None else self.count
+        return first, last
+
+    def downsample(self, width: int, start: Optional[int] = None, end: Optional[int] = None) -> List[Bar]:
+        """OHLC bars of `width` microseconds, aggregated in place over the mapped records"""
+        first, last = self.bounds(start, end)
+        if last <= first:
+            return []
+        if (self.timestamp_at(last - 1) - self.timestamp_at(first)) // width >= MAX_BUCKETS:
+            raise ValueError(f"More than {MAX_BUCKETS} buckets; use a wider bucket or a shorter range")
+        if np is None:
+            return _downsample_points(self.range(start, end), width)
+        records = np.frombuffer(self.mm, dtype=RECORD_DTYPE, count=last - first,
+                                offset=HEADER.size + first * RECORD.size)
+        try:
+            bars = _downsample_arrays(records["timestamp"], records["value"], width)
+        finally:
+            # A view of the map left alive would stop it being closed or grown
+            del records
+        return bars
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+class HistoryStore:
+    """Per-symbol, per-field history segments under one directory"""
+
+    def __init__(self, root: Path = HISTORY_DIR):
+        self.root = Path(root)
+        self.segments: Dict[Tuple[str, str], Segment] = {}
+        self.lock = threading.Lock()
+
+    def _path(self, symbol: str, field: str) -> Path:
+        return self.root / symbol / f"{field}.seg"
+
+    def _segment(self, symbol: str, field: str, create: bool) -> Optional[Segment]:
+        # Symbols become directory names, so keep them inside the root
+        if field not in NUMERIC_FIELDS or not symbol or "/" in symbol or "\\" in symbol or symbol.startswith("."):
+            return None
+        key = (symbol, field)
+        segment = self.segments.get(key)
+        if segment is None:
+            path = self._path(symbol, field)
+            if not create and not path.exists():
+                return None
+            segment = self.segments[key] = Segment(path)
+        return segment
+
+    def append(self, symbol: str, field: str, points: Iterable[Point]) -> int:
+        with self.lock:
+            segment = self._segment(symbol, field, create=True)
+            return segment.append(points) if segment is not None else 0
+
+    def append_rows(self, rows: List[tuple]):
+        """Value logger sink: (id, timestamp, symbol, field, value, is_override, user_id) rows"""
+        grouped: Dict[Tuple[str, str], List[Point]] = {}
+        for _, timestamp, symbol, field, value, is_override, _ in rows:
+            if field in NUMERIC_FIELDS:
+                try:
+                    point = (to_micros(timestamp), float(value), bool(is_override))
+                except (TypeError, ValueError):
+                    continue
+                grouped.setdefault((symbol, field), []).append(point)
+        for (symbol, field), points in grouped.items():
+            points.sort(key=lambda point: point[0])
+            self.append(symbol, field, points)
+
+    def range(self, symbol: str, field: str, start: Optional[datetime] = None,
+              end: Optional[datetime] = None, limit: Optional[int] = None) -> List[Point]:
+        with self.lock:
+            segment = self._segment(symbol, field, create=False)
+            if segment is None:
+                return []
+            return segment.range(
+                to_micros(start) if start is not None else None,
+                to_micros(end) if end is not None else None,
+                limit
+            )
+
+    def downsample(self, symbol: str, field: str, bucket: float, mode: str = "ohlc",
+                   start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Dict]:
+        """Aggregate points into `bucket`-second buckets, as OHLC bars or the last value per bucket.
+
+        Blocks for as long as the range takes to aggregate, so call it from an executor.
+        """
+        if bucket <= 0:
+            raise ValueError("Bucket must be positive")
+        if mode not in ("ohlc", "last"):
+            raise ValueError(f"Unknown downsample mode: {mode}")
+        width = max(1, int(bucket * 1_000_000))
+        with self.lock:
+            segment = self._segment(symbol, field, create=False)
+            if segment is None:
+                return []
+            bars = segment.downsample(
+                width,
+                to_micros(start) if start is not None else None,
+                to_micros(end) if end is not None else None
+            )
+        if mode == "last":
+            return [{"timestamp": from_micros(bar_start).isoformat(), "value": close, "count": count}
+                    for bar_start, _, _, _, close, count in bars]
+        return [
+            {"open": open_, "high": high, "low": low, "close": close, "count": count,
+             "timestamp": from_micros(bar_start).isoformat()}
+            for bar_start, open_, high, low, close, count in bars
+        ]
+
+    def import_csv(self, path: Path) -> int:
+        """Import a value log CSV (see value_logger.FIELDNAMES); returns the number of points stored"""
+        grouped: Dict[Tuple[str, str], List[Point]] = {}
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("field") not in NUMERIC_FIELDS:
+                    continue
+                try:
+                    point = (
+                        to_micros(datetime.fromisoformat(row["timestamp"])),
+                        float(row["value"]),
+                        row.get("is_override") == "True"
+                    )
+                except (KeyError, TypeError, ValueError):
+                    continue
+                grouped.setdefault((row["symbol"], row["field"]), []).append(point)
+        imported = 0
+        for (symbol, field), points in grouped.items():
+            points.sort(key=lambda point: point[0])
+            imported += self.append(symbol, field, points)
+        return imported
+
+    def flush(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.flush()
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+
+
+if __name__ == "__main__":
+    # python history_store.py logs/trading_values_*.csv
+    # Segments are append-only, so files are imported oldest first (their names sort by time)
+    store = HistoryStore(Path(os.environ.get("TRADING_HISTORY_DIR", HISTORY_DIR)))
+    for csv_path in sorted(sys.argv[1:], key=lambda p: Path(p).name):
+        print(f"{csv_path}: {store.import_csv(Path(csv_path))} points")
+    store.close()
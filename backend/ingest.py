@@ -0,0 +1,298 @@
+import argparse
+import math
+import os
+import select
+import socket
+import stat
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from formulas import NUMERIC_FIELDS
+from trace_log import ERROR, trace
+
+# Updates are lines of "SYMBOL FIELD VALUE", split on spaces or commas
+FIELDS = {field.encode(): field for field in NUMERIC_FIELDS}
+# Datagrams read before a batch is decoded and handed over, and the most one datagram can hold
+BATCH_DATAGRAMS = 256
+MAX_DATAGRAM = 65536
+# Cells waiting for the next tick; past this a batch is dropped rather than grow without bound
+DEFAULT_MAX_PENDING = 100000
+# How often the reader checks for stop, and a file for more lines
+POLL_INTERVAL = 0.1
+# A fed cell the feed hasn't updated for this long goes back to the random walk
+DEFAULT_STALE_AFTER = 30.0
+
+# (symbol, field) as they came off the wire, decoded only for the updates that survive conflation
+RawCell = Tuple[bytes, bytes]
+
+
+def decode_batch(data: bytes, updates: Dict[RawCell, float]) -> Tuple[int, int]:
+    """Decode the lines in `data` into `updates`, later lines replacing earlier ones; returns (decoded, malformed)"""
+    decoded = malformed = 0
+    for line in data.replace(b",", b" ").split(b"\n"):
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) != 3 or parts[1] not in FIELDS:
+            malformed += 1
+            continue
+        try:
+            value = float(parts[2])
+        except ValueError:
+            malformed += 1
+            continue
+        # nan and inf parse, but would put NaN/Infinity in the JSON clients are sent
+        if not math.isfinite(value):
+            malformed += 1
+            continue
+        updates[(parts[0], parts[1])] = value
+        decoded += 1
+    return decoded, malformed
+
+
+def open_source(source: str):
+    """A bound datagram socket for udp://host:port or unix:///path, or None for a file or pipe path"""
+    url = urlparse(source)
+    if url.scheme == "udp":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Room for bursts while the reader is decoding
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind((url.hostname or "127.0.0.1", url.port or 0))
+        return sock
+    if url.scheme == "unix":
+        if os.path.exists(url.path) and stat.S_ISSOCK(os.stat(url.path).st_mode):
+            os.unlink(url.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(url.path)
+        return sock
+    if url.scheme not in ("", "file"):
+        raise ValueError(f"Unknown ingest source: {source}")
+    return None
+
+
+class Ingest:
+    """Takes market data from a local feed and holds the latest value per cell for the next tick.
+
+    A reader thread receives from a UDP or Unix datagram socket, or reads a
+    file or named pipe, and decodes what has arrived in batches. Each batch
+    is conflated into the pending values under one lock acquisition, so
+    only the newest value for a cell survives until the tick takes them
+    all with `take`. The event loop never decodes: its share of the work
+    is one pass over the distinct cells that changed since the last tick.
+    """
+
+    def __init__(self, source: str, max_pending: int = DEFAULT_MAX_PENDING,
+                 stale_after: float = DEFAULT_STALE_AFTER):
+        self.source = source
+        self.max_pending = max_pending
+        self.stale_after = stale_after
+        self.sock = open_source(source)
+        # The socket file for unix://, or the file or pipe to read
+        self.path = urlparse(source).path or source
+        self.pending: Dict[RawCell, float] = {}
+        # Updates decoded into `pending` since the last take, to count what conflation replaced
+        self.pending_updates = 0
+        self.lock = threading.Lock()
+        self.received = 0
+        self.bytes = 0
+        self.batches = 0
+        self.malformed = 0
+        self.conflated = 0
+        self.dropped = 0
+        self.applied = 0
+        self.expired = 0
+        self.rejected: Dict[str, int] = {}
+        self.rate = 0.0
+        self._rate_window = (time.monotonic(), 0)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self):
+        return self.sock.getsockname() if self.sock is not None and self.sock.fileno() >= 0 else self.path
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ingest", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.sock is not None:
+            if self.sock.family == socket.AF_UNIX and os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock.close()
+
+    def _run(self):
+        try:
+            if self.sock is not None:
+                self._read_socket()
+            else:
+                self._read_file()
+        except Exception as e:
+            if trace.enabled(ERROR):
+                trace.log(ERROR, None, None, "ingest reader stopped", source=self.source, error=str(e))
+
+    def _read_socket(self):
+        sock = self.sock
+        sock.settimeout(POLL_INTERVAL)
+        while not self._stop.is_set():
+            self._update_rate()
+            try:
+                datagrams = [sock.recv(MAX_DATAGRAM)]
+            except socket.timeout:
+                datagrams = []
+            else:
+                # Drain what else has arrived, up to a batch, without waiting for more
+                sock.setblocking(False)
+                try:
+                    while len(datagrams) < BATCH_DATAGRAMS:
+                        datagrams.append(sock.recv(MAX_DATAGRAM))
+                except BlockingIOError:
+                    pass
+                finally:
+                    sock.settimeout(POLL_INTERVAL)
+            if datagrams:
+                self._hand_over(b"\n".join(datagrams))
+
+    def _read_file(self):
+        # Opened without blocking so stop is never stuck waiting on a pipe's writer
+        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            is_pipe = stat.S_ISFIFO(os.fstat(fd).st_mode)
+            partial = b""
+            while not self._stop.is_set():
+                self._update_rate()
+                if is_pipe and not select.select([fd], [], [], POLL_INTERVAL)[0]:
+                    continue
+                try:
+                    chunk = os.read(fd, MAX_DATAGRAM)
+                except BlockingIOError:
+                    continue
+                if not chunk:
+                    # The writer closed the pipe, or the file has no more lines yet
+                    self._stop.wait(POLL_INTERVAL)
+                    if is_pipe:
+                        os.close(fd)
+                        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+                        partial = b""
+                    continue
+                # Hold back a trailing partial line until the rest of it arrives
+                data, newline, partial = (partial + chunk).rpartition(b"\n")
+                if newline:
+                    self._hand_over(data)
+        finally:
+            os.close(fd)
+
+    def _update_rate(self):
+        started, received = self._rate_window
+        now = time.monotonic()
+        if now - started >= 1.0:
+            self.rate = (self.received - received) / (now - started)
+            self._rate_window = (now, self.received)
+
+    def _hand_over(self, data: bytes):
+        """Decode one batch and conflate it into the pending values"""
+        updates: Dict[RawCell, float] = {}
+        decoded, malformed = decode_batch(data, updates)
+        self.bytes += len(data)
+        self.batches += 1
+        self.malformed += malformed
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                # Nothing is taking the values; keep what's held rather than grow
+                self.dropped += decoded
+                return
+            self.received += decoded
+            self.pending_updates += decoded
+            self.pending.update(updates)
+
+    def take(self) -> Dict[Tuple[str, str], float]:
+        """The latest value of every cell updated since the last take"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            updates, self.pending_updates = self.pending_updates, 0
+        self.conflated += updates - len(pending)
+        return {(symbol.decode(errors="replace"), FIELDS[field]): value
+                for (symbol, field), value in pending.items()}
+
+    def reject(self, reason: str):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            "source": self.source,
+            "address": str(self.address),
+            "running": self._thread is not None and self._thread.is_alive(),
+            "updates_per_second": self.rate,
+            "received": self.received,
+            "bytes": self.bytes,
+            "batches": self.batches,
+            "pending": pending,
+            "applied": self.applied,
+            "expired": self.expired,
+            "stale_after": self.stale_after,
+            "conflated": self.conflated,
+            "malformed": self.malformed,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
+
+
+if __name__ == "__main__":
+    # Synthetic feed for trying the adapter out:
+    # python ingest.py udp://127.0.0.1:9999 --rate 100000 --symbols TYM5 NQM5 ESM5
+    import random
+
+    parser = argparse.ArgumentParser(description="Send a synthetic price feed to an ingest source")
+    parser.add_argument("target", help="udp://host:port, unix:///path or a file/pipe path")
+    parser.add_argument("--symbols", nargs="+", default=["TYM5", "NQM5", "ESM5", "FVM5"])
+    parser.add_argument("--rate", type=float, default=100000, help="updates per second")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--per-datagram", type=int, default=100, help="updates per datagram or write")
+    args = parser.parse_args()
+
+    url = urlparse(args.target)
+    if url.scheme == "udp":
+        out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        out.connect((url.hostname, url.port))
+        send = out.send
+    elif url.scheme == "unix":
+        out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        out.connect(url.path)
+        send = out.send
+    else:
+        out = open(url.path or args.target, "ab", buffering=0)
+        send = out.write
+    prices = {symbol: 100.0 for symbol in args.symbols}
+    fields = list(NUMERIC_FIELDS)
+    started = time.monotonic()
+    sent = 0
+    while time.monotonic() - started < args.duration:
+        lines = []
+        for _ in range(args.per_datagram):
+            symbol = random.choice(args.symbols)
+            field = random.choice(fields)
+            prices[symbol] += random.uniform(-0.05, 0.05)
+            value = round(prices[symbol], 2) if "edge" in field else random.randint(1, 100)
+            lines.append(f"{symbol} {field} {value}")
+        try:
+            send(("\n".join(lines) + "\n").encode())
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+        sent += args.per_datagram
+        ahead = sent / args.rate - (time.monotonic() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+    elapsed = time.monotonic() - started
+    print(f"sent {sent} updates in {elapsed:.1f}s ({sent / elapsed:.0f}/s)")
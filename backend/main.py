@@ -1,55 +1,38 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, Header, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, List, Optional, Set
+from fastapi.responses import PlainTextResponse, Response
+from typing import Dict, List, Optional, Set, Tuple, Union
 from pydantic import BaseModel
 import json
 from datetime import datetime
 import random
 import asyncio
-import math
-# import csv
-# import os
-# from pathlib import Path
-# from sqlalchemy import create_engine, Column, String, Boolean, Integer, Float, ForeignKey
-# from sqlalchemy.ext.declarative import declarative_base
-# from sqlalchemy.orm import sessionmaker, relationship
-
-# Database setup
-# SQLALCHEMY_DATABASE_URL = "sqlite:///./trading.db"
-# engine = create_engine(SQLALCHEMY_DATABASE_URL)
-# SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-# Base = declarative_base()
-
-# class Symbol(Base):
-#     __tablename__ = "symbols"
-# 
-#     id = Column(Integer, primary_key=True, index=True)
-#     symbol = Column(String, unique=True, index=True)
-#     description = Column(String)
-#     is_active = Column(Boolean, default=True)
-#     created_at = Column(String, default=lambda: datetime.now().isoformat())
-#     
-#     # New fields for calculations
-#     bid_edge_formula = Column(String, nullable=True)
-#     ask_edge_formula = Column(String, nullable=True)
-#     bid_q_formula = Column(String, nullable=True)
-#     ask_q_formula = Column(String, nullable=True)
-#     
-#     # Relationships for dependencies
-#     dependencies = relationship("SymbolDependency", back_populates="symbol")
-# 
-# class SymbolDependency(Base):
-#     __tablename__ = "symbol_dependencies"
-#     
-#     id = Column(Integer, primary_key=True, index=True)
-#     symbol_id = Column(Integer, ForeignKey("symbols.id"))
-#     depends_on_id = Column(Integer, ForeignKey("symbols.id"))
-#     
-#     symbol = relationship("Symbol", back_populates="dependencies")
-#     depends_on = relationship("Symbol")
-# 
-# # Create tables
-# Base.metadata.create_all(bind=engine)
+import os
+import threading
+import time
+from formulas import NUMERIC_FIELDS, FormulaError, compile_formula
+from dependency_graph import DependencyGraph
+from fanout import DEFAULT_MAX_QUEUE, DEFAULT_OVERFLOW, EVERYTHING, OVERFLOW_POLICIES, Fanout, Subscription
+from state_store import EDGE_FIELDS, ColumnarStore, StoredField
+from trace_log import DEBUG, ERROR, TRACE, WARNING, trace
+from value_logger import LOGS_DIR, ValueLogger
+from history_store import HISTORY_DIR, HistoryStore, from_micros
+from replay import Replayer, load_frames
+from scheduler import (DEFAULT_FLUSH_MAX_DELAY, DEFAULT_FLUSH_WINDOW, DEFAULT_INTERVAL, DEFAULT_POLICY,
+                       FlushScheduler, TickScheduler)
+from overrides import DEFAULT_PRECEDENCE, Override, OverrideIndex
+from sharding import DEFAULT_CAPACITY, ShardPool
+from wire import DEFAULT_ENCODING, WIRE_FIELDS, SymbolTable, encode_binary, negotiate
+from persistence import DATABASE_URL, Persistence
+from metrics import metrics
+from snapshot_cache import SnapshotCache
+from ingest import DEFAULT_STALE_AFTER, Ingest
+from profiler import DEFAULT_INTERVAL as PROFILE_INTERVAL, MAX_SECONDS as MAX_PROFILE_SECONDS, SamplingProfiler
+
+TICK_SECONDS = metrics.histogram("trading_tick_seconds", "Time to advance, recompute and broadcast one tick")
+FORMULA_SECONDS = metrics.summary("trading_formula_seconds", "Time spent evaluating each formula cell",
+                                  ("symbol", "field"))
+CELL_DATA_SECONDS = metrics.histogram("trading_cell_data_seconds", "Time to build the full cell_data for a snapshot")
 
 class Symbol:
     def __init__(self, symbol: str, description: Optional[str] = None):
@@ -73,9 +56,19 @@ class Symbol:
             pass
 
 class SymbolCalculator:
+    # Plain attributes until attach() moves them into a ColumnarStore
+    bid_edge = StoredField()
+    ask_edge = StoredField()
+    bid_q = StoredField()
+    ask_q = StoredField()
+
     def __init__(self, symbol: str, description: Optional[str] = None):
         self.symbol = symbol
         self.description = description
+        self.seed = sum(ord(c) for c in symbol)
+        self.rng = random.Random()
+        self.store = None
+        self.slot = None
         self.bid_edge = -10
         self.ask_edge = -10
         self.bid_q = 0
@@ -98,7 +91,14 @@ class SymbolCalculator:
             "bid_q": None,
             "ask_q": None
         }
+        self.compiled = {field: None for field in self.formulas}
+        self.evaluators = {field: None for field in self.formulas}
     
+    def attach(self, store: ColumnarStore):
+        """Move the numeric fields into a slot of the columnar store"""
+        self.slot = store.add(self.symbol, {field: getattr(self, field) for field in NUMERIC_FIELDS})
+        self.store = store
+
     def add_dependency(self, other_symbol: 'SymbolCalculator'):
         self.dependencies.add(other_symbol)
         other_symbol.dependent_on.add(self)
@@ -107,56 +107,66 @@ class SymbolCalculator:
         self.dependencies.discard(other_symbol)
         other_symbol.dependent_on.discard(self)
     
-    def set_formula(self, field: str, formula: str):
-        if field in self.formulas:
-            self.formulas[field] = formula
+    def set_formula(self, field: str, formula: Optional[str], resolve=None):
+        """Validate and compile a formula once, binding it right away when `resolve` is given.
+
+        Raises FormulaError and leaves the current formula untouched if the
+        formula is invalid or references a symbol `resolve` can't find.
+        """
+        if field not in self.formulas:
+            raise FormulaError(f"Formulas are not supported for field: {field}")
+        compiled = compile_formula(self.symbol, field, formula) if formula else None
+        evaluator = compiled.bind(resolve, self) if compiled is not None and resolve is not None else None
+        self.formulas[field] = formula or None
+        self.compiled[field] = compiled
+        self.evaluators[field] = evaluator
+
+    def bind_formulas(self, resolve):
+        """Resolve cross-symbol references of every compiled formula to calculators"""
+        evaluators = {
+            field: compiled.bind(resolve, self) if compiled is not None else None
+            for field, compiled in self.compiled.items()
+        }
+        self.evaluators = evaluators
     
     def calculate_value(self, field: str, time_diff: float, symbol_seed: int) -> float:
         """Calculate a new value for a field based on its formula or default behavior"""
         try:
-            if field in self.formulas:
-                # Use the formula to calculate the value
-                formula = self.formulas[field]
-                # Create a namespace for evaluation with all required variables
-                namespace = {
-                    'math': math,
-                    'time_diff': time_diff,
-                    'symbol_seed': symbol_seed,
-                    'bid_edge': self.bid_edge,
-                    'ask_edge': self.ask_edge,
-                    'bid_q': self.bid_q,
-                    'ask_q': self.ask_q
-                }
-                print(f"\nCalculating {field} with formula: {formula}")
-                print(f"Current values: bid_edge={self.bid_edge}, ask_edge={self.ask_edge}, bid_q={self.bid_q}, ask_q={self.ask_q}")
-                value = eval(formula, namespace)
-                print(f"Calculated value: {value}")
+            evaluator = self.evaluators.get(field)
+            if evaluator is not None:
+                # Use the compiled formula to calculate the value
+                started = time.perf_counter()
+                value = evaluator(time_diff, symbol_seed)
+                FORMULA_SECONDS.observe(time.perf_counter() - started, (self.symbol, field))
+                if trace.enabled(DEBUG, self.symbol, field):
+                    trace.log(DEBUG, self.symbol, field, "formula", formula=self.formulas[field],
+                              bid_edge=self.bid_edge, ask_edge=self.ask_edge, bid_q=self.bid_q,
+                              ask_q=self.ask_q, value=value)
+            elif self.compiled.get(field) is not None:
+                raise FormulaError(f"Formula for {self.symbol}.{field} is not bound")
             else:
                 # Default behavior for fields without formulas
                 if field in ["bid_edge", "ask_edge"]:
                     # For edge fields, use a random walk with mean reversion
                     current_value = getattr(self, field)
                     # Random walk component
-                    random_walk = random.uniform(-0.1, 0.1)
+                    random_walk = self.rng.uniform(-0.1, 0.1)
                     # Mean reversion component (pull towards 100)
                     mean_reversion = (100 - current_value) * 0.01
                     # Combine components
                     value = current_value + random_walk + mean_reversion
-                    print(f"\nCalculating {field} with random walk:")
-                    print(f"Current value: {current_value}")
-                    print(f"Random walk: {random_walk}")
-                    print(f"Mean reversion: {mean_reversion}")
-                    print(f"Final value: {value}")
+                    if trace.enabled(TRACE, self.symbol, field):
+                        trace.log(TRACE, self.symbol, field, "random walk", current=current_value,
+                                  random_walk=random_walk, mean_reversion=mean_reversion, value=value)
                 else:
                     # For quantity fields, use a random walk with bounds
                     current_value = getattr(self, field)
                     # Random walk with bounds
-                    value = current_value + random.uniform(-1, 1)
+                    value = current_value + self.rng.uniform(-1, 1)
                     # Ensure value stays within bounds
                     value = max(1, min(100, value))
-                    print(f"\nCalculating {field} with random walk:")
-                    print(f"Current value: {current_value}")
-                    print(f"Final value: {value}")
+                    if trace.enabled(TRACE, self.symbol, field):
+                        trace.log(TRACE, self.symbol, field, "random walk", current=current_value, value=value)
             
             # Apply rounding based on field type
             if field in ["bid_edge", "ask_edge"]:
@@ -166,12 +176,13 @@ class SymbolCalculator:
             
             return value
         except Exception as e:
-            print(f"Error calculating {field}: {str(e)}")
+            if trace.enabled(WARNING, self.symbol, field):
+                trace.log(WARNING, self.symbol, field, "error calculating", error=str(e))
             # If there's an error, use a default calculation
             if field in ["bid_edge", "ask_edge"]:
-                return round(100 + random.uniform(-1, 1), 2)
+                return round(100 + self.rng.uniform(-1, 1), 2)
             else:
-                return round(random.uniform(1, 100))
+                return round(self.rng.uniform(1, 100))
 
     def get_cell_data(self) -> Dict:
         return {
@@ -186,43 +197,69 @@ class SymbolCalculator:
             for symbol, calc in self.symbols.items()
         }
 
-# Create logs directory if it doesn't exist
-# LOGS_DIR = Path("logs")
-# LOGS_DIR.mkdir(exist_ok=True)
-
-# class ValueLogger:
-#     def __init__(self):
-#         self.log_file = LOGS_DIR / f"trading_values_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-#         self.fieldnames = ['timestamp', 'symbol', 'field', 'value', 'is_override', 'user_id']
-#         self._initialize_log_file()
-    
-#     def _initialize_log_file(self):
-#         with open(self.log_file, 'w', newline='') as f:
-#             writer = csv.DictWriter(f, fieldnames=self.fieldnames)
-#             writer.writeheader()
-    
-#     def log_value(self, timestamp: datetime, symbol: str, field: str, value: float, is_override: bool, user_id: Optional[str] = None):
-#         with open(self.log_file, 'a', newline='') as f:
-#             writer = csv.DictWriter(f, fieldnames=self.fieldnames)
-#             writer.writerow({
-#                 'timestamp': timestamp.isoformat(),
-#                 'symbol': symbol,
-#                 'field': field,
-#                 'value': value,
-#                 'is_override': str(is_override),
-#                 'user_id': user_id
-#             })
-
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, columnar: bool = False, seed: Optional[int] = None,
+                 tick_interval: float = DEFAULT_INTERVAL, overrun: str = DEFAULT_POLICY,
+                 override_policy: str = DEFAULT_PRECEDENCE, flush_window: float = DEFAULT_FLUSH_WINDOW,
+                 flush_max_delay: float = DEFAULT_FLUSH_MAX_DELAY):
+        self.fanout = Fanout()
+        # Symbol IDs for the binary wire encoding, which cell updates are also broadcast in
+        self.symbol_table = SymbolTable()
+        self.fanout.encoders["binary"] = lambda message: encode_binary(message, self.symbol_table)
         self.symbols: Dict[str, Symbol] = {}
+        # When the last tick of any group ran, and of each group; a group's formulas see
+        # the time since that group last ticked as time_diff
         self.last_update = datetime.now()
+        self.group_updates: Dict[str, datetime] = {}
+        self.scheduler = TickScheduler(tick_interval, overrun)
+        # Every user's overrides; calculator.overrides is kept in step as the view clients see
+        self.overrides = OverrideIndex(override_policy)
         self.column_orders = {}
         self.symbol_orders = {}
         self.master_maker = 'OFF'  # Add master maker state
         self.master_taker = 'OFF'  # Add master taker state
-        # self.value_logger = ValueLogger()
+        self.value_logger = ValueLogger()
+        # Logged values are also appended to per-cell binary history segments
+        self.history = HistoryStore(os.environ.get("TRADING_HISTORY_DIR", HISTORY_DIR))
+        self.value_logger.sinks.append(self.history.append_rows)
+        self.graph = DependencyGraph()
+        # Formula cells that change every tick even when their inputs don't
+        self.volatile_cells: Set[Tuple[str, str]] = set()
+        # Symbols with formulas referencing symbols that don't exist yet
+        self.unbound_symbols: Set[str] = set()
+        # With a seed every symbol's random walk is reproducible
+        self.seed = seed
+        self.store = None
+        # Set by start_shards, after which ticks run in worker processes over a shared-memory store
+        self.shards: Optional[ShardPool] = None
+        self.shard_config_stale = True
+        if columnar:
+            try:
+                self.store = ColumnarStore(seed)
+            except RuntimeError as e:
+                if trace.enabled(WARNING):
+                    trace.log(WARNING, None, None, "columnar state store disabled", error=str(e))
+        # Cells changed since the last cell_update, and that message's sequence number
+        self.changed_cells: Set[Tuple[str, str]] = set()
+        self.seq = 0
+        # Order and master state changes waiting for the next flush; only the latest per user is sent
+        self.pending_orders: Dict[Tuple[str, str], List[str]] = {}
+        self.master_state_changed = False
+        # Edits are broadcast through this, so a storm of them goes out as one message per window
+        self.flusher = FlushScheduler(self.flush, flush_window, flush_max_delay)
+        # Serialized snapshots, reused until the next broadcast moves the sheet's version on
+        self.snapshots = SnapshotCache()
+        # Set in replay mode, where recorded frames drive the inputs instead of update_values
+        self.replayer: Optional[Replayer] = None
+        # Set by start_persistence, after which state changes are journaled to the database
+        self.persistence: Optional[Persistence] = None
+        self.restored: Dict = {}
+        # Set by start_ingest, after which an external feed drives the cells it sends
+        self.ingest: Optional[Ingest] = None
+        # Input cells the feed drives, with the latest value it sent and when (monotonic). They hold
+        # that value instead of walking, under any override too, until the feed goes quiet on them
+        self.fed_cells: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self.fed_checked = 0.0
         self.initialize_symbols()
 
     def initialize_symbols(self):
@@ -237,17 +274,124 @@ class ConnectionManager:
         # Add all symbols to the manager
         for symbol in symbol_classes.values():
             self.symbols[symbol.symbol] = symbol
+            self.register_calculator(symbol.calculator)
             # Clear all overrides for this symbol
             for field in symbol.calculator.overrides:
                 symbol.calculator.overrides[field] = {}
-            
-        # Set up dependencies between symbols
-        if "TYM5" in self.symbols and "NQM5" in self.symbols and "ESM5" in self.symbols:
-            self.symbols["TYM5"].calculator.add_dependency(self.symbols["NQM5"].calculator)
-            self.symbols["TYM5"].calculator.add_dependency(self.symbols["ESM5"].calculator)
+
+        # Bind formulas and set up dependencies between symbols from their references
+        self.bind_formulas()
+
+    def register_calculator(self, calculator: SymbolCalculator):
+        self.shard_config_stale = True
+        self.symbol_table.intern(calculator.symbol)
+        self.overrides.attach(calculator.symbol, calculator.overrides)
+        if self.seed is not None:
+            calculator.rng.seed(f"{self.seed}:{calculator.symbol}")
+        if self.store is not None:
+            calculator.attach(self.store)
+
+    def resolve_calculator(self, symbol: str) -> Optional[SymbolCalculator]:
+        if symbol in self.symbols:
+            return self.symbols[symbol].calculator
+        return None
+
+    def bind_formulas(self, symbols: Optional[List[Symbol]] = None):
+        """Bind compiled formulas (of every symbol by default) to the calculators they reference"""
+        for symbol in (symbols if symbols is not None else list(self.symbols.values())):
+            try:
+                symbol.calculator.bind_formulas(self.resolve_calculator)
+                self.link_dependencies(symbol.calculator)
+                self.unbound_symbols.discard(symbol.symbol)
+            except FormulaError as e:
+                self.unbound_symbols.add(symbol.symbol)
+                if trace.enabled(WARNING, symbol.symbol):
+                    trace.log(WARNING, symbol.symbol, None, "error binding formulas", error=str(e))
+
+    def link_dependencies(self, calculator: SymbolCalculator):
+        """Mirror a calculator's formula references into the dependency graph"""
+        self.shard_config_stale = True
+        referenced = set()
+        for field in NUMERIC_FIELDS:
+            compiled = calculator.compiled[field]
+            inputs = compiled.references if compiled is not None else ()
+            self.graph.set_inputs((calculator.symbol, field), inputs)
+            self.graph.mark_dirty((calculator.symbol, field))
+            if compiled is not None and compiled.volatile:
+                self.volatile_cells.add((calculator.symbol, field))
+            else:
+                self.volatile_cells.discard((calculator.symbol, field))
+            self.refresh_walk(calculator, field)
+            referenced.update(ref_symbol for ref_symbol, _ in inputs)
+        referenced.discard(calculator.symbol)
+
+        for other in list(calculator.dependencies):
+            if other.symbol not in referenced:
+                calculator.remove_dependency(other)
+        for ref_symbol in referenced:
+            other = self.resolve_calculator(ref_symbol)
+            if other is not None:
+                calculator.add_dependency(other)
+
+    def set_formula(self, symbol: str, field: str, formula: Optional[str]):
+        if symbol not in self.symbols:
+            raise HTTPException(status_code=404, detail="Symbol not found")
+        calculator = self.symbols[symbol].calculator
+        try:
+            # Check for cycles before touching the calculator so a rejected formula changes nothing
+            if formula and field in NUMERIC_FIELDS:
+                self.graph.check_inputs((symbol, field), compile_formula(symbol, field, formula).references)
+            calculator.set_formula(field, formula, self.resolve_calculator)
+        except FormulaError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        self.link_dependencies(calculator)
+        self.recalculate((datetime.now() - self.last_update).total_seconds())
+        self.persist_symbol(symbol)
+
+    def recalculate(self, time_diff: float, group_diffs: Optional[Dict[str, float]] = None):
+        """Recompute dirty formula cells and everything downstream of them in dependency order.
+
+        With `group_diffs`, a cell in one of those tick groups sees that group's time_diff.
+        """
+        group_of = self.scheduler.group_of
+        for symbol, field in self.graph.take_dirty():
+            calculator = self.resolve_calculator(symbol)
+            if calculator is None or calculator.compiled[field] is None or calculator.overrides[field]:
+                continue
+            cell_diff = group_diffs.get(group_of(symbol), time_diff) if group_diffs else time_diff
+            self.set_cell_value(calculator, field, calculator.calculate_value(field, cell_diff, calculator.seed))
+
+    def refresh_walk(self, calculator: SymbolCalculator, field: str):
+        """Keep the store's walking and overridden flags in step with the cell's formula and overrides"""
+        if self.store is not None and field in NUMERIC_FIELDS:
+            walking = (calculator.compiled[field] is None and not calculator.overrides[field]
+                       and (calculator.symbol, field) not in self.fed_cells)
+            self.store.set_walking(calculator.slot, field, walking)
+            self.store.set_overridden(calculator.slot, field, bool(calculator.overrides[field]))
+
+    def advance_store(self, slots=None):
+        """Advance walking cells (of the given slots, or all) in one vectorized step and mark the moved ones"""
+        symbols = self.store.symbols
+        graph = self.graph
+        for field, slots in self.store.step(slots).items():
+            for slot in slots.tolist():
+                cell = (symbols[slot], field)
+                self.changed_cells.add(cell)
+                if graph.has_dependents(cell):
+                    graph.mark_dirty(cell)
+
+    def set_cell_value(self, calculator: SymbolCalculator, field: str, value):
+        if getattr(calculator, field) != value:
+            setattr(calculator, field, value)
+            self.changed_cells.add((calculator.symbol, field))
+
+    def mark_symbol_changed(self, symbol: str):
+        for field in self.symbols[symbol].calculator.overrides:
+            self.changed_cells.add((symbol, field))
 
     def get_cell_data(self) -> Dict:
-        return {
+        started = time.perf_counter()
+        cell_data = {
             symbol: {
                 "bid_edge": {"value": calc.calculator.bid_edge, "overrides": calc.calculator.overrides["bid_edge"]},
                 "ask_edge": {"value": calc.calculator.ask_edge, "overrides": calc.calculator.overrides["ask_edge"]},
@@ -258,83 +402,367 @@ class ConnectionManager:
             }
             for symbol, calc in self.symbols.items()
         }
+        CELL_DATA_SECONDS.observe(time.perf_counter() - started)
+        return cell_data
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        await websocket.send_json({
-            "type": "initial_data",
+    def take_cell_delta(self) -> Dict:
+        """Return only the cells changed since the last call, in get_cell_data's shape"""
+        delta = {}
+        current_time = datetime.now()
+        for symbol, field in self.changed_cells:
+            if symbol in self.symbols:
+                calculator = self.symbols[symbol].calculator
+                value = getattr(calculator, field)
+                overrides = calculator.overrides[field]
+                delta.setdefault(symbol, {})[field] = {
+                    "value": value,
+                    "overrides": overrides
+                }
+                # Log calculated values; overrides are logged when they're set
+                if not overrides and field in NUMERIC_FIELDS:
+                    self.value_logger.log_value(current_time, symbol, field, value, False)
+        self.changed_cells = set()
+        return delta
+
+    def flush(self):
+        """Broadcast everything changed since the last flush: orders, master state, then one cell_update"""
+        self.flusher.cancel()
+        if self.pending_orders or self.master_state_changed or self.changed_cells:
+            self.snapshots.bump()
+        pending_orders, self.pending_orders = self.pending_orders, {}
+        for (kind, user_id), order in pending_orders.items():
+            self.fanout.publish({
+                "type": f"{kind}_order_update",
+                "user_id": user_id,
+                "order": order
+            })
+        if self.master_state_changed:
+            self.master_state_changed = False
+            self.fanout.publish({
+                "type": "master_state_update",
+                "master_maker": self.master_maker,
+                "master_taker": self.master_taker
+            })
+        delta = self.take_cell_delta()
+        if not delta:
+            return
+        # Numbered so clients can spot gaps
+        self.seq += 1
+        self.fanout.publish({
+            "type": "cell_update",
+            "seq": self.seq,
+            "cell_data": delta
+        })
+
+    def request_flush(self):
+        """Broadcast what changed once the current burst of edits settles (see FlushScheduler)"""
+        self.flusher.request()
+
+    async def broadcast_changes(self):
+        """Broadcast what changed right away, along with anything waiting on the flush window"""
+        self.flush()
+
+    def get_snapshot(self, message_type: str = "snapshot", subscription: Subscription = EVERYTHING) -> Dict:
+        return {
+            "type": message_type,
+            "seq": self.seq,
+            "cell_data": subscription.filter(self.get_cell_data())
+        }
+
+    def serialized_snapshot(self, subscription: Subscription = EVERYTHING) -> str:
+        return self.snapshots.get(
+            ("snapshot", subscription.key),
+            lambda: json.dumps(self.get_snapshot(subscription=subscription))
+        )
+
+    def serialized_initial_data(self, encoding: str, subscription: Subscription = EVERYTHING) -> str:
+        return self.snapshots.get(
+            ("initial_data", encoding, subscription.key),
+            lambda: json.dumps(self.get_initial_data(encoding, subscription))
+        )
+
+    def serialized_cells(self) -> str:
+        """The body of GET /cells"""
+        return self.snapshots.get("cells", lambda: json.dumps({
+            "seq": self.seq,
             "cell_data": self.get_cell_data(),
             "column_orders": self.column_orders,
             "symbol_orders": self.symbol_orders
-        })
+        }))
+
+    def get_initial_data(self, encoding: str, subscription: Subscription = EVERYTHING) -> Dict:
+        initial_data = {
+            "type": "initial_data",
+            "seq": self.seq,
+            "cell_data": subscription.filter(self.get_cell_data()),
+            "column_orders": self.column_orders,
+            "symbol_orders": self.symbol_orders
+        }
+        if not subscription.everything:
+            initial_data["subscription"] = subscription.to_dict()
+        if encoding != DEFAULT_ENCODING:
+            # IDs used in binary frames; later symbols come with symbol_added
+            initial_data["encoding"] = encoding
+            initial_data["symbols"] = self.symbol_table.names
+            initial_data["fields"] = WIRE_FIELDS
+        return initial_data
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.fanout.channels)
+
+    async def connect(self, websocket: WebSocket, max_queue: int = DEFAULT_MAX_QUEUE,
+                      overflow: str = DEFAULT_OVERFLOW, subscription: Subscription = EVERYTHING):
+        # The encoding is picked from the subprotocols the client offers; JSON if none match
+        subprotocol, encoding = negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        if overflow not in OVERFLOW_POLICIES:
+            overflow = DEFAULT_OVERFLOW
+        # Register and queue the initial data in one step so no broadcast falls in between
+        channel = self.fanout.add(
+            websocket, max_queue, overflow,
+            resync=lambda: self.serialized_snapshot(self.fanout.subscription_of(websocket)),
+            encoding=encoding,
+            subscription=subscription
+        )
+        # Shared with every other client connecting at this version
+        channel.push(self.serialized_initial_data(encoding, subscription))
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.fanout.remove(websocket)
+
+    def subscribe(self, websocket: WebSocket, symbols: Optional[List[str]] = None,
+                  fields: Optional[List[str]] = None, replace: bool = False):
+        """Add symbols (names or patterns) and fields to a client's subscription, or replace it"""
+        if replace:
+            subscription = Subscription(symbols, fields)
+        else:
+            subscription = self.fanout.subscription_of(websocket).add(symbols, fields)
+        self.resubscribe(websocket, subscription)
+
+    def check_subscription(self, symbols, fields) -> Optional[str]:
+        """Why symbols and fields sent to subscribe or unsubscribe can't be used, or None if they can"""
+        for name, entries in (("symbols", symbols), ("fields", fields)):
+            if entries is not None and not (isinstance(entries, list)
+                                            and all(isinstance(entry, str) for entry in entries)):
+                return f"{name} must be a list of strings, or null for all"
+        return None
+
+    def unsubscribe(self, websocket: WebSocket, symbols: Optional[List[str]] = None,
+                    fields: Optional[List[str]] = None):
+        subscription = self.fanout.subscription_of(websocket).remove(
+            symbols, fields, all_symbols=self.symbols, all_fields=WIRE_FIELDS
+        )
+        self.resubscribe(websocket, subscription)
+
+    def resubscribe(self, websocket: WebSocket, subscription: Subscription):
+        # The snapshot fills in cells the client wasn't being sent until now
+        if self.fanout.subscribe(websocket, subscription):
+            snapshot = self.get_snapshot(subscription=subscription)
+            snapshot["subscription"] = subscription.to_dict()
+            self.send_to(websocket, snapshot)
+
+    def send_to(self, websocket: WebSocket, message: dict):
+        """Queue a message for one client, in order with its broadcasts"""
+        self.fanout.send(websocket, message)
+
+    def send_snapshot(self, websocket: WebSocket):
+        channel = self.fanout.channels.get(websocket)
+        if channel is not None:
+            channel.push(self.serialized_snapshot(channel.subscription), cells_only=True)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+        # Queued per client and sent by each client's own task, so this never waits on a socket
+        self.fanout.publish(message)
+
+    async def tick(self, symbols: Optional[List[Symbol]] = None, groups: Optional[List[str]] = None):
+        """Advance the inputs of `symbols` (default all) one step, recompute formulas and broadcast what changed.
+
+        `groups` names the tick groups being ticked (default all), each of
+        which sees the time since it last ticked rather than since any did.
+        """
+        started = time.perf_counter()
+        current_time = datetime.now()
+        group_diffs = {
+            name: (current_time - self.group_updates.get(name, self.last_update)).total_seconds()
+            for name in (self.scheduler.groups if groups is None else groups)
+        }
+        self.group_updates.update((name, current_time) for name in group_diffs)
+        # Shard workers take one time_diff per tick, so they get the longest
+        time_diff = max(group_diffs.values(), default=(current_time - self.last_update).total_seconds())
+        self.last_update = current_time
+        ticking = None if symbols is None else {symbol.symbol for symbol in symbols}
+        if self.ingest is not None:
+            self.apply_ingested()
+        
+        # Advance inputs, then recompute the formula cells that depend on them
+        if self.shards is not None:
+            await self.tick_shards(time_diff, symbols)
+        elif self.store is not None:
+            slots = None if symbols is None else [symbol.calculator.slot for symbol in symbols]
+            self.advance_store(slots)
+        else:
+            group_of = self.scheduler.group_of
+            for symbol in self.symbols.values() if symbols is None else symbols:
+                calculator = symbol.calculator
+                symbol_diff = group_diffs.get(group_of(symbol.symbol), time_diff)
+                for field in NUMERIC_FIELDS:
+                    # Overridden inputs hold the override value until it's removed, and fed ones the feed's
+                    if (calculator.compiled[field] is None and not calculator.overrides[field]
+                            and (symbol.symbol, field) not in self.fed_cells):
+                        self.set_cell_value(calculator, field, calculator.calculate_value(field, symbol_diff, calculator.seed))
+                        cell = (symbol.symbol, field)
+                        # Walked inputs aren't recomputed themselves, so only what reads them is dirty
+                        if self.graph.has_dependents(cell):
+                            self.graph.mark_dirty(cell)
+        if self.shards is None:
+            for cell in self.volatile_cells:
+                if ticking is None or cell[0] in ticking:
+                    self.graph.mark_dirty(cell)
+            self.recalculate(time_diff, group_diffs)
+        
+        # Trace bid edges at the end of the tick
+        if trace.enabled(DEBUG):
+            for symbol in self.symbols.values():
+                if trace.enabled(DEBUG, symbol.symbol, "bid_edge"):
+                    trace.log(DEBUG, symbol.symbol, "bid_edge", "tick", value=symbol.calculator.bid_edge)
+        
+        await self.broadcast_changes()
+        TICK_SECONDS.observe(time.perf_counter() - started)
+
+    def apply_ingested(self):
+        """Set each fed cell to the latest value the feed sent for it since the last tick"""
+        ingest = self.ingest
+        now = time.monotonic()
+        for cell, value in ingest.take().items():
+            symbol, field = cell
+            if symbol not in self.symbols:
+                ingest.reject("unknown_symbol")
+                continue
+            calculator = self.symbols[symbol].calculator
+            if calculator.compiled[field] is not None:
+                ingest.reject("formula")
+                continue
+            # Rounded as the random walk rounds
+            value = round(value, 2) if field in EDGE_FIELDS else round(value)
+            newly_fed = cell not in self.fed_cells
+            self.fed_cells[cell] = (value, now)
+            if newly_fed:
+                self.refresh_walk(calculator, field)
+            if calculator.overrides[field]:
+                # Kept in fed_cells, and shown once the override is removed
+                ingest.reject("overridden")
+                continue
+            self.set_cell_value(calculator, field, value)
+            if self.graph.has_dependents(cell):
+                self.graph.mark_dirty(cell)
+            ingest.applied += 1
+        if now - self.fed_checked >= 1.0:
+            self.fed_checked = now
+            self.expire_fed_cells(now)
+
+    def expire_fed_cells(self, now: float):
+        """Put cells the feed hasn't updated for its stale_after back on the random walk"""
+        stale_before = now - self.ingest.stale_after
+        stale = [cell for cell, (_, updated) in self.fed_cells.items() if updated < stale_before]
+        for cell in stale:
+            del self.fed_cells[cell]
+            symbol, field = cell
+            if symbol in self.symbols:
+                self.refresh_walk(self.symbols[symbol].calculator, field)
+        self.ingest.expired += len(stale)
+
+    def start_ingest(self, source: str):
+        """Take input cell values from a feed at `source` (udp://host:port, unix:///path or a file/pipe)"""
+        try:
+            ingest = Ingest(source, stale_after=float(os.environ.get("TRADING_INGEST_STALE", DEFAULT_STALE_AFTER)))
+        except (OSError, ValueError) as e:
+            if trace.enabled(ERROR):
+                trace.log(ERROR, None, None, "ingest disabled", source=source, error=str(e))
+            return
+        ingest.start()
+        self.ingest = ingest
+
+    def start_shards(self, shards: int, capacity: int = DEFAULT_CAPACITY):
+        """Start shard workers and move every symbol's values into their shared store"""
+        try:
+            pool = ShardPool(shards, self.seed, capacity)
+        except RuntimeError as e:
+            if trace.enabled(WARNING):
+                trace.log(WARNING, None, None, "sharding disabled", error=str(e))
+            return
+        self.store = pool.store
+        for symbol in self.symbols.values():
+            calculator = symbol.calculator
+            calculator.attach(pool.store)
+            for field in NUMERIC_FIELDS:
+                self.refresh_walk(calculator, field)
+        self.shards = pool
+        self.shard_config_stale = True
+
+    async def tick_shards(self, time_diff: float, symbols: Optional[List[Symbol]] = None):
+        """Run one tick in the shard workers, then pick up what they changed in the shared store"""
+        if self.shards.closed:
+            # Shutting down; the shared store is already gone
+            return
+        loop = asyncio.get_running_loop()
+        slots = None if symbols is None else [symbol.calculator.slot for symbol in symbols]
+        # Waiting on the workers happens off the event loop, which keeps serving clients meanwhile
+        try:
+            if self.shard_config_stale:
+                levels = self.graph.levels()
+                symbol_slots = [(name, symbol.calculator.slot, symbol.calculator.seed)
+                                for name, symbol in self.symbols.items()]
+                formulas = [
+                    (name, field, symbol.calculator.formulas[field], levels.get((name, field), 0))
+                    for name, symbol in self.symbols.items()
+                    for field in NUMERIC_FIELDS
+                    if symbol.calculator.evaluators.get(field) is not None
+                ]
+                await loop.run_in_executor(None, self.shards.configure, symbol_slots, formulas)
+                # Left set if configuring fails, so the next tick tries again
+                self.shard_config_stale = False
+            await loop.run_in_executor(None, self.shards.tick, time_diff, slots)
+        except (RuntimeError, OSError, EOFError) as e:
+            if self.shards.closed:
+                return
+            if trace.enabled(ERROR):
+                trace.log(ERROR, None, None, "shard tick failed", error=str(e))
+        if self.shards.closed:
+            return
+        names = self.store.symbols
+        for field, slots in self.shards.diff().items():
+            for slot in slots.tolist():
+                self.changed_cells.add((names[slot], field))
 
     async def update_values(self):
+        """Tick each scheduler group on its own fixed-rate deadlines"""
+        loop = asyncio.get_running_loop()
         while True:
-            current_time = datetime.now()
-            time_diff = (current_time - self.last_update).total_seconds()
-            
-            # Update all symbols
-            for symbol in self.symbols.values():
-                symbol_seed = sum(ord(c) for c in symbol.symbol)
-                
-                # Calculate new values
-                symbol.calculator.bid_edge = symbol.calculator.calculate_value("bid_edge", time_diff, symbol_seed)
-                symbol.calculator.ask_edge = symbol.calculator.calculate_value("ask_edge", time_diff, symbol_seed)
-                symbol.calculator.bid_q = symbol.calculator.calculate_value("bid_q", time_diff, symbol_seed)
-                symbol.calculator.ask_q = symbol.calculator.calculate_value("ask_q", time_diff, symbol_seed)
-                
-                # # Log calculated values
-                # self.value_logger.log_value(current_time, symbol.symbol, "bid_edge", symbol.calculator.bid_edge, False)
-                # self.value_logger.log_value(current_time, symbol.symbol, "ask_edge", symbol.calculator.ask_edge, False)
-                # self.value_logger.log_value(current_time, symbol.symbol, "bid_q", symbol.calculator.bid_q, False)
-                # self.value_logger.log_value(current_time, symbol.symbol, "ask_q", symbol.calculator.ask_q, False)
-                
-                # # Log any overrides
-                # for field in ["bid_edge", "ask_edge", "bid_q", "ask_q"]:
-                #     for user_id, override in symbol.calculator.overrides[field].items():
-                #         self.value_logger.log_value(
-                #             current_time,
-                #             symbol.symbol,
-                #             field,
-                #             override["value"],
-                #             True,
-                #             user_id
-                #         )
-            
-            # Print debug info for bid edges
-            print("\nCurrent bid edges:")
-            for symbol in self.symbols.values():
-                print(f"{symbol.symbol}: {symbol.calculator.bid_edge}")
-            
-            await self.broadcast({
-                "type": "cell_update",
-                "cell_data": self.get_cell_data()
-            })
-            await asyncio.sleep(1)
+            due = {group.name for group in self.scheduler.due(loop.time())}
+            if due:
+                if len(due) == len(self.scheduler.groups):
+                    await self.tick()
+                else:
+                    group_of = self.scheduler.group_of
+                    await self.tick([symbol for name, symbol in self.symbols.items() if group_of(name) in due],
+                                    list(due))
+            # Sleep until the next deadline, not for a fixed period, so tick time doesn't add drift
+            await asyncio.sleep(max(0.0, self.scheduler.next_deadline() - loop.time()))
 
     def update_column_order(self, user_id: str, order: List[str]):
         self.column_orders[user_id] = order
-        asyncio.create_task(self.broadcast({
-            "type": "column_order_update",
-            "user_id": user_id,
-            "order": order
-        }))
+        if self.persistence is not None:
+            self.persistence.put_order("column", user_id, order)
+        self.pending_orders[("column", user_id)] = order
+        self.request_flush()
 
     def update_symbol_order(self, user_id: str, order: List[str]):
         self.symbol_orders[user_id] = order
-        asyncio.create_task(self.broadcast({
-            "type": "symbol_order_update",
-            "user_id": user_id,
-            "order": order
-        }))
+        if self.persistence is not None:
+            self.persistence.put_order("symbol", user_id, order)
+        self.pending_orders[("symbol", user_id)] = order
+        self.request_flush()
 
     def add_symbol(self, symbol: str, description: Optional[str] = None):
         if symbol in self.symbols:
@@ -343,75 +771,329 @@ class ConnectionManager:
         # Create new symbol instance
         new_symbol = Symbol(symbol, description)
         self.symbols[symbol] = new_symbol
+        self.register_calculator(new_symbol.calculator)
+        self.mark_symbol_changed(symbol)
+        # A new symbol may satisfy references that couldn't be bound before
+        rebound = [new_symbol] + [self.symbols[s] for s in self.unbound_symbols]
+        self.bind_formulas(rebound)
+        self.recalculate((datetime.now() - self.last_update).total_seconds())
+        for other in rebound:
+            self.persist_symbol(other.symbol)
 
-        asyncio.create_task(self.broadcast({
+        # Snapshots from before now don't have its ID or cells
+        self.snapshots.bump()
+        # Sent now, ahead of the flush carrying its cells, so binary clients know its ID first
+        self.fanout.publish({
             "type": "symbol_added",
             "symbol": symbol,
+            "symbol_id": self.symbol_table.ids[symbol],
             "description": description
-        }))
+        })
+        self.request_flush()
 
-    def update_cell(self, symbol: str, cell_id: str, value: Optional[float], user_id: str):
+    def update_cell(self, symbol: str, cell_id: str, value: Optional[float], user_id: str,
+                    ttl: Optional[float] = None):
+        """Set or remove a user's override; raises ValueError for a ttl that isn't a positive number"""
+        error = self.check_ttl(ttl, value)
+        if error is not None:
+            raise ValueError(error)
         if symbol in self.symbols:
             calculator = self.symbols[symbol].calculator
             if cell_id in calculator.overrides:
                 current_time = datetime.now()
+                cell = (symbol, cell_id)
                 # If value is None or empty string, remove the override completely
                 if value is None or value == "":
-                    if user_id in calculator.overrides[cell_id]:
-                        del calculator.overrides[cell_id][user_id]
-                        # If no more overrides, reset to calculated value
-                        if not calculator.overrides[cell_id]:
-                            time_diff = (current_time - self.last_update).total_seconds()
-                            symbol_seed = sum(ord(c) for c in symbol)
-                            new_value = calculator.calculate_value(cell_id, time_diff, symbol_seed)
-                            setattr(calculator, cell_id, new_value)
-                            calculator.overrides[cell_id] = {}
+                    self.overrides.remove(cell, user_id)
                 else:
                     # Handle toggles as strings
                     if cell_id in ["maker", "taker"]:
                         if value in ["ON", "OFF"]:
-                            calculator.overrides[cell_id][user_id] = {
-                                "value": value,
-                                "timestamp": current_time.isoformat()
-                            }
-                            setattr(calculator, cell_id, value)
+                            self.overrides.set(cell, user_id, value, ttl)
+                            self.value_logger.log_value(current_time, symbol, cell_id, value, True, user_id)
                         else:
                             # Remove override if value is not valid
-                            if user_id in calculator.overrides[cell_id]:
-                                del calculator.overrides[cell_id][user_id]
-                                if not calculator.overrides[cell_id]:
-                                    calculator.overrides[cell_id] = {}
+                            self.overrides.remove(cell, user_id)
                     else:
                         try:
                             float_value = float(value)
-                            calculator.overrides[cell_id][user_id] = {
-                                "value": float_value,
-                                "timestamp": current_time.isoformat()
-                            }
-                            setattr(calculator, cell_id, float_value)
+                            self.overrides.set(cell, user_id, float_value, ttl)
+                            self.value_logger.log_value(current_time, symbol, cell_id, float_value, True, user_id)
                         except (ValueError, TypeError):
-                            if user_id in calculator.overrides[cell_id]:
-                                del calculator.overrides[cell_id][user_id]
-                                if not calculator.overrides[cell_id]:
-                                    calculator.overrides[cell_id] = {}
+                            self.overrides.remove(cell, user_id)
+                self.apply_overrides([cell])
                 return True
         return False
 
-    async def broadcast_master_state(self):
-        await self.broadcast({
-            "type": "master_state_update",
-            "master_maker": self.master_maker,
-            "master_taker": self.master_taker
-        })
+    def check_cell_update(self, symbol: str, cell_id: str, value) -> Optional[str]:
+        """Why an update can't be applied as given, or None if it can"""
+        if symbol not in self.symbols:
+            return "Symbol not found"
+        if cell_id not in self.symbols[symbol].calculator.overrides:
+            return "Cell not found"
+        if value is None or value == "":
+            return None
+        if cell_id in ["maker", "taker"]:
+            return None if value in ["ON", "OFF"] else "Value must be ON or OFF"
+        try:
+            float(value)
+        except (ValueError, TypeError):
+            return "Value must be a number"
+        return None
+
+    def check_ttl(self, ttl, value) -> Optional[str]:
+        """Why `ttl` can't go with an update to `value`, or None if it can; a removal ignores it"""
+        if ttl is None:
+            return None
+        if isinstance(ttl, bool) or not isinstance(ttl, (int, float)):
+            return "ttl must be a number of seconds"
+        if ttl <= 0 and not (value is None or value == ""):
+            return "ttl must be a positive number of seconds"
+        return None
+
+    def check_batch_item(self, update) -> Optional[str]:
+        """check_cell_update for one batch item, which over the websocket arrives unvalidated"""
+        if not isinstance(update, dict):
+            return "Update must be an object"
+        if not isinstance(update.get("symbol"), str) or not isinstance(update.get("cell_id"), str):
+            return "Update needs a symbol and a cell_id"
+        error = self.check_ttl(update.get("ttl"), update.get("value"))
+        if error is not None:
+            return error
+        return self.check_cell_update(update["symbol"], update["cell_id"], update.get("value"))
+
+    def update_cells(self, updates: List[Dict], user_id: str) -> Tuple[bool, List[Dict]]:
+        """Apply a batch of {symbol, cell_id, value, ttl} updates all or nothing, recomputing once"""
+        errors = [self.check_batch_item(update) for update in updates]
+        applied = not any(errors)
+        results = [
+            {
+                "symbol": update.get("symbol") if isinstance(update, dict) else None,
+                "cell_id": update.get("cell_id") if isinstance(update, dict) else None,
+                "status": "success" if applied else ("error" if error else "skipped"),
+                **({"message": error} if error else {})
+            }
+            for update, error in zip(updates, errors)
+        ]
+        if not applied:
+            return False, results
+        current_time = datetime.now()
+        cells = {}
+        for update in updates:
+            symbol, cell_id, value = update["symbol"], update["cell_id"], update.get("value")
+            cell = (symbol, cell_id)
+            if value is None or value == "":
+                self.overrides.remove(cell, user_id)
+            else:
+                if cell_id not in ["maker", "taker"]:
+                    value = float(value)
+                self.overrides.set(cell, user_id, value, update.get("ttl"))
+                self.value_logger.log_value(current_time, symbol, cell_id, value, True, user_id)
+            cells[cell] = True
+        self.apply_overrides(cells)
+        return True, results
+
+    def apply_overrides(self, cells):
+        """Show each cell's winning override, or go back to its calculated value once it has none"""
+        numeric = False
+        time_diff = (datetime.now() - self.last_update).total_seconds()
+        for cell in cells:
+            symbol, field = cell
+            if symbol not in self.symbols:
+                continue
+            calculator = self.symbols[symbol].calculator
+            override = self.overrides.get(cell)
+            if override is not None:
+                self.set_cell_value(calculator, field, override.value)
+            elif cell in self.fed_cells and calculator.compiled.get(field) is None:
+                # Back to what the feed last sent, rather than walking from the override
+                self.set_cell_value(calculator, field, self.fed_cells[cell][0])
+            elif field in NUMERIC_FIELDS and calculator.compiled.get(field) is None:
+                # Formula cells are recomputed with their dependents below
+                self.set_cell_value(calculator, field, calculator.calculate_value(field, time_diff, calculator.seed))
+            self.changed_cells.add(cell)
+            if field in NUMERIC_FIELDS:
+                self.refresh_walk(calculator, field)
+                self.graph.mark_dirty(cell)
+                numeric = True
+        # Propagate the change to dependent cells within this update
+        if numeric:
+            self.recalculate(time_diff)
+
+    def clear_overrides(self, user_id: Optional[str] = None, field: Optional[str] = None) -> int:
+        """Remove overrides by a user and/or on a field across the sheet; returns the number of cells cleared"""
+        cells = self.overrides.clear(user_id, field)
+        self.apply_overrides(cells)
+        return len(cells)
+
+    def set_override_policy(self, policy: str, priorities: Optional[Dict[str, int]] = None):
+        self.apply_overrides(self.overrides.set_policy(policy, priorities))
+
+    async def expire_overrides(self):
+        """Drop overrides whose TTL has run out as the timer wheel turns"""
+        while True:
+            await asyncio.sleep(self.overrides.wheel.resolution)
+            cells = self.overrides.expire()
+            if cells:
+                self.apply_overrides(cells)
+                self.request_flush()
 
     def set_master_state(self, maker=None, taker=None):
         if maker is not None:
             self.master_maker = maker
         if taker is not None:
             self.master_taker = taker
-        asyncio.create_task(self.broadcast_master_state())
+        if self.persistence is not None:
+            self.persistence.put_setting("master_state", {"maker": self.master_maker, "taker": self.master_taker})
+        self.master_state_changed = True
+        self.request_flush()
+
+    def persist_symbol(self, symbol: str):
+        if self.persistence is None:
+            return
+        calculator = self.symbols[symbol].calculator
+        depends_on = sorted(other.symbol for other in calculator.dependencies)
+        self.persistence.put_symbol(symbol, calculator.description, calculator.formulas, depends_on)
+
+    def journal_override(self, cell: Tuple[str, str], user_id: str, override: Optional[Override]):
+        symbol, field = cell
+        if override is None:
+            self.persistence.delete("overrides", symbol, field, user_id)
+        else:
+            self.persistence.put_override(symbol, field, user_id, override.value, override.timestamp, override.expires)
+
+    def restore(self, state: Dict) -> List[Tuple[str, str, str]]:
+        """Load persisted state in bulk, binding formulas and recomputing once at the end.
+
+        Returns the overrides that were skipped, because they have expired
+        or their cell no longer exists.
+        """
+        restored = []
+        for row in state["symbols"]:
+            symbol = self.symbols.get(row["symbol"])
+            if symbol is None:
+                symbol = self.symbols[row["symbol"]] = Symbol(row["symbol"], row["description"])
+                self.register_calculator(symbol.calculator)
+            restored.append((symbol, row["formulas"]))
+        for symbol, formulas in restored:
+            for field, formula in formulas.items():
+                try:
+                    symbol.calculator.set_formula(field, formula)
+                except FormulaError as e:
+                    if trace.enabled(WARNING, symbol.symbol, field):
+                        trace.log(WARNING, symbol.symbol, field, "error restoring formula", error=str(e))
+        self.bind_formulas()
 
-manager = ConnectionManager()
+        now = datetime.now()
+        cells = set()
+        skipped = []
+        for row in state["overrides"]:
+            symbol, field, user_id = row["symbol"], row["field"], row["user_id"]
+            ttl = (row["expires"] - now).total_seconds() if row["expires"] is not None else None
+            if symbol not in self.symbols or field not in self.symbols[symbol].calculator.overrides or \
+                    (ttl is not None and ttl <= 0):
+                skipped.append((symbol, field, user_id))
+                continue
+            self.overrides.set((symbol, field), user_id, row["value"], ttl, timestamp=row["timestamp"])
+            cells.add((symbol, field))
+        self.column_orders.update(state["column_orders"])
+        self.symbol_orders.update(state["symbol_orders"])
+        master_state = state["settings"].get("master_state")
+        if master_state is not None:
+            self.master_maker = master_state["maker"]
+            self.master_taker = master_state["taker"]
+        self.apply_overrides(cells)
+        self.recalculate((datetime.now() - self.last_update).total_seconds())
+        return skipped
+
+    def start_persistence(self, url: str = DATABASE_URL):
+        """Restore the saved state, then journal every change to it from here on"""
+        started = time.perf_counter()
+        persistence = Persistence(url)
+        state = persistence.load()
+        skipped = self.restore(state)
+        self.restored = {
+            "symbols": len(state["symbols"]),
+            "overrides": len(state["overrides"]) - len(skipped),
+            "seconds": time.perf_counter() - started,
+        }
+        self.persistence = persistence
+        self.overrides.journal = self.journal_override
+        # Save what didn't come from the database, i.e. the built-in symbols on a first start
+        loaded = {row["symbol"] for row in state["symbols"]}
+        for symbol in self.symbols:
+            if symbol not in loaded:
+                self.persist_symbol(symbol)
+        for symbol, field, user_id in skipped:
+            persistence.delete("overrides", symbol, field, user_id)
+        for kind, orders in (("column", self.column_orders), ("symbol", self.symbol_orders)):
+            for user_id, order in orders.items():
+                persistence.put_order(kind, user_id, order)
+        persistence.put_setting("master_state", {"maker": self.master_maker, "taker": self.master_taker})
+        persistence.start()
+
+# A value log CSV, a directory of them or a history directory to replay instead of the random walk
+REPLAY_SOURCE = os.environ.get("TRADING_REPLAY")
+
+manager = ConnectionManager(
+    columnar=os.environ.get("TRADING_COLUMNAR") == "1",
+    # Replays are seeded by default so runs over the same recording match
+    seed=int(os.environ["TRADING_SEED"]) if os.environ.get("TRADING_SEED") else (0 if REPLAY_SOURCE else None),
+    tick_interval=float(os.environ.get("TRADING_TICK_INTERVAL", DEFAULT_INTERVAL)),
+    overrun=os.environ.get("TRADING_OVERRUN", DEFAULT_POLICY),
+    override_policy=os.environ.get("TRADING_OVERRIDE_POLICY", DEFAULT_PRECEDENCE),
+    flush_window=float(os.environ.get("TRADING_FLUSH_WINDOW", DEFAULT_FLUSH_WINDOW)),
+    flush_max_delay=float(os.environ.get("TRADING_FLUSH_MAX_DELAY", DEFAULT_FLUSH_MAX_DELAY))
+)
+# Where symbols, formulas, overrides, orders and master state are kept across restarts; empty to keep nothing
+DATABASE = os.environ.get("TRADING_DATABASE_URL", DATABASE_URL)
+# Worker processes to tick symbols in; started with the app rather than on import,
+# since the workers import this module too
+SHARDS = int(os.environ.get("TRADING_SHARDS", "0"))
+# A market data feed to drive input cells from, e.g. udp://127.0.0.1:9999; the random walk drives the rest
+INGEST_SOURCE = os.environ.get("TRADING_INGEST")
+if REPLAY_SOURCE:
+    # Keep replayed values out of the recorded session logs and history
+    manager.value_logger.logs_dir = LOGS_DIR / "replay"
+    manager.value_logger.sinks.remove(manager.history.append_rows)
+
+# Read when /metrics is scraped, from whichever manager is current
+def per_client(read):
+    return lambda: {(channel.name,): read(channel) for channel in list(manager.fanout.channels.values())}
+
+metrics.gauge("trading_symbols", "Symbols on the sheet", collect=lambda: len(manager.symbols))
+metrics.gauge("trading_ws_connections", "Open websocket connections", collect=lambda: len(manager.fanout.channels))
+metrics.gauge("trading_ws_queue_depth", "Messages queued for a client", ("client",),
+              per_client(lambda channel: len(channel.queue)))
+metrics.counter("trading_ws_sent_total", "Messages written to a client", ("client",),
+                per_client(lambda channel: channel.sent))
+metrics.counter("trading_ws_dropped_total", "Messages dropped by a client's overflow policy", ("client",),
+                per_client(lambda channel: channel.dropped))
+metrics.counter("trading_ws_send_seconds_total", "Time spent writing to a client's socket", ("client",),
+                per_client(lambda channel: channel.send_seconds))
+metrics.gauge("trading_overridden_cells", "Cells with at least one override",
+              collect=lambda: len(manager.overrides.by_cell))
+metrics.gauge("trading_overrides", "Overrides held per user", ("user",),
+              collect=lambda: {(user_id,): len(cells) for user_id, cells in manager.overrides.by_user.items()})
+metrics.counter("trading_overrides_expired_total", "Overrides removed by their TTL",
+                collect=lambda: manager.overrides.expired)
+metrics.counter("trading_ticks_missed_total", "Tick deadlines dropped because an earlier tick overran", ("group",),
+                collect=lambda: {(name,): group.missed for name, group in manager.scheduler.groups.items()})
+metrics.gauge("trading_tick_max_lag_seconds", "Longest a tick has started after its deadline", ("group",),
+              collect=lambda: {(name,): group.max_lag for name, group in manager.scheduler.groups.items()})
+metrics.counter("trading_ingest_updates_total", "Updates decoded from the market data feed",
+                collect=lambda: manager.ingest.received if manager.ingest is not None else 0)
+metrics.counter("trading_ingest_applied_total", "Feed values applied to cells after conflation",
+                collect=lambda: manager.ingest.applied if manager.ingest is not None else 0)
+metrics.counter("trading_ingest_dropped_total", "Feed updates not applied, by reason", ("reason",),
+                collect=lambda: {} if manager.ingest is None else {
+                    ("conflated",): manager.ingest.conflated,
+                    ("malformed",): manager.ingest.malformed,
+                    ("pending_full",): manager.ingest.dropped,
+                    **{(reason,): count for reason, count in manager.ingest.rejected.items()},
+                })
+metrics.counter("trading_flush_requests_total", "Broadcasts asked for by edits", collect=lambda: manager.flusher.requests)
+metrics.counter("trading_flushes_total", "Edit broadcasts sent after coalescing", collect=lambda: manager.flusher.flushes)
 
 app = FastAPI()
 
@@ -436,15 +1118,53 @@ class NewSymbol(BaseModel):
     symbol: str
     description: Optional[str] = None
 
+class FormulaUpdate(BaseModel):
+    formula: Optional[str] = None  # None or empty clears the formula
+
+class LogLevelUpdate(BaseModel):
+    level: Optional[str] = None  # None clears a symbol or cell level
+    symbol: Optional[str] = None
+    field: Optional[str] = None
+
+class TickGroupUpdate(BaseModel):
+    interval: Optional[float] = None  # Seconds between ticks
+    policy: Optional[str] = None  # "skip" or "catch_up"
+    symbols: Optional[List[str]] = None  # Moved into this group
+
 class CellUpdate(BaseModel):
     cell_id: str
     value: Optional[float] = None  # Make value optional to support override removal
     user_id: str
     symbol: str
+    ttl: Optional[float] = None  # Seconds until the override expires
+
+class BatchCellItem(BaseModel):
+    symbol: str
+    cell_id: str
+    value: Optional[Union[float, str]] = None  # None or empty removes the override
+    ttl: Optional[float] = None
+
+class BatchCellUpdate(BaseModel):
+    user_id: str
+    updates: List[BatchCellItem]
+
+class OverridePolicyUpdate(BaseModel):
+    policy: str  # "latest", "earliest" or "priority"
+    priorities: Optional[Dict[str, int]] = None  # Higher wins under "priority"
+
+def split_list(value: Optional[str]) -> Optional[List[str]]:
+    """A comma-separated query parameter as a list, or None if it wasn't given"""
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(",") if item.strip()]
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, max_queue: int = DEFAULT_MAX_QUEUE,
+                             overflow: str = DEFAULT_OVERFLOW, symbols: Optional[str] = None,
+                             fields: Optional[str] = None):
+    # symbols and fields are comma-separated; symbols may be patterns such as "ES*"
+    subscription = Subscription(split_list(symbols), split_list(fields))
+    await manager.connect(websocket, max_queue, overflow, subscription)
     try:
         while True:
             data = await websocket.receive_text()
@@ -460,32 +1180,84 @@ async def websocket_endpoint(websocket: WebSocket):
                     update_data["user_id"],
                     update_data["order"]
                 )
+            elif update_data.get("type") == "snapshot_request":
+                # Sent by clients that saw a gap in cell_update sequence numbers
+                manager.send_snapshot(websocket)
             elif update_data.get("type") == "master_state":
                 maker = update_data.get("master_maker")
                 taker = update_data.get("master_taker")
                 manager.set_master_state(maker, taker)
+            elif update_data.get("type") == "batch":
+                # Many edits applied together, answered with per-item results
+                user_id, updates = update_data.get("user_id"), update_data.get("updates", [])
+                if not isinstance(user_id, str) or not isinstance(updates, list):
+                    manager.send_to(websocket, {
+                        "type": "batch_result",
+                        "request_id": update_data.get("request_id"),
+                        "status": "error",
+                        "message": "Batch needs a user_id and a list of updates",
+                        "results": []
+                    })
+                    continue
+                applied, results = manager.update_cells(updates, user_id)
+                if applied:
+                    manager.request_flush()
+                manager.send_to(websocket, {
+                    "type": "batch_result",
+                    "request_id": update_data.get("request_id"),
+                    "status": "success" if applied else "error",
+                    "results": results
+                })
+            elif update_data.get("type") in ("subscribe", "unsubscribe"):
+                symbols, fields = update_data.get("symbols"), update_data.get("fields")
+                error = manager.check_subscription(symbols, fields)
+                if error is not None:
+                    manager.send_to(websocket, {"type": "error", "message": error})
+                elif update_data["type"] == "subscribe":
+                    # Adding to a client that gets everything narrows it to what's added
+                    manager.subscribe(websocket, symbols, fields, update_data.get("replace", False))
+                else:
+                    manager.unsubscribe(websocket, symbols, fields)
+            elif update_data.get("type") == "clear_overrides":
+                # Bulk clear by user and/or field, sent as one delta
+                manager.clear_overrides(update_data.get("user_id"), update_data.get("field"))
+                manager.request_flush()
             else:
                 cell_id = update_data["cell_id"]
                 value = update_data.get("value")  # Use get() to handle None or empty values
                 user_id = update_data["user_id"]
                 symbol = update_data["symbol"]
                 
-                manager.update_cell(symbol, cell_id, value, user_id)
+                try:
+                    manager.update_cell(symbol, cell_id, value, user_id, update_data.get("ttl"))
+                except ValueError as e:
+                    manager.send_to(websocket, {
+                        "type": "error",
+                        "symbol": symbol,
+                        "cell_id": cell_id,
+                        "message": str(e)
+                    })
+                    continue
                 
-                await manager.broadcast({
-                    "type": "cell_update",
-                    "cell_data": manager.get_cell_data()
-                })
+                manager.request_flush()
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Also covers sockets closed by their channel's overflow policy
         manager.disconnect(websocket)
 
 @app.get("/cells")
-async def get_cells():
-    return {
-        "cell_data": manager.get_cell_data(),
-        "column_orders": manager.column_orders,
-        "symbol_orders": manager.symbol_orders
-    }
+async def get_cells(if_none_match: Optional[str] = Header(None)):
+    # The ETag is the sheet's version, so a client that's seen this one already gets a 304
+    etag = manager.snapshots.etag
+    if if_none_match is not None and (if_none_match.strip() == "*" or
+                                      etag in (tag.strip() for tag in if_none_match.split(","))):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(manager.serialized_cells(), media_type="application/json", headers={"ETag": etag})
+
+@app.get("/snapshots")
+async def get_snapshots():
+    return manager.snapshots.stats()
 
 @app.get("/symbols")
 async def get_symbols():
@@ -497,16 +1269,67 @@ async def add_symbol(symbol: NewSymbol):
     manager.add_symbol(symbol.symbol, symbol.description)
     return {"status": "success", "symbol": symbol.symbol}
 
+@app.get("/symbols/{symbol}/formulas")
+async def get_formulas(symbol: str):
+    if symbol not in manager.symbols:
+        raise HTTPException(status_code=404, detail="Symbol not found")
+    return manager.symbols[symbol].calculator.formulas
+
+@app.post("/symbols/{symbol}/formulas/{field}")
+async def set_formula(symbol: str, field: str, update: FormulaUpdate):
+    manager.set_formula(symbol, field, update.formula)
+    manager.request_flush()
+    return {"status": "success", "symbol": symbol, "field": field}
+
+@app.post("/cells/batch")
+async def update_cells(batch: BatchCellUpdate):
+    applied, results = manager.update_cells([item.dict() for item in batch.updates], batch.user_id)
+    if applied:
+        manager.request_flush()
+    return {"status": "success" if applied else "error", "results": results}
+
 @app.post("/cells/{symbol}/{cell_id}")
 async def update_cell(symbol: str, cell_id: str, update: CellUpdate):
-    if manager.update_cell(symbol, cell_id, update.value, update.user_id):
-        await manager.broadcast({
-            "type": "cell_update",
-            "cell_data": manager.get_cell_data()
-        })
+    try:
+        updated = manager.update_cell(symbol, cell_id, update.value, update.user_id, update.ttl)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if updated:
+        manager.request_flush()
         return {"status": "success"}
     return {"status": "error", "message": "Cell not found"}
 
+@app.get("/overrides")
+async def get_overrides(user_id: Optional[str] = None):
+    if user_id is not None:
+        return {"user_id": user_id, "overrides": manager.overrides.for_user(user_id)}
+    return manager.overrides.stats()
+
+@app.delete("/overrides/users/{user_id}")
+async def clear_user_overrides(user_id: str, field: Optional[str] = None):
+    cleared = manager.clear_overrides(user_id, field)
+    manager.request_flush()
+    return {"status": "success", "cleared": cleared}
+
+@app.delete("/overrides/fields/{field}")
+async def clear_field_overrides(field: str):
+    cleared = manager.clear_overrides(field=field)
+    manager.request_flush()
+    return {"status": "success", "cleared": cleared}
+
+@app.get("/overrides/policy")
+async def get_override_policy():
+    return {"policy": manager.overrides.policy, "priorities": manager.overrides.priorities}
+
+@app.post("/overrides/policy")
+async def set_override_policy(update: OverridePolicyUpdate):
+    try:
+        manager.set_override_policy(update.policy, update.priorities)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    manager.request_flush()
+    return {"policy": manager.overrides.policy, "priorities": manager.overrides.priorities}
+
 @app.post("/column-order")
 async def update_column_order(order_update: ColumnOrder):
     manager.update_column_order(order_update.user_id, order_update.order)
@@ -531,9 +1354,178 @@ async def set_master_state(data: dict):
     manager.set_master_state(maker, taker)
     return {"status": "success"}
 
+@app.get("/logs")
+async def get_logs(cursor: Optional[int] = None, since: Optional[str] = None, limit: int = 1000):
+    try:
+        return manager.value_logger.get_logs(cursor, since, max(1, min(limit, 10000)))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid timestamp: {value}")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
+
+@app.get("/history/{symbol}/{field}")
+async def get_history(symbol: str, field: str, start: Optional[str] = None, end: Optional[str] = None,
+                      limit: int = 10000):
+    points = manager.history.range(symbol, field, parse_time(start), parse_time(end), max(1, min(limit, 100000)))
+    return {
+        "symbol": symbol,
+        "field": field,
+        "points": [
+            {"timestamp": from_micros(timestamp).isoformat(), "value": value, "is_override": is_override}
+            for timestamp, value, is_override in points
+        ]
+    }
+
+@app.get("/history/{symbol}/{field}/downsample")
+async def get_history_downsample(symbol: str, field: str, bucket: float = 60, mode: str = "ohlc",
+                                 start: Optional[str] = None, end: Optional[str] = None):
+    try:
+        start_time, end_time = parse_time(start), parse_time(end)
+        # Long ranges take a while to aggregate, so keep it off the event loop
+        bars = await asyncio.get_running_loop().run_in_executor(
+            None, manager.history.downsample, symbol, field, bucket, mode, start_time, end_time
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"symbol": symbol, "field": field, "bucket": bucket, "mode": mode, "bars": bars}
+
+@app.get("/debug/log-levels")
+async def get_log_levels():
+    return trace.get_levels()
+
+@app.post("/debug/log-levels")
+async def set_log_level(update: LogLevelUpdate):
+    try:
+        trace.set_level(update.level, update.symbol, update.field)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return trace.get_levels()
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# One profile at a time; the sampler thread watches the event loop's thread
+profile_lock = asyncio.Lock()
+
+@app.get("/debug/profile")
+async def get_profile(seconds: float = 5.0, interval: float = PROFILE_INTERVAL, format: str = "json"):
+    """Sample the event loop's stack for `seconds`; format=folded gives flame graph input"""
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="interval must be between 0.001 and 1")
+    if format not in ("json", "folded"):
+        raise HTTPException(status_code=400, detail="format must be json or folded")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    async with profile_lock:
+        profiler = SamplingProfiler(threading.get_ident(), interval)
+        await asyncio.get_running_loop().run_in_executor(None, profiler.run, seconds)
+    if format == "folded":
+        return PlainTextResponse(profiler.folded())
+    return profiler.report()
+
+@app.get("/debug/trace/{symbol}")
+async def get_trace(symbol: str, field: Optional[str] = None, limit: int = 100):
+    if symbol not in manager.symbols:
+        raise HTTPException(status_code=404, detail="Symbol not found")
+    return {"symbol": symbol, "records": trace.tail(symbol, field, limit)}
+
+@app.get("/scheduler")
+async def get_scheduler():
+    return {**manager.scheduler.stats(), "flush": manager.flusher.stats()}
+
+@app.post("/scheduler/groups/{name}")
+async def set_tick_group(name: str, update: TickGroupUpdate):
+    unknown = [symbol for symbol in update.symbols or [] if symbol not in manager.symbols]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Symbols not found: {', '.join(unknown)}")
+    try:
+        manager.scheduler.set_group(name, update.interval, update.policy)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if update.symbols:
+        manager.scheduler.assign(update.symbols, name)
+    return manager.scheduler.stats()
+
+@app.delete("/scheduler/groups/{name}")
+async def remove_tick_group(name: str):
+    try:
+        manager.scheduler.remove_group(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Tick group not found")
+    return manager.scheduler.stats()
+
+@app.get("/subscriptions")
+async def get_subscriptions():
+    return manager.fanout.stats()
+
+@app.get("/persistence")
+async def get_persistence():
+    if manager.persistence is None:
+        raise HTTPException(status_code=404, detail="Persistence is disabled")
+    return {**manager.persistence.stats(), "restored": manager.restored}
+
+@app.get("/ingest")
+async def get_ingest():
+    if manager.ingest is None:
+        raise HTTPException(status_code=404, detail="No market data feed")
+    return {**manager.ingest.stats(), "fed_cells": len(manager.fed_cells)}
+
+@app.get("/shards")
+async def get_shards():
+    if manager.shards is None:
+        raise HTTPException(status_code=404, detail="Sharding is off")
+    return manager.shards.stats()
+
+@app.get("/replay/status")
+async def get_replay_status():
+    if manager.replayer is None:
+        raise HTTPException(status_code=404, detail="Not in replay mode")
+    return manager.replayer.report()
+
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(manager.update_values())
+    trace.start()
+    manager.value_logger.start()
+    asyncio.create_task(manager.expire_overrides())
+    # Replays start from the built-in sheet and don't touch the saved state
+    if DATABASE and not REPLAY_SOURCE:
+        manager.start_persistence(DATABASE)
+    if SHARDS > 1:
+        manager.start_shards(SHARDS, int(os.environ.get("TRADING_SHARD_CAPACITY", DEFAULT_CAPACITY)))
+    if REPLAY_SOURCE:
+        speed = float(os.environ.get("TRADING_REPLAY_SPEED", "1"))
+        manager.replayer = Replayer(manager, load_frames(REPLAY_SOURCE), speed)
+        asyncio.create_task(manager.replayer.run())
+    else:
+        if INGEST_SOURCE:
+            manager.start_ingest(INGEST_SOURCE)
+        asyncio.create_task(manager.update_values())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if manager.ingest is not None:
+        manager.ingest.stop()
+    if manager.shards is not None:
+        manager.shards.close()
+    if manager.persistence is not None:
+        manager.persistence.stop()
+    manager.value_logger.stop()
+    manager.history.close()
+    trace.stop()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,177 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+# Upper bounds in seconds, from 50µs to 10s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+    def lines(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.lines()]
+
+
+class Value(Metric):
+    """A number per label set, kept as it changes or read from `collect` at scrape time.
+
+    `collect` returns a number, or a dict of label values to numbers, for
+    values the app already tracks and only needs exposing.
+    """
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], Union[float, Dict[Labels, float]]]] = None):
+        super().__init__(name, help, label_names)
+        self.values: Dict[Labels, float] = {}
+        self.collect = collect
+
+    def lines(self) -> Iterable[str]:
+        values = self.values
+        if self.collect is not None:
+            collected = self.collect()
+            values = collected if isinstance(collected, dict) else {(): collected}
+        for labels, value in list(values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+
+class Counter(Value):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, labels: Labels = ()):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+
+class Gauge(Value):
+    kind = "gauge"
+
+    def set(self, value: float, labels: Labels = ()):
+        self.values[labels] = value
+
+
+class Summary(Metric):
+    """Count and total of observations per label set, without quantiles.
+
+    Cheap enough to keep per cell: rate(sum) / rate(count) is the mean, and
+    rate(sum) alone shows which label set is taking the most time.
+    """
+
+    kind = "summary"
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self.values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        totals = self.values.get(labels)
+        if totals is None:
+            totals = self.values[labels] = [0, 0.0]
+        totals[0] += 1
+        totals[1] += value
+
+    def lines(self) -> Iterable[str]:
+        for labels, (count, total) in list(self.values.items()):
+            label_text = _format_labels(self.label_names, labels)
+            yield f"{self.name}_sum{label_text} {_format_value(total)}"
+            yield f"{self.name}_count{label_text} {count}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count per bucket (not cumulative, plus one for +Inf), then the sum
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1][0] += value
+
+    def lines(self) -> Iterable[str]:
+        for labels, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), list(counts)):
+                cumulative += count
+                label_text = _format_labels(self.label_names, labels, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{label_text} {cumulative}"
+            label_text = _format_labels(self.label_names, labels)
+            yield f"{self.name}_sum{label_text} {_format_value(total[0])}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class Registry:
+    """Metrics rendered together in the Prometheus text format.
+
+    Observations are plain dict and list updates on the event loop thread,
+    with no locking, so they're cheap enough for the tick loop.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label_names: Tuple[str, ...] = (), collect=None) -> Counter:
+        return self.register(Counter(name, help, label_names, collect))
+
+    def gauge(self, name: str, help: str, label_names: Tuple[str, ...] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, label_names, collect))
+
+    def summary(self, name: str, help: str, label_names: Tuple[str, ...] = ()) -> Summary:
+        return self.register(Summary(name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
@@ -0,0 +1,215 @@
+import itertools
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+Cell = Tuple[str, str]
+
+# Which user's override a cell shows when several users override it
+PRECEDENCE_POLICIES = ("latest", "earliest", "priority")
+DEFAULT_PRECEDENCE = "latest"
+
+
+class Override:
+    __slots__ = ("user_id", "value", "timestamp", "seq", "expires_at", "expires")
+
+    def __init__(self, user_id: str, value, timestamp: datetime, seq: int, expires_at: Optional[float],
+                 expires: Optional[datetime] = None):
+        self.user_id = user_id
+        self.value = value
+        self.timestamp = timestamp
+        self.seq = seq
+        # time.monotonic() deadline, or None for an override that doesn't expire
+        self.expires_at = expires_at
+        # The same deadline on the wall clock, as shown to clients and persisted
+        self.expires = expires
+
+
+class TimerWheel:
+    """Hashed timer wheel: scheduling and cancelling are O(1), and advancing
+    only looks at the buckets whose time has come rather than every timer"""
+
+    def __init__(self, resolution: float = 0.25, size: int = 1024, now: Optional[float] = None):
+        self.resolution = resolution
+        self.size = size
+        self.buckets: List[Dict[Hashable, float]] = [{} for _ in range(size)]
+        self.locations: Dict[Hashable, int] = {}
+        self.current = int((time.monotonic() if now is None else now) / resolution)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def schedule(self, key: Hashable, deadline: float):
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.resolution), self.current + 1)
+        bucket = tick % self.size
+        self.buckets[bucket][key] = deadline
+        self.locations[key] = bucket
+
+    def cancel(self, key: Hashable):
+        bucket = self.locations.pop(key, None)
+        if bucket is not None:
+            del self.buckets[bucket][key]
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Remove and return the keys whose deadline is at or before `now`"""
+        target = int(now / self.resolution)
+        expired = []
+        # One full turn visits every bucket, so never walk further than that
+        for tick in range(self.current + 1, min(target, self.current + self.size) + 1):
+            bucket = self.buckets[tick % self.size]
+            if not bucket:
+                continue
+            for key, deadline in list(bucket.items()):
+                # Timers a whole turn or more away share the bucket; leave them
+                if deadline <= now:
+                    del bucket[key]
+                    del self.locations[key]
+                    expired.append(key)
+        self.current = max(self.current, target)
+        return expired
+
+
+class OverrideIndex:
+    """Overrides indexed by cell and by user, with each cell's winning override kept current.
+
+    The per-symbol `overrides` dicts on the calculators are kept in step as
+    the serialized view clients see, but the index is the source of truth:
+    the effective value of a cell is one lookup, clearing a user's overrides
+    touches only that user's cells, and TTLs expire through a timer wheel.
+    """
+
+    def __init__(self, policy: str = DEFAULT_PRECEDENCE, priorities: Optional[Dict[str, int]] = None,
+                 wheel: Optional[TimerWheel] = None):
+        if policy not in PRECEDENCE_POLICIES:
+            raise ValueError(f"Unknown precedence policy: {policy}")
+        self.policy = policy
+        # Higher wins under the "priority" policy; users not listed have priority 0
+        self.priorities: Dict[str, int] = dict(priorities or {})
+        self.by_cell: Dict[Cell, Dict[str, Override]] = {}
+        self.by_user: Dict[str, Set[Cell]] = {}
+        self.effective: Dict[Cell, Override] = {}
+        self.views: Dict[str, Dict[str, Dict]] = {}
+        self.wheel = wheel or TimerWheel()
+        self.seqs = itertools.count(1)
+        self.expired = 0
+        # Called with (cell, user_id, override) on every set, and with None for the override on every removal
+        self.journal: Optional[Callable[[Cell, str, Optional[Override]], None]] = None
+
+    def attach(self, symbol: str, views: Dict[str, Dict]):
+        """Keep a calculator's overrides dict (field -> user -> override) in step with the index"""
+        self.views[symbol] = views
+
+    def get(self, cell: Cell) -> Optional[Override]:
+        """The override a cell shows, if any"""
+        return self.effective.get(cell)
+
+    def set(self, cell: Cell, user_id: str, value, ttl: Optional[float] = None, now: Optional[float] = None,
+            timestamp: Optional[datetime] = None):
+        if ttl is not None and ttl <= 0:
+            # Not a permanent override, which is what no ttl means
+            raise ValueError("ttl must be a positive number of seconds")
+        now = time.monotonic() if now is None else now
+        timestamp = timestamp or datetime.now()
+        expires_at = now + ttl if ttl is not None else None
+        expires = datetime.now() + timedelta(seconds=ttl) if expires_at is not None else None
+        override = Override(user_id, value, timestamp, next(self.seqs), expires_at, expires)
+        self.by_cell.setdefault(cell, {})[user_id] = override
+        self.by_user.setdefault(user_id, set()).add(cell)
+        if expires_at is None:
+            self.wheel.cancel((cell, user_id))
+        else:
+            self.wheel.schedule((cell, user_id), expires_at)
+        view = {"value": value, "timestamp": timestamp.isoformat()}
+        if expires is not None:
+            view["expires"] = expires.isoformat()
+        symbol, field = cell
+        self.views[symbol][field][user_id] = view
+        self._resolve(cell)
+        if self.journal is not None:
+            self.journal(cell, user_id, override)
+
+    def remove(self, cell: Cell, user_id: str) -> bool:
+        overrides = self.by_cell.get(cell)
+        if not overrides or user_id not in overrides:
+            return False
+        del overrides[user_id]
+        if not overrides:
+            del self.by_cell[cell]
+        cells = self.by_user[user_id]
+        cells.discard(cell)
+        if not cells:
+            del self.by_user[user_id]
+        self.wheel.cancel((cell, user_id))
+        symbol, field = cell
+        self.views[symbol][field].pop(user_id, None)
+        self._resolve(cell)
+        if self.journal is not None:
+            self.journal(cell, user_id, None)
+        return True
+
+    def clear(self, user_id: Optional[str] = None, field: Optional[str] = None) -> Set[Cell]:
+        """Remove every override by `user_id` and/or on `field`; returns the cells that had one"""
+        if user_id is not None:
+            cells = [cell for cell in self.by_user.get(user_id, ()) if field is None or cell[1] == field]
+            pairs = [(cell, user_id) for cell in cells]
+        else:
+            pairs = [(cell, user) for cell, overrides in self.by_cell.items()
+                     if field is None or cell[1] == field for user in overrides]
+        for cell, user in pairs:
+            self.remove(cell, user)
+        return {cell for cell, _ in pairs}
+
+    def expire(self, now: Optional[float] = None) -> Set[Cell]:
+        """Remove overrides whose TTL has run out; returns the cells that had one"""
+        cells = set()
+        for cell, user_id in self.wheel.advance(time.monotonic() if now is None else now):
+            if self.remove(cell, user_id):
+                cells.add(cell)
+                self.expired += 1
+        return cells
+
+    def set_policy(self, policy: str, priorities: Optional[Dict[str, int]] = None) -> Set[Cell]:
+        """Change the precedence rules; returns the cells whose winning override changed"""
+        if policy not in PRECEDENCE_POLICIES:
+            raise ValueError(f"Unknown precedence policy: {policy}")
+        self.policy = policy
+        if priorities is not None:
+            self.priorities = dict(priorities)
+        changed = set()
+        for cell in list(self.by_cell):
+            before = self.effective.get(cell)
+            if self._resolve(cell) is not before:
+                changed.add(cell)
+        return changed
+
+    def _resolve(self, cell: Cell) -> Optional[Override]:
+        overrides = self.by_cell.get(cell)
+        if not overrides:
+            self.effective.pop(cell, None)
+            return None
+        if self.policy == "earliest":
+            winner = min(overrides.values(), key=lambda o: o.seq)
+        elif self.policy == "priority":
+            winner = max(overrides.values(), key=lambda o: (self.priorities.get(o.user_id, 0), o.seq))
+        else:
+            winner = max(overrides.values(), key=lambda o: o.seq)
+        self.effective[cell] = winner
+        return winner
+
+    def for_user(self, user_id: str) -> List[Dict]:
+        return [
+            {"symbol": symbol, "field": field, "value": self.by_cell[(symbol, field)][user_id].value}
+            for symbol, field in sorted(self.by_user.get(user_id, ()))
+        ]
+
+    def stats(self) -> Dict:
+        return {
+            "policy": self.policy,
+            "priorities": self.priorities,
+            "cells": len(self.by_cell),
+            "users": {user_id: len(cells) for user_id, cells in self.by_user.items()},
+            "pending_expiries": len(self.wheel),
+            "expired": self.expired,
+        }
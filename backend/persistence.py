@@ -0,0 +1,297 @@
+import json
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from sqlalchemy import (Boolean, Column, ForeignKey, Integer, String, bindparam, create_engine, delete,
+                        event, inspect, select, text)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import declarative_base, relationship
+
+from formulas import NUMERIC_FIELDS
+from trace_log import ERROR, trace
+
+# Next to this file, whichever directory the server is started from
+DATABASE_URL = f"sqlite:///{Path(__file__).parent / 'trading.db'}"
+
+Base = declarative_base()
+
+
+class Symbol(Base):
+    __tablename__ = "symbols"
+
+    id = Column(Integer, primary_key=True, index=True)
+    symbol = Column(String, unique=True, index=True)
+    description = Column(String)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(String, default=lambda: datetime.now().isoformat())
+
+    # Formula source per field, or None for a random walk
+    bid_edge_formula = Column(String, nullable=True)
+    ask_edge_formula = Column(String, nullable=True)
+    bid_q_formula = Column(String, nullable=True)
+    ask_q_formula = Column(String, nullable=True)
+
+    # Relationships for dependencies
+    dependencies = relationship("SymbolDependency", back_populates="symbol", foreign_keys="SymbolDependency.symbol_id")
+
+
+class SymbolDependency(Base):
+    __tablename__ = "symbol_dependencies"
+
+    id = Column(Integer, primary_key=True, index=True)
+    symbol_id = Column(Integer, ForeignKey("symbols.id"))
+    depends_on_id = Column(Integer, ForeignKey("symbols.id"))
+
+    symbol = relationship("Symbol", back_populates="dependencies", foreign_keys=[symbol_id])
+    depends_on = relationship("Symbol", foreign_keys=[depends_on_id])
+
+
+class OverrideRecord(Base):
+    __tablename__ = "overrides"
+
+    symbol = Column(String, primary_key=True)
+    field = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    value = Column(String)  # JSON, since toggles are "ON"/"OFF"
+    timestamp = Column(String)
+    expires = Column(String, nullable=True)
+
+
+class UserOrder(Base):
+    __tablename__ = "user_orders"
+
+    kind = Column(String, primary_key=True)  # "column" or "symbol"
+    user_id = Column(String, primary_key=True)
+    order = Column(String)  # JSON list
+
+
+class Setting(Base):
+    __tablename__ = "settings"
+
+    key = Column(String, primary_key=True)
+    value = Column(String)  # JSON
+
+
+FORMULA_COLUMNS = {field: f"{field}_formula" for field in NUMERIC_FIELDS}
+
+# Key columns of each journaled table, in the order journal keys list them
+KEYS = {
+    "symbols": ("symbol",),
+    "overrides": ("symbol", "field", "user_id"),
+    "user_orders": ("kind", "user_id"),
+    "settings": ("key",),
+}
+TABLES = {table.name: table for table in Base.metadata.sorted_tables}
+
+REPLACE_DEPENDENCIES = (
+    text("DELETE FROM symbol_dependencies WHERE symbol_id = (SELECT id FROM symbols WHERE symbol = :symbol)"),
+    text("INSERT INTO symbol_dependencies (symbol_id, depends_on_id) "
+         "SELECT s.id, d.id FROM symbols s, symbols d WHERE s.symbol = :symbol AND d.symbol = :depends_on"),
+)
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # Readers don't block the writer, and a commit is one append to the log
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+class Persistence:
+    """Journals symbols, formulas, overrides, orders and master state to SQLite without blocking the event loop.
+
+    The put/delete methods only record the latest row for a key in memory.
+    A writer thread takes whatever has built up every `flush_interval`
+    seconds and writes it in one transaction, so a cell overridden a
+    hundred times between flushes is written once. `load` reads every
+    table back in one pass for a warm start.
+    """
+
+    def __init__(self, url: str = DATABASE_URL, flush_interval: float = 0.5):
+        self.url = url
+        self.flush_interval = flush_interval
+        self.engine = create_engine(url)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", _set_pragmas)
+        Base.metadata.create_all(self.engine)
+        self._add_missing_columns()
+        # (table, key) -> row to upsert, or None to delete; only the latest change per key is kept
+        self.pending: Dict[Tuple[str, Hashable], Optional[Dict]] = {}
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.written = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _add_missing_columns(self):
+        """Bring tables created by an older version of the models up to date"""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing:
+                        column_type = column.type.compile(self.engine.dialect)
+                        conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+
+    def put(self, table: str, row: Dict):
+        key = tuple(row[column] for column in KEYS[table])
+        with self.lock:
+            self.pending[(table, key)] = row
+
+    def delete(self, table: str, *key):
+        with self.lock:
+            self.pending[(table, key)] = None
+
+    def put_symbol(self, symbol: str, description: Optional[str], formulas: Dict[str, Optional[str]],
+                   depends_on: List[str]):
+        row = {"symbol": symbol, "description": description, "is_active": True, "depends_on": depends_on}
+        row.update({column: formulas.get(field) for field, column in FORMULA_COLUMNS.items()})
+        self.put("symbols", row)
+
+    def put_override(self, symbol: str, field: str, user_id: str, value, timestamp: datetime,
+                     expires: Optional[datetime]):
+        self.put("overrides", {
+            "symbol": symbol,
+            "field": field,
+            "user_id": user_id,
+            "value": json.dumps(value),
+            "timestamp": timestamp.isoformat(),
+            "expires": expires.isoformat() if expires is not None else None,
+        })
+
+    def put_order(self, kind: str, user_id: str, order: List[str]):
+        self.put("user_orders", {"kind": kind, "user_id": user_id, "order": json.dumps(order)})
+
+    def put_setting(self, key: str, value):
+        self.put("settings", {"key": key, "value": json.dumps(value)})
+
+    def load(self) -> Dict:
+        """Every persisted row, read in one pass"""
+        with self.engine.connect() as conn:
+            symbols = conn.execute(select(Symbol.__table__).where(Symbol.is_active).order_by(Symbol.id)).mappings().all()
+            overrides = conn.execute(
+                select(OverrideRecord.__table__).order_by(OverrideRecord.timestamp)
+            ).mappings().all()
+            orders = conn.execute(select(UserOrder.__table__)).mappings().all()
+            settings = conn.execute(select(Setting.__table__)).mappings().all()
+        return {
+            "symbols": [
+                {
+                    "symbol": row["symbol"],
+                    "description": row["description"],
+                    "formulas": {field: row[column] for field, column in FORMULA_COLUMNS.items()},
+                }
+                for row in symbols
+            ],
+            # Oldest first, so replaying them keeps their precedence
+            "overrides": [
+                {
+                    "symbol": row["symbol"],
+                    "field": row["field"],
+                    "user_id": row["user_id"],
+                    "value": json.loads(row["value"]),
+                    "timestamp": datetime.fromisoformat(row["timestamp"]),
+                    "expires": datetime.fromisoformat(row["expires"]) if row["expires"] else None,
+                }
+                for row in overrides
+            ],
+            "column_orders": {row["user_id"]: json.loads(row["order"]) for row in orders if row["kind"] == "column"},
+            "symbol_orders": {row["user_id"]: json.loads(row["order"]) for row in orders if row["kind"] == "symbol"},
+            "settings": {row["key"]: json.loads(row["value"]) for row in settings},
+        }
+
+    def flush(self) -> int:
+        """Write everything pending in one transaction; returns the number of rows written"""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        upserts: Dict[str, List[Dict]] = {}
+        deletes: Dict[str, List[Tuple]] = {}
+        for (table, key), row in batch.items():
+            if row is None:
+                deletes.setdefault(table, []).append(key)
+            else:
+                upserts.setdefault(table, []).append(row)
+        try:
+            with self.engine.begin() as conn:
+                for table, rows in upserts.items():
+                    self._upsert(conn, table, rows)
+                for table, keys in deletes.items():
+                    columns = KEYS[table]
+                    statement = delete(TABLES[table]).where(
+                        *(TABLES[table].c[column] == bindparam(f"key_{column}") for column in columns)
+                    )
+                    conn.execute(statement, [{f"key_{column}": value for column, value in zip(columns, key)}
+                                             for key in keys])
+        except Exception as e:
+            self.errors += 1
+            if trace.enabled(ERROR):
+                trace.log(ERROR, None, None, "error writing state to the database", error=str(e))
+            # Retry with the next flush, unless a newer change for the key has come in since
+            with self.lock:
+                for key, row in batch.items():
+                    self.pending.setdefault(key, row)
+            return 0
+        self.flushes += 1
+        self.written += len(batch)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        return len(batch)
+
+    def _upsert(self, conn, table: str, rows: List[Dict]):
+        columns = TABLES[table].c
+        values = [{key: value for key, value in row.items() if key in columns} for row in rows]
+        statement = insert(TABLES[table])
+        keys = KEYS[table]
+        statement = statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: statement.excluded[name] for name in values[0] if name not in keys}
+        )
+        conn.execute(statement, values)
+        if table == "symbols":
+            delete_dependencies, insert_dependency = REPLACE_DEPENDENCIES
+            conn.execute(delete_dependencies, [{"symbol": row["symbol"]} for row in rows])
+            dependencies = [{"symbol": row["symbol"], "depends_on": other}
+                            for row in rows for other in row.get("depends_on", ())]
+            if dependencies:
+                conn.execute(insert_dependency, dependencies)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write what's pending and stop the writer thread"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self.engine.dispose()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            "url": self.url,
+            "pending": pending,
+            "flushes": self.flushes,
+            "written": self.written,
+            "errors": self.errors,
+            "last_flush_ms": self.last_flush_ms,
+        }
@@ -0,0 +1,88 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+# Where a frame is running: (file, first line of the function, function name)
+Location = Tuple[str, int, str]
+
+MAX_SECONDS = 60.0
+DEFAULT_INTERVAL = 0.005
+
+
+def _describe(location: Location) -> str:
+    filename, line, name = location
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+class SamplingProfiler:
+    """Samples another thread's stack from a background thread.
+
+    Nothing is installed in the sampled thread, so it runs at full speed
+    while a profile is taken; the cost is the sampler waking every
+    `interval` seconds and walking the stack.
+    """
+
+    def __init__(self, thread_id: int, interval: float = DEFAULT_INTERVAL, max_depth: int = 128):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+
+    def run(self, seconds: float) -> "SamplingProfiler":
+        """Sample for `seconds`; blocks, so call it from a thread other than the one sampled"""
+        me = threading.get_ident()
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or self.thread_id == me:
+                break
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            del frame
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self.elapsed = time.perf_counter() - started
+        return self
+
+    def folded(self) -> str:
+        """One line per distinct stack, root first, as flamegraph.pl and speedscope read them"""
+        return "\n".join(
+            f"{';'.join(_describe(location) for location in stack)} {count}"
+            for stack, count in self.stacks.most_common()
+        ) + "\n"
+
+    def report(self, limit: int = 50) -> Dict:
+        """The functions seen most, by samples where they were running (self) and on the stack (total)"""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            if stack:
+                own[stack[-1]] += count
+            for location in set(stack):
+                total[location] += count
+        samples = max(self.samples, 1)
+
+        def rows(counter: Counter) -> List[Dict]:
+            return [
+                {"function": _describe(location), "samples": count, "percent": round(100.0 * count / samples, 1)}
+                for location, count in counter.most_common(limit)
+            ]
+
+        return {
+            "seconds": self.elapsed,
+            "interval": self.interval,
+            "samples": self.samples,
+            "self": rows(own),
+            "total": rows(total),
+        }
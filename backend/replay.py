@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import csv
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from formulas import NUMERIC_FIELDS
+from history_store import HistoryStore, from_micros
+
+# symbol, field, value, is_override, user_id
+Row = Tuple[str, str, object, bool, Optional[str]]
+Frame = Tuple[datetime, List[Row]]
+
+REPLAY_USER = "replay"
+REMOVED_SUFFIX = "_removed"
+
+
+def load_csv_frames(paths: List[Path]) -> List[Frame]:
+    """Group value log rows into frames of rows sharing a timestamp, oldest first"""
+    frames: Dict[datetime, List[Row]] = {}
+    for path in sorted(paths, key=lambda p: p.name):
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                try:
+                    timestamp = datetime.fromisoformat(row["timestamp"])
+                    field = row["field"]
+                    value = float(row["value"]) if field in NUMERIC_FIELDS else row["value"]
+                except (KeyError, TypeError, ValueError):
+                    continue
+                frames.setdefault(timestamp, []).append(
+                    (row["symbol"], field, value, row.get("is_override") == "True", row.get("user_id") or None)
+                )
+    return sorted(frames.items(), key=lambda frame: frame[0])
+
+
+def load_history_frames(root: Path, start: Optional[datetime] = None,
+                        end: Optional[datetime] = None) -> List[Frame]:
+    """Merge every segment of a history store into frames, oldest first"""
+    store = HistoryStore(root)
+    frames: Dict[int, List[Row]] = {}
+    try:
+        for symbol_dir in sorted(p for p in Path(root).iterdir() if p.is_dir()):
+            for field in NUMERIC_FIELDS:
+                for timestamp, value, is_override in store.range(symbol_dir.name, field, start, end):
+                    frames.setdefault(timestamp, []).append((symbol_dir.name, field, value, is_override, None))
+    finally:
+        store.close()
+    return [(from_micros(timestamp), rows) for timestamp, rows in sorted(frames.items())]
+
+
+def load_frames(source: Path) -> List[Frame]:
+    source = Path(source)
+    if source.is_dir() and any(source.glob("*.csv")):
+        return load_csv_frames(list(source.glob("*.csv")))
+    if source.is_dir():
+        return load_history_frames(source)
+    return load_csv_frames([source])
+
+
+class Replayer:
+    """Feeds recorded frames through a ConnectionManager in place of the random walk.
+
+    Recorded values of input cells are applied as-is and recorded overrides
+    go through update_cell; formula cells are recomputed from the current
+    formulas and compared with what was recorded, so a formula edit can be
+    checked against a real session. Older builds evaluated some formulas
+    before their inputs had moved on in the same tick; a value of a formula
+    reading other cells that matches it over the previous frame is counted
+    as lagged rather than as a mismatch, and cells showing an override
+    aren't checked. `speed` is a
+    multiple of real time, and 0 replays as fast as possible.
+    """
+
+    def __init__(self, manager, frames: List[Frame], speed: float = 1.0, tolerance: float = 1e-6):
+        self.manager = manager
+        self.frames = frames
+        self.speed = speed
+        self.tolerance = tolerance
+        self.frames_applied = 0
+        self.rows_applied = 0
+        self.mismatches = 0
+        self.lagged = 0
+        self.skipped = 0
+        self.last_recorded: Dict[Tuple[str, str], float] = {}
+        self.max_deviation = 0.0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.running = False
+
+    async def run(self):
+        if not self.frames:
+            return
+        self.running = True
+        self.started_at = time.monotonic()
+        first_time = self.frames[0][0]
+        previous_time = first_time
+        try:
+            for frame_time, rows in self.frames:
+                if self.speed > 0:
+                    due = self.started_at + (frame_time - first_time).total_seconds() / self.speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif self.frames_applied % 100 == 0:
+                    # Let clients and other tasks in between frames
+                    await asyncio.sleep(0)
+                self.apply(rows, (frame_time - previous_time).total_seconds())
+                previous_time = frame_time
+                await self.manager.broadcast_changes()
+        finally:
+            self.finished_at = time.monotonic()
+            self.running = False
+
+    def apply(self, rows: List[Row], time_diff: float):
+        manager = self.manager
+        # Formulas over the previous frame's cells, reading their own cell as last
+        # recorded, for recordings that evaluated a formula before the inputs it
+        # reads had moved on in the same tick
+        lagged = {}
+        for symbol, field, _, is_override, _ in rows:
+            calculator = manager.symbols[symbol].calculator if symbol in manager.symbols else None
+            if is_override or calculator is None or calculator.evaluators.get(field) is None:
+                continue
+            # Only a formula reading other cells can lag behind them; one reading just
+            # time_diff or its own cell has nothing to lag and must match outright
+            if not calculator.compiled[field].references - {(symbol, field)}:
+                continue
+            current = getattr(calculator, field)
+            setattr(calculator, field, self.last_recorded.get((symbol, field), current))
+            try:
+                lagged[(symbol, field)] = calculator.calculate_value(field, time_diff, calculator.seed)
+            finally:
+                setattr(calculator, field, current)
+        recorded = []
+        overridden = set()
+        for symbol, field, value, is_override, user_id in rows:
+            if symbol not in manager.symbols:
+                manager.add_symbol(symbol)
+            calculator = manager.symbols[symbol].calculator
+            if is_override:
+                # Older builds logged a removal as an override row from "<user>_removed"
+                if user_id and user_id.endswith(REMOVED_SUFFIX):
+                    manager.update_cell(symbol, field, None, user_id[:-len(REMOVED_SUFFIX)])
+                else:
+                    manager.update_cell(symbol, field, value, user_id or REPLAY_USER)
+                overridden.add((symbol, field))
+            elif field in NUMERIC_FIELDS:
+                # Calculated values are only logged for cells without overrides, and
+                # removals aren't logged at all now, so an override still held here was
+                # removed in the recording
+                for override_user in list(calculator.overrides[field]):
+                    manager.update_cell(symbol, field, None, override_user)
+                if calculator.compiled.get(field) is not None:
+                    recorded.append((calculator, field, value))
+                else:
+                    manager.set_cell_value(calculator, field, value)
+                    manager.graph.mark_dirty((symbol, field))
+            self.rows_applied += 1
+        # Formulas reading time or their own cell change every frame, as they do every tick
+        for cell in manager.volatile_cells:
+            manager.graph.mark_dirty(cell)
+        manager.recalculate(time_diff)
+        for calculator, field, value in recorded:
+            cell = (calculator.symbol, field)
+            self.last_recorded[cell] = value
+            if cell in overridden or calculator.overrides[field]:
+                # Shows the override rather than the formula, so there's nothing to check
+                self.skipped += 1
+                continue
+            deviation = abs(getattr(calculator, field) - value)
+            if deviation <= self.tolerance:
+                continue
+            if cell in lagged and abs(lagged[cell] - value) <= self.tolerance:
+                self.lagged += 1
+                continue
+            self.mismatches += 1
+            self.max_deviation = max(self.max_deviation, deviation)
+        self.frames_applied += 1
+
+    def report(self) -> Dict:
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        elapsed = end - self.started_at if self.started_at is not None else 0.0
+        span = (self.frames[-1][0] - self.frames[0][0]).total_seconds() if self.frames else 0.0
+        return {
+            "running": self.running,
+            "speed": self.speed,
+            "frames": len(self.frames),
+            "frames_applied": self.frames_applied,
+            "rows_applied": self.rows_applied,
+            "elapsed_seconds": elapsed,
+            "recorded_seconds": span,
+            "frames_per_second": self.frames_applied / elapsed if elapsed > 0 else None,
+            "rows_per_second": self.rows_applied / elapsed if elapsed > 0 else None,
+            "effective_speed": span / elapsed if elapsed > 0 and self.finished_at is not None else None,
+            "formula_mismatches": self.mismatches,
+            "formula_lagged": self.lagged,
+            "formula_skipped": self.skipped,
+            "max_formula_deviation": self.max_deviation,
+        }
+
+
+if __name__ == "__main__":
+    # python replay.py logs/trading_values_20250511_184432.csv --speed 0 \
+    #     --formula "TYM5.bid_edge=0.4 * context['NQM5']['bid_edge']"
+    import json
+    from main import ConnectionManager
+
+    parser = argparse.ArgumentParser(description="Replay recorded value logs through the calculators")
+    parser.add_argument("source", type=Path, help="value log CSV, directory of CSVs or history directory")
+    parser.add_argument("--speed", type=float, default=0, help="multiple of real time; 0 is as fast as possible")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--formula", action="append", default=[], metavar="SYMBOL.field=EXPR",
+                        help="replace a formula before replaying")
+    args = parser.parse_args()
+
+    async def main():
+        manager = ConnectionManager(seed=args.seed)
+        for spec in args.formula:
+            cell, formula = spec.split("=", 1)
+            symbol, field = cell.split(".", 1)
+            manager.set_formula(symbol, field, formula)
+        replayer = Replayer(manager, load_frames(args.source), args.speed)
+        await replayer.run()
+        print(json.dumps(replayer.report(), indent=2))
+
+    asyncio.run(main())
@@ -0,0 +1,212 @@
+import asyncio
+import math
+from typing import Callable, Dict, Iterable, List, Optional
+
+# What a group does when a tick finishes after its next deadline has passed
+OVERRUN_POLICIES = ("skip", "catch_up")
+DEFAULT_POLICY = "skip"
+DEFAULT_GROUP = "default"
+DEFAULT_INTERVAL = 1.0
+MIN_INTERVAL = 0.01
+# Edits within this long of each other go out in one flush, but none waits longer than the max delay
+DEFAULT_FLUSH_WINDOW = 0.02
+DEFAULT_FLUSH_MAX_DELAY = 0.05
+
+
+class TickGroup:
+    """Symbols that tick together at a fixed interval"""
+
+    def __init__(self, name: str, interval: float, policy: str = DEFAULT_POLICY):
+        self.name = name
+        self.interval = interval
+        self.policy = policy
+        self.deadline: Optional[float] = None
+        self.last_tick: Optional[float] = None
+        self.ticks = 0
+        # Deadlines dropped without a tick because an earlier tick overran
+        self.missed = 0
+        # Ticks that started after their deadline by more than a whole interval
+        self.late = 0
+        self.max_lag = 0.0
+
+    def fire(self, now: float, max_catch_up: int):
+        """Record a tick at `now` for the current deadline and move to the next one"""
+        lag = now - self.deadline
+        self.ticks += 1
+        self.last_tick = now
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.interval:
+            self.late += 1
+        if self.policy == "catch_up":
+            self.deadline += self.interval
+            behind = math.floor((now - self.deadline) / self.interval) + 1
+            # Catch up at most max_catch_up ticks, then drop the rest
+            if behind > max_catch_up:
+                self.missed += behind - max_catch_up
+                self.deadline += (behind - max_catch_up) * self.interval
+        else:
+            # Next deadline on the original grid that's still in the future
+            behind = math.floor(lag / self.interval) + 1
+            self.missed += behind - 1
+            self.deadline += behind * self.interval
+
+    def stats(self) -> Dict:
+        return {
+            "interval": self.interval,
+            "policy": self.policy,
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "late": self.late,
+            "max_lag": self.max_lag,
+        }
+
+
+class TickScheduler:
+    """Fixed-rate tick deadlines on the event loop's monotonic clock, per group of symbols.
+
+    Deadlines advance by whole intervals from when a group started, so the
+    time spent computing and broadcasting a tick doesn't push the next one
+    back. Symbols that aren't assigned to a group tick with the default group.
+    """
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL, policy: str = DEFAULT_POLICY, max_catch_up: int = 10):
+        self.max_catch_up = max(1, max_catch_up)
+        self.groups: Dict[str, TickGroup] = {}
+        self.symbol_groups: Dict[str, str] = {}
+        self.set_group(DEFAULT_GROUP, interval, policy)
+
+    def set_group(self, name: str, interval: Optional[float] = None, policy: Optional[str] = None) -> TickGroup:
+        if interval is not None and interval < MIN_INTERVAL:
+            raise ValueError(f"Interval must be at least {MIN_INTERVAL}s")
+        if policy is not None and policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy: {policy}")
+        group = self.groups.get(name)
+        if group is None:
+            group = self.groups[name] = TickGroup(name, interval or DEFAULT_INTERVAL, policy or DEFAULT_POLICY)
+        else:
+            if interval is not None and interval != group.interval:
+                group.interval = interval
+                # Restart the grid so a shorter interval takes effect straight away
+                if group.last_tick is not None:
+                    group.deadline = group.last_tick + interval
+            if policy is not None:
+                group.policy = policy
+        return group
+
+    def remove_group(self, name: str):
+        if name == DEFAULT_GROUP:
+            raise ValueError("The default group can't be removed")
+        if self.groups.pop(name, None) is None:
+            raise KeyError(name)
+        self.symbol_groups = {symbol: group for symbol, group in self.symbol_groups.items() if group != name}
+
+    def assign(self, symbols: Iterable[str], name: str):
+        if name not in self.groups:
+            raise KeyError(name)
+        for symbol in symbols:
+            if name == DEFAULT_GROUP:
+                self.symbol_groups.pop(symbol, None)
+            else:
+                self.symbol_groups[symbol] = name
+
+    def group_of(self, symbol: str) -> str:
+        return self.symbol_groups.get(symbol, DEFAULT_GROUP)
+
+    def due(self, now: float) -> List[TickGroup]:
+        """Groups whose deadline has passed, with their deadlines moved on"""
+        due = []
+        for group in self.groups.values():
+            if group.deadline is None:
+                group.deadline = now
+            if group.deadline <= now:
+                group.fire(now, self.max_catch_up)
+                due.append(group)
+        return due
+
+    def next_deadline(self) -> Optional[float]:
+        deadlines = [group.deadline for group in self.groups.values() if group.deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def stats(self) -> Dict:
+        return {
+            "max_catch_up": self.max_catch_up,
+            "groups": {name: group.stats() for name, group in self.groups.items()},
+            "symbols": dict(self.symbol_groups),
+        }
+
+
+class FlushScheduler:
+    """Coalesces bursts of requests into one call of `flush`.
+
+    A request schedules the flush `window` seconds out, and every request
+    after it moves that back to `window` after the latest, so a burst goes
+    out together once it pauses. No flush is put off more than `max_delay`
+    after the first request it covers, however long the burst runs. With
+    a window of 0, or no running event loop, every request flushes at once.
+    """
+
+    def __init__(self, flush: Callable[[], None], window: float = DEFAULT_FLUSH_WINDOW,
+                 max_delay: float = DEFAULT_FLUSH_MAX_DELAY):
+        self.flush = flush
+        self.configure(window, max_delay)
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.first_request: Optional[float] = None
+        self.last_request = 0.0
+        self.requests = 0
+        self.flushes = 0
+        self.max_wait = 0.0
+
+    def configure(self, window: float, max_delay: float):
+        if window < 0 or max_delay < 0:
+            raise ValueError("Flush window and max delay can't be negative")
+        self.window = window
+        self.max_delay = max(window, max_delay)
+
+    def request(self):
+        self.requests += 1
+        loop = None
+        if self.window > 0:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+        if loop is None:
+            self.flushes += 1
+            self.flush()
+            return
+        now = loop.time()
+        self.last_request = now
+        if self.first_request is None:
+            self.first_request = now
+        if self.handle is None:
+            # Later requests don't reschedule; the timer checks for them when it fires
+            self.handle = loop.call_at(now + self.window, self._fire)
+
+    def _fire(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        due = min(self.last_request + self.window, self.first_request + self.max_delay)
+        if due > now:
+            self.handle = loop.call_at(due, self._fire)
+            return
+        self.handle = None
+        self.max_wait = max(self.max_wait, now - self.first_request)
+        self.first_request = None
+        self.flushes += 1
+        self.flush()
+
+    def cancel(self):
+        """Drop the pending flush, for when the caller is about to flush anyway"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.first_request = None
+
+    def stats(self) -> Dict:
+        return {
+            "window": self.window,
+            "max_delay": self.max_delay,
+            "requests": self.requests,
+            "flushes": self.flushes,
+            "max_wait": self.max_wait,
+        }
@@ -0,0 +1,253 @@
+import itertools
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+from formulas import NUMERIC_FIELDS, FormulaError, compile_formula
+from state_store import EDGE_FIELDS, ColumnarStore, StoredField, np
+
+DEFAULT_CAPACITY = 65536
+# How long a worker waits at a phase barrier, or the hub for a tick, before giving up on it
+PHASE_TIMEOUT = 10.0
+
+
+class SharedColumnarStore(ColumnarStore):
+    """A ColumnarStore whose columns and flags live in one shared memory segment.
+
+    The hub creates the segment and every shard worker attaches to it by
+    name, so all processes read and write the same values without copying.
+    The capacity is fixed when the segment is created.
+    """
+
+    def __init__(self, seed: Optional[int] = None, capacity: int = DEFAULT_CAPACITY,
+                 name: Optional[str] = None, shard: int = 0):
+        super().__init__(seed, 1)
+        n = len(NUMERIC_FIELDS)
+        size = capacity * n * (8 + 1 + 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.owner = name is None
+        self.capacity = capacity
+        offset = 0
+        self.columns, self.walking, self.overridden = {}, {}, {}
+        for arrays, dtype in ((self.columns, np.float64), (self.walking, np.bool_), (self.overridden, np.bool_)):
+            for field in NUMERIC_FIELDS:
+                arrays[field] = np.ndarray((capacity,), dtype=dtype, buffer=self.shm.buf, offset=offset)
+                offset += capacity * np.dtype(dtype).itemsize
+        # Each shard walks its own symbols from its own streams
+        streams = np.random.SeedSequence(seed, spawn_key=(shard,)).spawn(n)
+        self.rngs = {field: np.random.default_rng(stream) for field, stream in zip(NUMERIC_FIELDS, streams)}
+
+    def _grow(self, capacity: int):
+        raise RuntimeError(f"Shared state segment is full ({self.capacity} symbols); raise TRADING_SHARD_CAPACITY")
+
+    def close(self):
+        # The arrays hold views of the buffer, which must be released first
+        self.columns = self.walking = self.overridden = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ShardCell:
+    """One symbol's row of the shared store, which worker formulas are bound to"""
+
+    bid_edge = StoredField()
+    ask_edge = StoredField()
+    bid_q = StoredField()
+    ask_q = StoredField()
+
+    def __init__(self, symbol: str, store: SharedColumnarStore, slot: int):
+        self.symbol = symbol
+        self.store = store
+        self.slot = slot
+
+
+def worker_main(shard: int, shards: int, name: str, capacity: int, seed: Optional[int], conn, barrier):
+    """Run one shard: walk its symbols' inputs and evaluate its formula cells, level by level"""
+    store = SharedColumnarStore(seed, capacity, name, shard)
+    own_slots = np.zeros(0, dtype=np.intp)
+    # Per level, (cell, field, symbol seed, evaluator) for this shard's formula cells
+    levels: List[List[Tuple[ShardCell, str, int, object]]] = []
+    errors = 0
+    try:
+        while True:
+            # Replies carry the phase they answer, so the hub can tell them from late ones
+            command, phase, payload = conn.recv()
+            if command == "stop":
+                break
+            if command == "config":
+                cells = {symbol: ShardCell(symbol, store, slot) for symbol, slot, _ in payload["symbols"]}
+                seeds = {symbol: symbol_seed for symbol, _, symbol_seed in payload["symbols"]}
+                store.size = payload["size"]
+                own_slots = np.array([slot for _, slot, _ in payload["symbols"] if slot % shards == shard],
+                                     dtype=np.intp)
+                levels = [[] for _ in range(payload["max_level"] + 1)]
+                for symbol, field, source, level in payload["formulas"]:
+                    if cells[symbol].slot % shards != shard:
+                        continue
+                    try:
+                        evaluator = compile_formula(symbol, field, source).bind(cells.get, cells[symbol])
+                    except FormulaError:
+                        errors += 1
+                        continue
+                    levels[level].append((cells[symbol], field, seeds[symbol], evaluator))
+                conn.send(("configured", phase, None))
+            elif command == "tick":
+                time_diff, slots = payload
+                if slots is None:
+                    walk = own_slots
+                else:
+                    slots = np.asarray(slots, dtype=np.intp)
+                    walk = slots[slots % shards == shard]
+                if walk.size:
+                    store.step(walk)
+                overridden = store.overridden
+                try:
+                    for level, formulas in enumerate(levels):
+                        # Level 0 reads nothing, so it can run alongside the walk; every
+                        # later level waits until all shards have written the one before
+                        if level:
+                            barrier.wait(PHASE_TIMEOUT)
+                        for cell, field, symbol_seed, evaluator in formulas:
+                            if overridden[field][cell.slot]:
+                                continue
+                            try:
+                                value = evaluator(time_diff, symbol_seed)
+                                value = round(value, 2) if field in EDGE_FIELDS else round(value)
+                            except Exception:
+                                # Keep the previous value rather than guess one
+                                errors += 1
+                                continue
+                            setattr(cell, field, value)
+                except threading.BrokenBarrierError:
+                    conn.send(("error", phase, f"Shard {shard} timed out waiting for the other shards"))
+                    continue
+                conn.send(("ticked", phase, errors))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        store.close()
+
+
+class ShardPool:
+    """Worker processes that each tick a partition of the symbols in a shared store.
+
+    Symbols are partitioned by slot. A tick walks every shard's inputs, then
+    evaluates formula cells one dependency level at a time with a barrier in
+    between, so a formula reading another shard's cell always sees that
+    cell's value for the same tick. The hub (the process serving websockets)
+    diffs the shared columns after each tick to find what changed.
+    """
+
+    def __init__(self, shards: int, seed: Optional[int] = None, capacity: int = DEFAULT_CAPACITY):
+        self.shards = shards
+        self.store = SharedColumnarStore(seed, capacity)
+        # Values as of the last diff, to find what the workers changed
+        self.previous = {field: np.zeros(capacity) for field in NUMERIC_FIELDS}
+        self.errors = 0
+        self.ticks = 0
+        self.closed = False
+        self.phases = itertools.count(1)
+        context = multiprocessing.get_context("spawn")
+        self.barrier = context.Barrier(shards)
+        self.connections = []
+        self.processes = []
+        for shard in range(shards):
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=worker_main,
+                args=(shard, shards, self.store.shm.name, capacity, seed, child, self.barrier),
+                name=f"trading-shard-{shard}",
+                daemon=True
+            )
+            process.start()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def _send(self, command: str, payload) -> int:
+        phase = next(self.phases)
+        for conn in self.connections:
+            conn.send((command, phase, payload))
+        return phase
+
+    def _gather(self, expected: str, phase: int) -> List:
+        """Every worker's reply to `phase`, skipping replies left over from earlier phases.
+
+        All workers are waited on up to one shared deadline even once one has
+        failed, so no reply to this phase is left to be read by the next one;
+        replies that come later still are skipped by their phase.
+        """
+        deadline = time.monotonic() + PHASE_TIMEOUT
+        results = []
+        failure = None
+        for shard, conn in enumerate(self.connections):
+            while True:
+                if not conn.poll(max(0.0, deadline - time.monotonic())):
+                    failure = failure or f"Shard worker {shard} did not respond"
+                    break
+                status, reply_phase, payload = conn.recv()
+                if reply_phase != phase:
+                    continue
+                if status != expected:
+                    failure = failure or payload
+                else:
+                    results.append(payload)
+                break
+        if failure is not None:
+            # Workers still waiting at a barrier give up on this phase rather than deadlock the next
+            self.barrier.reset()
+            raise RuntimeError(failure)
+        return results
+
+    def configure(self, symbols: List[Tuple[str, int, int]], formulas: List[Tuple[str, str, str, int]]):
+        """Send every worker the symbols' slots and the formulas with their dependency levels"""
+        config = {
+            "size": self.store.size,
+            "symbols": symbols,
+            "formulas": formulas,
+            "max_level": max((level for *_, level in formulas), default=0),
+        }
+        self._gather("configured", self._send("config", config))
+
+    def tick(self, time_diff: float, slots: Optional[List[int]] = None):
+        """Blocks until every worker has ticked, so call it from an executor rather than the event loop"""
+        self.errors = sum(self._gather("ticked", self._send("tick", (time_diff, slots))))
+        self.ticks += 1
+
+    def diff(self) -> Dict[str, "np.ndarray"]:
+        """Slots whose values changed since the last diff, per field"""
+        size = self.store.size
+        changed = {}
+        for field in NUMERIC_FIELDS:
+            column = self.store.columns[field][:size]
+            previous = self.previous[field][:size]
+            slots = np.flatnonzero(column != previous)
+            if slots.size:
+                previous[slots] = column[slots]
+                changed[field] = slots
+        return changed
+
+    def stats(self) -> Dict:
+        return {
+            "shards": self.shards,
+            "capacity": self.store.capacity,
+            "symbols": self.store.size,
+            "ticks": self.ticks,
+            "formula_errors": self.errors,
+            "alive": [process.is_alive() for process in self.processes],
+        }
+
+    def close(self):
+        self.closed = True
+        for conn in self.connections:
+            try:
+                conn.send(("stop", 0, None))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.store.close()
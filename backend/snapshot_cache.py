@@ -0,0 +1,57 @@
+import os
+from typing import Callable, Dict, Hashable
+
+DEFAULT_MAX_ENTRIES = 64
+
+
+class SnapshotCache:
+    """Serialized snapshots of the sheet, built once per version and shared.
+
+    The sheet's version moves on with every broadcast that changes what a
+    snapshot would hold. Until it does, every request for the same kind of
+    snapshot (message type, encoding, subscription) gets the same string,
+    so a storm of reconnects costs one serialization instead of one each.
+    Values that change between broadcasts aren't missed: they're in the
+    next broadcast, which every client gets after its snapshot.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.version = 0
+        # Tells this process's versions apart from a restarted one's in ETags
+        self.instance = os.urandom(4).hex()
+        self.entries: Dict[Hashable, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self):
+        """Start a new version, dropping every snapshot of the old one"""
+        self.version += 1
+        self.entries.clear()
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.instance}-{self.version}"'
+
+    def get(self, key: Hashable, build: Callable[[], str]) -> str:
+        """The snapshot for `key` at the current version, built by `build` if there isn't one yet"""
+        text = self.entries.get(key)
+        if text is not None:
+            self.hits += 1
+            return text
+        self.misses += 1
+        text = build()
+        if len(self.entries) >= self.max_entries:
+            # Many distinct subscriptions at one version; start over rather than track usage
+            self.entries.clear()
+        self.entries[key] = text
+        return text
+
+    def stats(self) -> Dict:
+        return {
+            "version": self.version,
+            "etag": self.etag,
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,113 @@
+from typing import Dict, List, Optional
+
+from formulas import NUMERIC_FIELDS
+
+try:
+    import numpy as np
+except ImportError:  # The columnar store is optional
+    np = None
+
+EDGE_FIELDS = ("bid_edge", "ask_edge")
+
+
+class StoredField:
+    """A calculator attribute that lives in a ColumnarStore once the calculator is attached"""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        store = obj.store
+        if store is None:
+            return obj.__dict__[self.name]
+        return float(store.columns[self.name][obj.slot])
+
+    def __set__(self, obj, value):
+        store = obj.store
+        if store is None:
+            obj.__dict__[self.name] = value
+        else:
+            store.columns[self.name][obj.slot] = value
+
+
+class ColumnarStore:
+    """One contiguous float64 array per numeric field, indexed by symbol slot.
+
+    Cells flagged as walking (no formula, no override) are advanced together
+    by `step`, one vectorized random walk per field drawn from its own
+    seeded generator, so a run with the same seed and symbols is reproducible.
+    """
+
+    def __init__(self, seed: Optional[int] = None, capacity: int = 64):
+        if np is None:
+            raise RuntimeError("numpy is required for the columnar state store")
+        self.capacity = max(1, capacity)
+        self.size = 0
+        self.symbols: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.columns = {field: np.zeros(self.capacity) for field in NUMERIC_FIELDS}
+        self.walking = {field: np.zeros(self.capacity, dtype=bool) for field in NUMERIC_FIELDS}
+        # Cells with overrides, which nothing but the overrides may write
+        self.overridden = {field: np.zeros(self.capacity, dtype=bool) for field in NUMERIC_FIELDS}
+        streams = np.random.SeedSequence(seed).spawn(len(NUMERIC_FIELDS))
+        self.rngs = {field: np.random.default_rng(stream) for field, stream in zip(NUMERIC_FIELDS, streams)}
+
+    def add(self, symbol: str, values: Dict[str, float]) -> int:
+        if symbol in self.index:
+            return self.index[symbol]
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+        slot = self.size
+        for field in NUMERIC_FIELDS:
+            self.columns[field][slot] = values.get(field, 0)
+            self.walking[field][slot] = False
+            self.overridden[field][slot] = False
+        self.symbols.append(symbol)
+        self.index[symbol] = slot
+        self.size += 1
+        return slot
+
+    def _grow(self, capacity: int):
+        for field in NUMERIC_FIELDS:
+            column = np.zeros(capacity)
+            column[:self.size] = self.columns[field][:self.size]
+            self.columns[field] = column
+            walking = np.zeros(capacity, dtype=bool)
+            walking[:self.size] = self.walking[field][:self.size]
+            self.walking[field] = walking
+            overridden = np.zeros(capacity, dtype=bool)
+            overridden[:self.size] = self.overridden[field][:self.size]
+            self.overridden[field] = overridden
+        self.capacity = capacity
+
+    def set_walking(self, slot: int, field: str, walking: bool):
+        self.walking[field][slot] = walking
+
+    def set_overridden(self, slot: int, field: str, overridden: bool):
+        self.overridden[field][slot] = overridden
+
+    def step(self, slots=None) -> Dict[str, "np.ndarray"]:
+        """Advance every walking cell, or those among `slots`, one step; returns the slots that moved per field"""
+        selected = None if slots is None else np.asarray(slots, dtype=np.intp)
+        changed = {}
+        for field in NUMERIC_FIELDS:
+            if selected is None:
+                slots = np.flatnonzero(self.walking[field][:self.size])
+            else:
+                slots = selected[self.walking[field][selected]]
+            if not slots.size:
+                continue
+            column = self.columns[field]
+            values = column[slots]
+            noise = self.rngs[field].uniform(-1, 1, slots.size)
+            if field in EDGE_FIELDS:
+                # Random walk with mean reversion towards 100
+                new_values = np.round(values + noise * 0.1 + (100 - values) * 0.01, 2)
+            else:
+                # Random walk within [1, 100]
+                new_values = np.round(np.clip(values + noise, 1, 100))
+            column[slots] = new_values
+            changed[field] = slots[new_values != values]
+        return changed
@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+OFF = 100
+
+LEVELS = {
+    "TRACE": TRACE,
+    "DEBUG": DEBUG,
+    "INFO": INFO,
+    "WARNING": WARNING,
+    "ERROR": ERROR,
+    "OFF": OFF,
+}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+
+def parse_level(level) -> int:
+    if isinstance(level, int):
+        return level
+    try:
+        return LEVELS[str(level).upper()]
+    except KeyError:
+        raise ValueError(f"Unknown log level: {level}") from None
+
+
+class TraceLog:
+    """Leveled log records for the tick loop, kept off stdout's critical path.
+
+    Levels can be set for the whole sheet, a symbol or a single cell, and
+    `enabled` is checked before building a record, so disabled logging costs
+    one comparison. Records go to an in-memory ring buffer (for /debug/trace)
+    and to a pending queue that a background thread flushes to the standard
+    `logging` module.
+    """
+
+    def __init__(self, level: int = WARNING, capacity: int = 10000,
+                 flush_interval: float = 0.5, logger: Optional[logging.Logger] = None):
+        self.default_level = level
+        self.symbol_levels: Dict[str, int] = {}
+        self.cell_levels: Dict[Tuple[str, str], int] = {}
+        self.min_level = level
+        self.ring: deque = deque(maxlen=capacity)
+        self.pending: deque = deque(maxlen=capacity)
+        self.flush_interval = flush_interval
+        self.logger = logger or logging.getLogger("trading")
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def set_level(self, level, symbol: Optional[str] = None, field: Optional[str] = None):
+        """Set the level for the sheet, a symbol or a cell; None for a symbol or cell clears it"""
+        level = parse_level(level) if level is not None else None
+        if field is not None and symbol is not None:
+            levels, key = self.cell_levels, (symbol, field)
+        elif symbol is not None:
+            levels, key = self.symbol_levels, symbol
+        else:
+            self.default_level = level if level is not None else WARNING
+            levels = key = None
+        if levels is not None:
+            if level is None:
+                levels.pop(key, None)
+            else:
+                levels[key] = level
+        self.min_level = min([self.default_level, *self.symbol_levels.values(), *self.cell_levels.values()])
+
+    def get_levels(self) -> Dict:
+        return {
+            "default": LEVEL_NAMES.get(self.default_level, self.default_level),
+            "symbols": {symbol: LEVEL_NAMES.get(level, level) for symbol, level in self.symbol_levels.items()},
+            "cells": {f"{symbol}.{field}": LEVEL_NAMES.get(level, level)
+                      for (symbol, field), level in self.cell_levels.items()},
+        }
+
+    def level_for(self, symbol: Optional[str], field: Optional[str]) -> int:
+        level = self.cell_levels.get((symbol, field))
+        if level is None:
+            level = self.symbol_levels.get(symbol, self.default_level)
+        return level
+
+    def enabled(self, level: int, symbol: Optional[str] = None, field: Optional[str] = None) -> bool:
+        """Whether a record at `level` would be kept; without a symbol, whether any could be"""
+        if level < self.min_level:
+            return False
+        if symbol is None:
+            return True
+        return level >= self.level_for(symbol, field)
+
+    def log(self, level: int, symbol: Optional[str], field: Optional[str], message: str, **values):
+        record = (time.time(), level, symbol, field, message, values)
+        self.ring.append(record)
+        self.pending.append(record)
+
+    def tail(self, symbol: str, field: Optional[str] = None, limit: int = 100) -> List[Dict]:
+        records = []
+        for record in reversed(self.ring):
+            if record[2] == symbol and (field is None or record[3] == field):
+                records.append(self._as_dict(record))
+                if len(records) >= limit:
+                    break
+        records.reverse()
+        return records
+
+    @staticmethod
+    def _as_dict(record) -> Dict:
+        timestamp, level, symbol, field, message, values = record
+        return {
+            "timestamp": timestamp,
+            "level": LEVEL_NAMES.get(level, level),
+            "symbol": symbol,
+            "field": field,
+            "message": message,
+            "values": values,
+        }
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if not self.logger.handlers and not logging.getLogger().handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+            self.logger.addHandler(handler)
+        self.logger.setLevel(TRACE)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="trace-log-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        pending = self.pending
+        while pending:
+            try:
+                timestamp, level, symbol, field, message, values = pending.popleft()
+            except IndexError:
+                break
+            location = ".".join(part for part in (symbol, field) if part)
+            details = " ".join(f"{key}={value}" for key, value in values.items())
+            text = " ".join(part for part in (location, message, details) if part)
+            # Keep the time the record was made rather than the time it was flushed
+            log_record = self.logger.makeRecord(self.logger.name, level, __file__, 0, text, None, None)
+            log_record.created = timestamp
+            log_record.msecs = (timestamp % 1) * 1000
+            self.logger.handle(log_record)
+
+
+trace = TraceLog(parse_level(os.environ.get("TRADING_LOG_LEVEL", "WARNING")))
@@ -0,0 +1,199 @@
+import csv
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from trace_log import ERROR, trace
+
+# One CSV file per rotation, named after the time it was opened
+# Next to this file, whatever directory the server is started from
+LOGS_DIR = Path(__file__).parent / "logs"
+
+FIELDNAMES = ['timestamp', 'symbol', 'field', 'value', 'is_override', 'user_id']
+
+
+def row_to_dict(row) -> Dict:
+    row_id, timestamp, symbol, field, value, is_override, user_id = row
+    return {
+        'id': row_id,
+        'timestamp': timestamp.isoformat(),
+        'symbol': symbol,
+        'field': field,
+        'value': value,
+        'is_override': str(is_override),
+        'user_id': user_id
+    }
+
+
+class ValueLogger:
+    """Records calculated values and overrides without blocking the event loop.
+
+    `log_value` only appends a tuple to an in-memory window (served by
+    /logs) and to a bounded queue. A writer thread drains the queue in
+    batches, flushing on `batch_size` rows or every `flush_interval`
+    seconds, and starts a new CSV file once the current one passes
+    `max_bytes` or `max_age` seconds.
+    """
+
+    def __init__(self, logs_dir: Path = LOGS_DIR, batch_size: int = 1000, flush_interval: float = 1.0,
+                 max_bytes: int = 50 * 1024 * 1024, max_age: float = 3600, max_queue: int = 100000,
+                 recent: int = 10000):
+        self.logs_dir = Path(logs_dir)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.recent: deque = deque(maxlen=recent)
+        self.ids = itertools.count(1)
+        self.dropped = 0
+        self.written = 0
+        self.log_file: Optional[Path] = None
+        # Called from the writer thread with every batch of rows, e.g. HistoryStore.append_rows
+        self.sinks: List[Callable[[List], None]] = []
+        self._file = None
+        self._writer = None
+        self._opened_at = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def log_value(self, timestamp: datetime, symbol: str, field: str, value, is_override: bool,
+                  user_id: Optional[str] = None):
+        row = (next(self.ids), timestamp, symbol, field, value, is_override, user_id)
+        self.recent.append(row)
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def get_logs(self, cursor: Optional[int] = None, since: Optional[str] = None, limit: int = 1000) -> Dict:
+        """Up to `limit` rows after `cursor` (a row id) and at or after `since` (an ISO timestamp).
+
+        Without either, returns the latest rows. The returned cursor is the
+        id of the last row, to pass back for the next page. Only the most
+        recent rows are kept in memory, so `truncated` is set when rows the
+        caller asked for were already dropped, with `missed` counting them
+        when the cursor says how many.
+        """
+        since_time = datetime.fromisoformat(since) if since else None
+        if since_time is not None and since_time.tzinfo is not None:
+            since_time = since_time.astimezone().replace(tzinfo=None)
+        if cursor is None and since_time is None:
+            rows = list(itertools.islice(reversed(self.recent), limit))
+            rows.reverse()
+            has_more = False
+        else:
+            rows = []
+            # Rows are in id order, so walk back to the cursor and stop there
+            for row in reversed(self.recent):
+                if (cursor is not None and row[0] <= cursor) or (since_time is not None and row[1] < since_time):
+                    break
+                rows.append(row)
+            rows.reverse()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        # Ids start at 1, so an oldest row past that means earlier rows were dropped
+        oldest = self.recent[0] if self.recent else None
+        missed = 0
+        truncated = False
+        if oldest is not None and oldest[0] > 1:
+            if cursor is not None:
+                missed = max(0, oldest[0] - cursor - 1)
+                truncated = missed > 0
+            elif since_time is not None:
+                truncated = since_time < oldest[1]
+        return {
+            "logs": [row_to_dict(row) for row in rows],
+            "cursor": rows[-1][0] if rows else (cursor or 0),
+            "has_more": has_more,
+            "truncated": truncated,
+            "missed": missed
+        }
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="value-logger", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+                # Take whatever else is already queued without waiting
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stopping = self._stop.is_set()
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline or stopping:
+                if stopping:
+                    while True:
+                        try:
+                            batch.append(self.queue.get_nowait())
+                        except queue.Empty:
+                            break
+                if batch:
+                    self._write(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+            if stopping:
+                self._close_file()
+                return
+
+    def _write(self, batch: List):
+        try:
+            self._rotate_if_needed()
+            self._writer.writerows({key: value for key, value in row_to_dict(row).items() if key != 'id'}
+                                   for row in batch)
+            self._file.flush()
+            self.written += len(batch)
+        except OSError as e:
+            if trace.enabled(ERROR):
+                trace.log(ERROR, None, None, "error writing value log", error=str(e))
+            self._close_file()
+        for sink in self.sinks:
+            try:
+                sink(batch)
+            except Exception as e:
+                if trace.enabled(ERROR):
+                    trace.log(ERROR, None, None, "error in value log sink", error=str(e))
+
+    def _rotate_if_needed(self):
+        if self._file is not None:
+            too_big = self._file.tell() >= self.max_bytes
+            too_old = time.monotonic() - self._opened_at >= self.max_age
+            if not (too_big or too_old):
+                return
+            self._close_file()
+        self.logs_dir.mkdir(parents=True, exist_ok=True)
+        self.log_file = self.logs_dir / f"trading_values_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        # Rotating twice within a second appends to the same file rather than clobbering it
+        is_new = not self.log_file.exists()
+        self._file = open(self.log_file, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=FIELDNAMES)
+        if is_new:
+            self._writer.writeheader()
+        self._opened_at = time.monotonic()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._writer = None
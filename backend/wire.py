@@ -0,0 +1,123 @@
+import json
+import struct
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+# WebSocket subprotocols a client can ask for, most compact first; no subprotocol means JSON
+SUBPROTOCOLS = {
+    "trading.bin.v1": "binary",
+    "trading.json": "json",
+}
+DEFAULT_ENCODING = "json"
+
+# Field IDs in binary frames are indexes into this tuple
+WIRE_FIELDS = ("bid_edge", "ask_edge", "bid_q", "ask_q", "maker", "taker")
+FIELD_IDS = {field: i for i, field in enumerate(WIRE_FIELDS)}
+
+CELL_UPDATE = 1
+VERSION = 1
+# kind, version, skipped, seq, record count; skipped is how many cell_updates before this one
+# weren't for this client (a filtered subscription), so its previous one was seq - 1 - skipped
+FRAME_HEADER = struct.Struct("<BBHII")
+# symbol ID, field ID, flags, padding, value
+CELL_RECORD = struct.Struct("<IBBxxd")
+# The cell has overrides; they follow the records as a JSON array, one entry per flagged record
+FLAG_OVERRIDES = 1
+# The value is an ON/OFF toggle, stored as 1.0/0.0
+FLAG_TOGGLE = 2
+MAX_SKIPPED = 0xFFFF
+
+Payload = Union[str, bytes]
+
+
+def negotiate(requested: List[str]) -> Tuple[Optional[str], str]:
+    """The subprotocol to accept from the client's list, in its order of preference, and its encoding"""
+    for subprotocol in requested:
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol, SUBPROTOCOLS[subprotocol]
+    return None, DEFAULT_ENCODING
+
+
+class SymbolTable:
+    """Symbol IDs for binary frames; IDs are never reused, so clients only ever append"""
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+
+    def intern(self, symbol: str) -> int:
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.ids[symbol] = len(self.names)
+            self.names.append(symbol)
+        return symbol_id
+
+
+@lru_cache(maxsize=64)
+def frame_struct(count: int) -> struct.Struct:
+    """The header plus `count` records as one struct, so a frame is packed in a single call"""
+    return struct.Struct(FRAME_HEADER.format + CELL_RECORD.format.lstrip("<") * count)
+
+
+def encode_cell_update(seq: int, cell_data: Dict, symbols: SymbolTable, prev_seq: Optional[int] = None) -> bytes:
+    """A cell_update as fixed-width records, with any overrides in a JSON tail"""
+    skipped = 0 if prev_seq is None else seq - 1 - prev_seq
+    if not 0 <= skipped <= MAX_SKIPPED:
+        # Too far back to say; 0 makes the client see a gap and resync
+        skipped = 0
+    flat = [CELL_UPDATE, VERSION, skipped, seq, 0]
+    extend = flat.extend
+    ids = symbols.ids
+    overrides = []
+    count = 0
+    for symbol, fields in cell_data.items():
+        symbol_id = ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = symbols.intern(symbol)
+        for field, cell in fields.items():
+            value = cell["value"]
+            flags = 0
+            if isinstance(value, str):
+                flags = FLAG_TOGGLE
+                value = 1.0 if value == "ON" else 0.0
+            if cell["overrides"]:
+                flags |= FLAG_OVERRIDES
+                overrides.append(cell["overrides"])
+            extend((symbol_id, FIELD_IDS[field], flags, value))
+            count += 1
+    flat[4] = count
+    frame = frame_struct(count).pack(*flat)
+    if overrides:
+        frame += json.dumps(overrides, separators=(",", ":")).encode()
+    return frame
+
+
+def decode_cell_update(frame: bytes, names: List[str]) -> Dict:
+    """The inverse of encode_cell_update, in the JSON message's shape"""
+    kind, version, skipped, seq, count = FRAME_HEADER.unpack_from(frame, 0)
+    if kind != CELL_UPDATE or version != VERSION:
+        raise ValueError(f"Unsupported frame: kind {kind} version {version}")
+    end = FRAME_HEADER.size + CELL_RECORD.size * count
+    cell_data: Dict = {}
+    flagged = []
+    for symbol_id, field_id, flags, value in CELL_RECORD.iter_unpack(frame[FRAME_HEADER.size:end]):
+        if flags & FLAG_TOGGLE:
+            value = "ON" if value else "OFF"
+        cell = {"value": value, "overrides": {}}
+        cell_data.setdefault(names[symbol_id], {})[WIRE_FIELDS[field_id]] = cell
+        if flags & FLAG_OVERRIDES:
+            flagged.append(cell)
+    if flagged:
+        for cell, overrides in zip(flagged, json.loads(frame[end:])):
+            cell["overrides"] = overrides
+    message = {"type": "cell_update", "seq": seq, "cell_data": cell_data}
+    if skipped:
+        message["prev_seq"] = seq - 1 - skipped
+    return message
+
+
+def encode_binary(message: Dict, symbols: SymbolTable) -> Payload:
+    """Binary frames for cell updates; everything else is rare enough to stay JSON"""
+    if message.get("type") == "cell_update":
+        return encode_cell_update(message["seq"], message["cell_data"], symbols, message.get("prev_seq"))
+    return json.dumps(message)
@@ -1,6 +1,44 @@
 import React, { useState, useEffect, useRef } from 'react';
 import './SpreadsheetGrid.css';
 
+// Binary cell_update frames (see backend/wire.py): a 12-byte header, then
+// 16-byte records, then a JSON array of overrides for the flagged records
+const CELL_UPDATE_FRAME = 1;
+const FRAME_HEADER_SIZE = 12;
+const CELL_RECORD_SIZE = 16;
+const FLAG_OVERRIDES = 1;
+const FLAG_TOGGLE = 2;
+
+const decodeCellUpdate = (buffer, symbolNames, fieldNames) => {
+    const view = new DataView(buffer);
+    if (view.getUint8(0) !== CELL_UPDATE_FRAME) {
+        return null;
+    }
+    // Updates skipped because they had nothing this client is subscribed to
+    const skipped = view.getUint16(2, true);
+    const seq = view.getUint32(4, true);
+    const count = view.getUint32(8, true);
+    const cellData = {};
+    const flagged = [];
+    let offset = FRAME_HEADER_SIZE;
+    for (let i = 0; i < count; i++, offset += CELL_RECORD_SIZE) {
+        const symbol = symbolNames[view.getUint32(offset, true)];
+        const field = fieldNames[view.getUint8(offset + 4)];
+        const flags = view.getUint8(offset + 5);
+        const raw = view.getFloat64(offset + 8, true);
+        const cell = { value: flags & FLAG_TOGGLE ? (raw ? 'ON' : 'OFF') : raw, overrides: {} };
+        (cellData[symbol] = cellData[symbol] || {})[field] = cell;
+        if (flags & FLAG_OVERRIDES) {
+            flagged.push(cell);
+        }
+    }
+    if (flagged.length) {
+        const overrides = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, offset)));
+        flagged.forEach((cell, i) => { cell.overrides = overrides[i]; });
+    }
+    return { type: 'cell_update', seq, prev_seq: seq - 1 - skipped, cell_data: cellData };
+};
+
 const SpreadsheetGrid = () => {
     const defaultSymbols = ['ESM5', 'NQM5', 'TYM5', 'TUM5'];
     const defaultColumns = [
@@ -27,22 +65,39 @@ const SpreadsheetGrid = () => {
     const [draggedSymbol, setDraggedSymbol] = useState(null);
     const ws = useRef(null);
     const inputRef = useRef(null);
+    const lastSeq = useRef(0);
+    const awaitingSnapshot = useRef(false);
+    const symbolNames = useRef([]);
+    const fieldNames = useRef([]);
     const [masterMaker, setMasterMaker] = useState('ON');
     const [masterTaker, setMasterTaker] = useState('ON');
 
     useEffect(() => {
         console.log('Connecting to WebSocket...');
-        ws.current = new WebSocket('ws://localhost:8000/ws');
+        // Prefer the binary encoding for cell updates; the server falls back to JSON.
+        // Only the symbols on this sheet are sent.
+        const query = `symbols=${encodeURIComponent(defaultSymbols.join(','))}`;
+        ws.current = new WebSocket(`ws://localhost:8000/ws?${query}`, ['trading.bin.v1', 'trading.json']);
+        ws.current.binaryType = 'arraybuffer';
 
         ws.current.onopen = () => {
             console.log('WebSocket connected');
         };
 
         ws.current.onmessage = (event) => {
-            console.log('Received message:', event.data);
-            const data = JSON.parse(event.data);
+            const data = event.data instanceof ArrayBuffer
+                ? decodeCellUpdate(event.data, symbolNames.current, fieldNames.current)
+                : JSON.parse(event.data);
+            if (!data) {
+                return;
+            }
             
             if (data.type === 'initial_data') {
+                lastSeq.current = data.seq;
+                if (data.symbols) {
+                    symbolNames.current = data.symbols;
+                    fieldNames.current = data.fields;
+                }
                 setCells(data.cell_data);
                 if (data.column_orders && data.column_orders[userId]) {
                     const orderedColumns = data.column_orders[userId].map(id => 
@@ -61,6 +116,27 @@ const SpreadsheetGrid = () => {
                     }
                 }
             } else if (data.type === 'cell_update') {
+                // Updates only carry changed cells, so a gap means we've missed some.
+                // prev_seq is the previous update sent to us when others were skipped.
+                const prevSeq = typeof data.prev_seq !== 'undefined' ? data.prev_seq : data.seq - 1;
+                if (data.seq <= lastSeq.current || prevSeq > lastSeq.current) {
+                    if (data.seq > lastSeq.current && !awaitingSnapshot.current) {
+                        awaitingSnapshot.current = true;
+                        ws.current.send(JSON.stringify({ type: 'snapshot_request' }));
+                    }
+                    return;
+                }
+                lastSeq.current = data.seq;
+                setCells(prevCells => {
+                    const newCells = { ...prevCells };
+                    Object.entries(data.cell_data).forEach(([symbol, fields]) => {
+                        newCells[symbol] = { ...newCells[symbol], ...fields };
+                    });
+                    return newCells;
+                });
+            } else if (data.type === 'snapshot') {
+                awaitingSnapshot.current = false;
+                lastSeq.current = data.seq;
                 setCells(data.cell_data);
             } else if (data.type === 'column_order_update') {
                 if (data.user_id === userId) {
@@ -80,9 +156,19 @@ const SpreadsheetGrid = () => {
                         setSymbols(orderedSymbols);
                     }
                 }
+            } else if (data.type === 'symbol_added') {
+                if (typeof data.symbol_id !== 'undefined') {
+                    symbolNames.current[data.symbol_id] = data.symbol;
+                }
             } else if (data.type === 'master_state_update') {
                 if (typeof data.master_maker !== 'undefined') setMasterMaker(data.master_maker);
                 if (typeof data.master_taker !== 'undefined') setMasterTaker(data.master_taker);
+            } else if (data.type === 'error') {
+                if (data.cell_id) {
+                    console.error(`Edit to ${data.symbol}.${data.cell_id} rejected:`, data.message);
+                } else {
+                    console.error('Request rejected:', data.message);
+                }
             }
         };
 
@@ -1,8 +1,12 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import './ValueLogger.css';
 
+// Keep the panel bounded; older rows are dropped as new ones arrive
+const MAX_LOGS = 2000;
+
 const ValueLogger = () => {
     const [logs, setLogs] = useState([]);
+    const cursor = useRef(null);
     const [selectedSymbol, setSelectedSymbol] = useState('all');
     const [selectedField, setSelectedField] = useState('all');
     const [showOverrides, setShowOverrides] = useState(true);
@@ -11,17 +15,28 @@ const ValueLogger = () => {
     useEffect(() => {
         const fetchLogs = async () => {
             try {
-                const response = await fetch('http://localhost:8000/logs');
+                // Only ask for rows after the last one we've seen
+                const query = cursor.current === null ? '' : `?cursor=${cursor.current}`;
+                const response = await fetch(`http://localhost:8000/logs${query}`);
                 if (!response.ok) {
                     throw new Error('Logging service not available');
                 }
                 const data = await response.json();
-                setLogs(data.logs || []);
+                const newLogs = data.logs || [];
+                cursor.current = data.cursor;
+                if (data.truncated) {
+                    // Rows between the last poll and these were dropped by the server, so start afresh
+                    console.warn(`Value log skipped ${data.missed} rows`);
+                    setLogs(newLogs.slice(-MAX_LOGS));
+                } else if (newLogs.length > 0) {
+                    setLogs(prevLogs => [...prevLogs, ...newLogs].slice(-MAX_LOGS));
+                }
                 setError(null);
             } catch (error) {
                 console.error('Error fetching logs:', error);
                 setError('Logging service not available');
                 setLogs([]);
+                cursor.current = null;
             }
         };
 